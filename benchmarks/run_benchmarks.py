@@ -0,0 +1,501 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Benchmarks for the packet codec and the control round-trip path of
+blackstarid. No amplifier is needed: packets are synthesised and
+passed to BlackstarIDAmp through an in-memory transport.
+
+Run all benchmarks and save the results:
+
+    python3 benchmarks/run_benchmarks.py -o before.json
+
+Compare the results from two revisions:
+
+    python3 benchmarks/run_benchmarks.py --compare before.json after.json
+
+Benchmark decoding of real traffic recorded with blackstarid.capture:
+
+    python3 benchmarks/run_benchmarks.py --capture knobs.cap
+
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from blackstarid import BlackstarIDAmp, NoDataAvailable
+from blackstarid.blackstarid import AmpTransport, BlackstarIDAmpPreset
+from blackstarid.capture import ReplayTransport
+from blackstarid.library import PresetLibrary
+from blackstarid.manager import AmpManager
+from blackstarid.midi import MidiMap, MidiParser
+from blackstarid.reader import AmpReader
+from blackstarid.simulator import SimulatedAmp, SimulatedTransport
+
+
+class LoopTransport(AmpTransport):
+
+    '''Transport which endlessly replays a fixed list of packets and
+    discards anything written. This keeps the transport overhead to a
+    minimum, so that the time measured is dominated by BlackstarIDAmp.
+
+    '''
+
+    def __init__(self, packets, product_id=0x0001):
+        super(LoopTransport, self).__init__()
+        self.packets = packets
+        self.index = 0
+        self._product_id = product_id
+
+    def open(self, vendor):
+        self.product_id = self._product_id
+
+    def close(self):
+        self.product_id = None
+
+    def read(self, timeout=None):
+        packets = self.packets
+        if not packets:
+            raise NoDataAvailable
+        packet = packets[self.index]
+        self.index = (self.index + 1) % len(packets)
+        return packet
+
+    def write(self, data):
+        return len(data)
+
+
+def capture_packets(fn):
+    '''Run ``fn`` against a simulated amplifier and return the packets the
+    amplifier sends in response, in the form PyUSB would return them.
+
+    '''
+    sim = SimulatedAmp()
+    fn(sim)
+    packets = []
+    while sim.pending():
+        packets.append(sim.next_packet(0))
+    return packets
+
+
+def control_stream():
+    '''Packets resulting from sweeping each front panel knob, mixed with
+    tuner data and preset changes.
+
+    '''
+    def sweep(sim):
+        for value in range(0, 128, 4):
+            for control in ('gain', 'volume', 'bass', 'middle', 'treble',
+                            'isf', 'mod_level', 'reverb_level'):
+                sim.turn_knob(control, value)
+        for value in range(0, 32, 2):
+            for control in ('mod_segval', 'delay_feedback', 'reverb_size'):
+                sim.turn_knob(control, value)
+        for note in range(12):
+            sim.tuner_reading(note, note - 6)
+        for preset in range(1, 9):
+            sim.select_preset_on_amp(preset)
+        sim.handle([0x81, 0x00, 0x00, 0x04, 0x03, 0x06, 0x02, 0x7a])
+    return capture_packets(sweep)
+
+
+def delay_stream():
+    '''Packets resulting from adjusting the delay time both with the tap
+    button and with the level knob while holding the tap button, the
+    latter producing fine/coarse packet pairs.
+
+    '''
+    def sweep(sim):
+        for value in range(100, 2001, 50):
+            sim.turn_knob('delay_time', value)
+            sim.turn_knob('delay_time', value, tap=True)
+            sim.turn_knob('delay_level', value % 128)
+    return capture_packets(sweep)
+
+
+def preset_stream():
+    '''Preset name and settings packets for all 128 presets.'''
+    def fetch(sim):
+        for preset in range(1, 129):
+            sim.handle([0x02, 0x04, preset, 0x00])
+            sim.handle([0x02, 0x05, preset, 0x00])
+    return capture_packets(fetch)
+
+
+INSIDER_PRESET = '''<?xml version="1.0" encoding="UTF-8"?>
+<Preset>
+  <Amplifier>
+    <Voice>3</Voice>
+    <Gain>96</Gain>
+    <Volume>40</Volume>
+    <Bass>70</Bass>
+    <Middle>50</Middle>
+    <Treble>80</Treble>
+    <ISF>30</ISF>
+    <TVP Status="1">2</TVP>
+  </Amplifier>
+  <EffectsChain Focused="2">
+    <Modulation Status="0" Position="1">
+      <Types/>
+      <Level>64</Level>
+      <Rate>20</Rate>
+      <Adjust1>5</Adjust1>
+      <Adjust2>64</Adjust2>
+    </Modulation>
+    <Delay Status="1" Position="2">
+      <Types/>
+      <Level>50</Level>
+      <Tempo>450</Tempo>
+      <Adjust1>12</Adjust1>
+      <Adjust2>127</Adjust2>
+    </Delay>
+    <Reverb Status="1" Position="0">
+      <Types/>
+      <Level>30</Level>
+      <Adjust1>10</Adjust1>
+      <Adjust2>0</Adjust2>
+    </Reverb>
+  </EffectsChain>
+  <Info>
+    <Name>Benchmark Lead</Name>
+    <Creator>outsider</Creator>
+    <Genre>3</Genre>
+    <SubGenre>1</SubGenre>
+    <SearchTags>lead solo</SearchTags>
+    <About>Synthetic preset used by the benchmark suite</About>
+  </Info>
+  <Tuner>0</Tuner>
+  <Bench>0</Bench>
+  <Audio>
+    <Metronome Type="0">120</Metronome>
+    <Track Repeat="0"></Track>
+  </Audio>
+</Preset>
+'''
+
+
+def connected_amp(packets):
+    amp = BlackstarIDAmp(transport=LoopTransport(packets))
+    amp.connect()
+    return amp
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def measure(fn, iterations, warmup):
+    '''Call ``fn`` ``warmup`` times untimed, then ``iterations`` times
+    timing each call. Returns a dictionary of statistics, with
+    latencies in microseconds.
+
+    '''
+    for i in range(warmup):
+        fn()
+
+    timer = time.perf_counter
+    durations = [0.0] * iterations
+    for i in range(iterations):
+        start = timer()
+        fn()
+        durations[i] = timer() - start
+
+    total = sum(durations)
+    durations.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total > 0 else float('inf'),
+        'p50_us': percentile(durations, 0.50) * 1e6,
+        'p99_us': percentile(durations, 0.99) * 1e6,
+        'max_us': durations[-1] * 1e6,
+    }
+
+
+def preset_file(tmpdir):
+    # The preset file used by several benchmarks, written once
+    path = os.path.join(tmpdir, 'benchmark.bsp')
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            f.write(INSIDER_PRESET)
+    return path
+
+
+def cycle(fn, *args):
+    # Return a function calling fn(i, *args) with i counting up from 0
+    # on each call
+    counter = {'index': 0}
+
+    def call():
+        i = counter['index']
+        fn(i, *args)
+        counter['index'] = i + 1
+    return call
+
+
+def read_data_packet(packets, trace=False):
+    def setup(tmpdir):
+        amp = connected_amp(packets())
+        if trace:
+            amp.enable_trace()
+        return amp.read_data_packet
+    return setup
+
+
+def setup_read_data_delay_time(tmpdir):
+    return connected_amp(delay_stream()).read_data
+
+
+def setup_from_packet(tmpdir):
+    settings_packets = [p for p in preset_stream() if p[1] == 0x05]
+
+    def from_packet(i):
+        BlackstarIDAmpPreset.from_packet(
+            settings_packets[i % len(settings_packets)])
+    return cycle(from_packet)
+
+
+def setup_from_file(tmpdir):
+    path = preset_file(tmpdir)
+    return lambda: BlackstarIDAmpPreset.from_file(path)
+
+
+def setup_library_search(tmpdir):
+    # A library of presets differing in name and gain
+    library_dir = os.path.join(tmpdir, 'library')
+    os.mkdir(library_dir)
+    for i in range(1000):
+        with open(os.path.join(library_dir, '{0}.rig'.format(i)), 'w') as f:
+            f.write(INSIDER_PRESET
+                    .replace('Benchmark Lead', 'Preset {0}'.format(i))
+                    .replace('<Gain>96', '<Gain>{0}'.format(i % 128)))
+    library = PresetLibrary(':memory:')
+    library.import_tree(library_dir, workers=1)
+    return lambda: library.search('preset 9', gain=('>', 64))
+
+
+def setup_set_control(tmpdir):
+    amp = connected_amp([])
+
+    def set_control(i):
+        amp.set_control('gain', i % 128)
+        amp.set_control('delay_time', 100 + (i % 1900))
+    return cycle(set_control)
+
+
+def round_trip(latency=False):
+    def setup(tmpdir):
+        amp = BlackstarIDAmp(transport=SimulatedTransport())
+        amp.connect()
+        if latency:
+            # Every write and echo timed by a LatencyMonitor
+            amp.enable_latency()
+
+        def control_round_trip(i):
+            amp.set_control('volume', i % 128)
+            amp.read_data(0.1)
+        return cycle(control_round_trip)
+    return setup
+
+
+def setup_apply_settings(tmpdir):
+    # Alternately applying two presets which differ in a few controls
+    amp = connected_amp([])
+    path = preset_file(tmpdir)
+    presets = [BlackstarIDAmpPreset.from_file(path),
+               BlackstarIDAmpPreset.from_file(path)]
+    presets[1].gain = 10
+    presets[1].delay_time = 1500
+    return cycle(lambda i: amp.apply_settings(presets[i % 2]))
+
+
+def setup_midi_parse_map(tmpdir):
+    # A pedal sweep as sent by a MIDI foot controller, using running
+    # status, parsed and mapped to control values
+    parser = MidiParser()
+    midi_map = MidiMap()
+    parser.feed(bytes([0xb0, 4, 0]))
+
+    def midi_parse_map(i):
+        for status, number, value in parser.feed(bytes([4, i % 128])):
+            midi_map.control_change(number, value)
+    return cycle(midi_parse_map)
+
+
+def setup_fetch_preset_names(tmpdir):
+    # Time to ready for all 128 preset names, with an AmpReader
+    # picking up the replies as the GUI does
+    amp = BlackstarIDAmp(transport=SimulatedTransport())
+    amp.connect()
+    reader = AmpReader(amp, lambda data: None, 0.1)
+    reader.start()
+
+    def fetch_preset_names():
+        fetch = amp.fetch_preset_names()
+        if not fetch.wait(10) or fetch.failed:
+            raise RuntimeError('Preset name fetch failed')
+    return fetch_preset_names
+
+
+def setup_switch_preset(tmpdir):
+    # A synchronised preset switch across four simulated amps
+    manager = AmpManager()
+    for i in range(4):
+        manager.add('sim{0}'.format(i), SimulatedTransport())
+    manager.connect()
+    group = manager.group()
+    return cycle(lambda i: group.switch_preset(1 + i % 128))
+
+
+def read_data_capture(capture):
+    def setup(tmpdir):
+        amp = BlackstarIDAmp(
+            transport=ReplayTransport(capture, speed=None, loop=True))
+        amp.connect()
+        amp.startup()
+        return amp.read_data
+    return setup
+
+
+def benchmarks(capture=None):
+    '''Return a list of (name, setup) or (name, setup, max_iterations)
+    tuples, one for each benchmark. setup(tmpdir) builds what the
+    benchmark needs, in the temporary directory ``tmpdir`` if it needs
+    files, and returns the function to time; it is only called for
+    the benchmarks which are run. max_iterations caps the iterations
+    of slow benchmarks. If ``capture`` is the path of a capture file,
+    a benchmark decoding it is included.
+
+    '''
+    result = [
+        ('read_data_packet.controls', read_data_packet(control_stream)),
+        ('read_data_packet.traced',
+         read_data_packet(control_stream, trace=True)),
+        ('read_data_packet.presets', read_data_packet(preset_stream)),
+        ('read_data.delay_time', setup_read_data_delay_time),
+        ('preset.from_packet', setup_from_packet),
+        ('preset.from_file', setup_from_file),
+        ('library.search', setup_library_search, 2000),
+        ('set_control.encode', setup_set_control),
+        ('set_control.round_trip', round_trip()),
+        ('set_control.round_trip.monitored', round_trip(latency=True)),
+        ('apply_settings.diff', setup_apply_settings),
+        ('midi.parse_map', setup_midi_parse_map),
+        ('preset_names.fetch', setup_fetch_preset_names, 200),
+        ('group.switch_preset', setup_switch_preset, 2000),
+    ]
+
+    if capture is not None:
+        result.append(('read_data.capture', read_data_capture(capture)))
+
+    return result
+
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        out = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=here,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def run(args):
+    results = {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for benchmark in benchmarks(args.capture):
+            name, setup = benchmark[0:2]
+            if args.filter and args.filter not in name:
+                continue
+            fn = setup(tmpdir)
+            iterations = args.iterations
+            warmup = args.warmup
+            if len(benchmark) > 2:
+                iterations = min(iterations, benchmark[2])
+                warmup = min(warmup, benchmark[2] // 10)
+            stats = measure(fn, iterations, warmup)
+            results['benchmarks'][name] = stats
+            print('{0:28s} {1:12.0f} ops/s  p50 {2:8.2f} us  p99 {3:8.2f} us'.format(
+                name, stats['ops_per_sec'], stats['p50_us'], stats['p99_us']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    print('{0:28s} {1:>12s} {2:>12s} {3:>8s} {4:>10s} {5:>10s}'.format(
+        'benchmark', 'old ops/s', 'new ops/s', 'speedup', 'old p99', 'new p99'))
+    for name in sorted(set(old['benchmarks']) | set(new['benchmarks'])):
+        o = old['benchmarks'].get(name)
+        n = new['benchmarks'].get(name)
+        if o is None or n is None:
+            print('{0:28s} only in {1}'.format(
+                name, new_file if o is None else old_file))
+            continue
+        print('{0:28s} {1:12.0f} {2:12.0f} {3:7.2f}x {4:10.2f} {5:10.2f}'.format(
+            name, o['ops_per_sec'], n['ops_per_sec'],
+            n['ops_per_sec'] / o['ops_per_sec'], o['p99_us'], n['p99_us']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=20000,
+                        help='number of timed calls per benchmark')
+    parser.add_argument('-w', '--warmup', type=int, default=1000,
+                        help='number of untimed calls per benchmark')
+    parser.add_argument('-o', '--output',
+                        help='write results as JSON to this file')
+    parser.add_argument('-k', '--filter',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='also benchmark decoding this capture file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,3 +16,4 @@
 # Copyright 2015, Jonathan Underwood. All rights reserved.
 
 from blackstarid.blackstarid import BlackstarIDAmp, NoDataAvailable, NotConnectedError
+from blackstarid.blackstarid import AmpTransport, USBTransport
@@ -0,0 +1,206 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''An asyncio interface to the amplifier. For example:
+
+    async with AsyncBlackstarIDAmp() as amp:
+        await amp.set_control('gain', 64)
+        name = await amp.get_preset_name(1)
+        async for event in amp.events():
+            print(event)
+
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+
+from blackstarid.blackstarid import BlackstarIDAmp, NotConnectedError
+from blackstarid.reader import AmpReader
+
+logger = logging.getLogger('outsider.blackstarid.asyncamp')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class AsyncBlackstarIDAmp(object):
+
+    '''Wraps a BlackstarIDAmp for use from an asyncio event loop. Blocking
+    writes are made from a single worker thread, which keeps them in
+    the order they were awaited, and data from the amp is read by an
+    AmpReader thread and handed to the event loop.
+
+    ``amp`` is the BlackstarIDAmp to use, and a new one using USB is
+    created if not specified. ``read_timeout`` is passed to the
+    AmpReader.
+
+    '''
+
+    def __init__(self, amp=None, loop=None, read_timeout=0.1):
+        if amp is None:
+            amp = BlackstarIDAmp()
+        self.amp = amp
+        self.read_timeout = read_timeout
+        self._loop = loop
+        self._executor = None
+        self._reader = None
+        self._subscribers = set()
+        self._name_waiters = {}
+
+    @property
+    def connected(self):
+        return self.amp.connected
+
+    @property
+    def model(self):
+        return self.amp.model
+
+    @property
+    def state(self):
+        return self.amp.state
+
+    def _run(self, fn, *args):
+        if self._executor is None:
+            raise NotConnectedError
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        '''Connect to the amplifier, discard any pending data and start
+        reading data from it.
+
+        '''
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        try:
+            await self._run(self.amp.connect)
+            await self._run(self.amp.drain)
+        except Exception:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise
+
+        self._reader = AmpReader(self.amp, self._data_from_reader,
+                                 self.read_timeout, name='AsyncAmpReader')
+        self._reader.start()
+
+    async def disconnect(self):
+        '''Stop reading from and disconnect from the amplifier. Any
+        iterators returned by events finish.
+
+        '''
+        if self._executor is None:
+            return
+
+        if self._reader is not None:
+            await self._loop.run_in_executor(None, self._reader.stop)
+            self._reader = None
+
+        await self._run(self.amp.disconnect)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+        for queue in list(self._subscribers):
+            queue.put_nowait(None)
+        for waiters in self._name_waiters.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(NotConnectedError())
+        self._name_waiters.clear()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def startup(self):
+        '''Send the startup packet. The amp's response arrives as events.'''
+        await self._run(self.amp.startup)
+
+    async def set_control(self, control, value):
+        await self._run(self.amp.set_control, control, value)
+
+    async def select_preset(self, preset):
+        await self._run(self.amp.select_preset, preset)
+
+    async def apply_settings(self, preset, force=False):
+        return await self._run(self.amp.apply_settings, preset, force)
+
+    async def send_packet(self, packet):
+        return await self._run(self.amp.send_packet, packet)
+
+    async def get_preset_name(self, preset, timeout=1.0):
+        '''Return the name of ``preset``. Raises asyncio.TimeoutError if the
+        amp doesn't respond within ``timeout`` seconds.
+
+        '''
+        future = self._loop.create_future()
+        waiters = self._name_waiters.setdefault(preset, [])
+        waiters.append(future)
+        try:
+            await self._run(self.amp.get_preset_name, preset)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._name_waiters.pop(preset, None)
+
+    async def set_preset_name(self, preset, name):
+        '''Rename ``preset`` and wait for the amp to confirm the change.'''
+        await self._run(self.amp.set_preset_name, preset, name, True)
+
+    async def events(self):
+        '''Asynchronous iterator over the dictionaries of data sent by the
+        amp, as returned by BlackstarIDAmp.read_data. Each iterator
+        receives every event that arrives after it is created.
+
+        '''
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._subscribers.discard(queue)
+
+    def _data_from_reader(self, data):
+        # Called in the reader thread
+        self._loop.call_soon_threadsafe(self._dispatch, data)
+
+    def _dispatch(self, data):
+        if 'preset_name' in data:
+            preset, name = data['preset_name']
+            for future in self._name_waiters.get(preset, ()):
+                if not future.done():
+                    future.set_result(name)
+
+        for queue in self._subscribers:
+            queue.put_nowait(data)
@@ -0,0 +1,253 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Storage for the settings of all the presets on an amplifier.'''
+
+import array
+import operator
+
+from blackstarid.blackstarid import BlackstarIDAmpPreset
+
+# NumPy is optional. Without it, columns are returned as arrays from
+# the array module and masks as lists. It is imported by _import_numpy
+# when a bank is first queried, as importing it takes longer than
+# starting the GUI does.
+numpy = None
+_numpy_tried = False
+
+
+def _import_numpy():
+    global numpy, _numpy_tried
+    if not _numpy_tried:
+        _numpy_tried = True
+        try:
+            import numpy
+        except ImportError:
+            pass
+    return numpy
+
+
+_operators = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+
+
+class PresetBank(object):
+
+    '''The settings of all 128 presets of an amplifier, stored as the raw
+    preset settings packets in one contiguous buffer of 128 rows of 64
+    bytes. When NumPy is available the buffer is also viewed as a
+    structured array, array, with one field per entry in
+    BlackstarIDAmpPreset.packet_layout, so that columns can be
+    accessed, masked and compared without Python loops. The array is
+    created, and NumPy imported, when first used.
+
+    Presets are numbered from 1, as on the amp.
+
+    '''
+
+    size = 128
+    record_size = 64
+
+    layout = BlackstarIDAmpPreset.packet_layout
+    fields = BlackstarIDAmpPreset.packet_fields
+
+    # The NumPy dtype of a row, created with the first array
+    dtype = None
+
+    def __init__(self):
+        self._buf = bytearray(self.size * self.record_size)
+        self._view = memoryview(self._buf)
+        self.loaded = bytearray(self.size)
+        self._array = None
+
+    @property
+    def array(self):
+        '''The buffer viewed as a NumPy structured array, or None if NumPy
+        isn't available.
+
+        '''
+        if self._array is None and _import_numpy() is not None:
+            cls = type(self)
+            if cls.dtype is None:
+                layout = self.layout
+                cls.dtype = numpy.dtype({
+                    'names': [name for name, offset, fmt in layout],
+                    'formats': ['u1' if fmt == 'B' else '<u2'
+                                for name, offset, fmt in layout],
+                    'offsets': [offset for name, offset, fmt in layout],
+                    'itemsize': self.record_size,
+                })
+            self._array = numpy.frombuffer(self._buf, dtype=cls.dtype)
+        return self._array
+
+    def _row(self, preset):
+        if preset not in range(1, self.size + 1):
+            raise ValueError('Preset number {0} out of range'.format(preset))
+        start = (preset - 1) * self.record_size
+        return start, start + self.record_size
+
+    def update(self, packet):
+        '''Store the settings from a 0x02/0x05 preset settings packet, or
+        from a BlackstarIDAmpPreset. Returns the preset number.
+
+        '''
+        if isinstance(packet, BlackstarIDAmpPreset):
+            packet = packet.packet
+        elif packet[0] != 0x02 or packet[1] != 0x05 or packet[3] != 0x2a:
+            raise ValueError('Packet is not a preset settings packet')
+
+        preset = packet[2]
+        start, end = self._row(preset)
+        self._buf[start:end] = bytes(packet[0:self.record_size])
+        self.loaded[preset - 1] = 1
+        return preset
+
+    def clear(self):
+        '''Forget the settings of all presets.'''
+        self._buf[:] = bytes(len(self._buf))
+        self.loaded[:] = bytes(self.size)
+
+    def __contains__(self, preset):
+        return preset in range(1, self.size + 1) and self.loaded[preset - 1] == 1
+
+    def __len__(self):
+        return self.loaded.count(1)
+
+    def __iter__(self):
+        '''Iterate over the numbers of the presets whose settings are
+        stored.
+
+        '''
+        for i, loaded in enumerate(self.loaded):
+            if loaded:
+                yield i + 1
+
+    def __getitem__(self, preset):
+        '''Return a BlackstarIDAmpPreset viewing the stored settings of
+        ``preset``, without copying. Raises KeyError if no settings are
+        stored for the preset.
+
+        '''
+        if preset not in self:
+            raise KeyError(preset)
+        start, end = self._row(preset)
+        return BlackstarIDAmpPreset(self._view[start:end])
+
+    def column(self, field):
+        '''Return the values of ``field`` for all presets, as a NumPy array
+        view if NumPy is available, otherwise as an array.array. Entry
+        i is the value for preset i + 1, and is 0 if the preset hasn't
+        been loaded.
+
+        '''
+        if self.array is not None:
+            return self.array[field]
+
+        offset, fmt = self._field_format(field)
+        if fmt == 'B':
+            return array.array('B', self._buf[offset::self.record_size])
+
+        lo = self._buf[offset::self.record_size]
+        hi = self._buf[offset + 1::self.record_size]
+        return array.array('H', [l + 256 * h for l, h in zip(lo, hi)])
+
+    def _field_format(self, field):
+        for name, offset, fmt in self.layout:
+            if name == field:
+                return offset, fmt
+        raise KeyError('Unknown preset field {0}'.format(field))
+
+    def mask(self, field, op, value):
+        '''Return a boolean mask over all presets which is true where the
+        preset is loaded and ``field`` compares to ``value`` according
+        to ``op``, which is one of '<', '<=', '==', '!=', '>=' or '>'.
+        For example bank.mask('gain', '>', 100).
+
+        '''
+        try:
+            fn = _operators[op]
+        except KeyError:
+            raise ValueError('Unknown comparison operator {0}'.format(op))
+
+        col = self.column(field)
+        if self.array is not None:
+            loaded = numpy.frombuffer(self.loaded, dtype=numpy.uint8) == 1
+            return fn(col, value) & loaded
+
+        return [bool(l) and fn(v, value) for v, l in zip(col, self.loaded)]
+
+    def where(self, field, op, value):
+        '''Return a list of the numbers of the presets selected by mask.'''
+        m = self.mask(field, op, value)
+        if self.array is not None:
+            return (numpy.flatnonzero(m) + 1).tolist()
+        return [i + 1 for i, selected in enumerate(m) if selected]
+
+    def _changed_rows(self, other):
+        if self.array is not None:
+            changed = self.array != other.array
+            changed |= (numpy.frombuffer(self.loaded, dtype=numpy.uint8) !=
+                        numpy.frombuffer(other.loaded, dtype=numpy.uint8))
+            return (numpy.flatnonzero(changed) + 1).tolist()
+
+        rs = self.record_size
+        return [i + 1 for i in range(self.size)
+                if self.loaded[i] != other.loaded[i] or
+                self._view[i * rs:(i + 1) * rs] != other._view[i * rs:(i + 1) * rs]]
+
+    def diff(self, other):
+        '''Compare with another PresetBank. Returns a dictionary mapping
+        the number of each preset which differs to a list of the fields
+        which differ. A preset which is loaded in only one of the banks
+        maps to None.
+
+        '''
+        result = {}
+        for preset in self._changed_rows(other):
+            if (preset in self) != (preset in other):
+                result[preset] = None
+                continue
+            a = self[preset]
+            b = other[preset]
+            fields = [name for name in self.fields
+                      if getattr(a, name) != getattr(b, name)]
+            if fields:
+                result[preset] = fields
+        return result
+
+    def tobytes(self):
+        '''Return the contents of the bank as bytes, suitable for passing
+        to frombytes.
+
+        '''
+        return bytes(self.loaded) + bytes(self._buf)
+
+    @classmethod
+    def frombytes(cls, data):
+        '''Create a bank from data returned by tobytes.'''
+        bank = cls()
+        if len(data) != len(bank.loaded) + len(bank._buf):
+            raise ValueError('Data is not a preset bank')
+        bank.loaded[:] = data[0:cls.size]
+        bank._buf[:] = data[cls.size:]
+        return bank
@@ -15,11 +15,17 @@
 #
 # Copyright 2015, Jonathan Underwood. All rights reserved.
 
-import usb.core
-import usb.util
 import logging
+import collections
+import contextlib
+import errno
+import struct
+import threading
+import time
 import xml.etree.ElementTree as et
 
+from blackstarid.state import AmpState
+
 # Set up logging and create a null handler in case the application doesn't
 # provide a log handler
 logger = logging.getLogger('outsider.blackstarid')
@@ -34,6 +40,19 @@ __null_handler = __NullHandler()
 logger.addHandler(__null_handler)
 
 
+# PyUSB is imported by _import_usb when a USBTransport first needs it,
+# so that programs which never use USB, or haven't yet, don't pay for
+# importing it
+usb = None
+
+
+def _import_usb():
+    global usb
+    if usb is None:
+        import usb.core
+        import usb.util
+
+
 class NotConnectedError(Exception):
 
     '''Raised when an operation requiring an amp is called when no amp is
@@ -60,123 +79,126 @@ class NoDataAvailable(Exception):
     pass
 
 
-class BlackstarIDAmpPreset(object):
+# Directions of packets passed to amp taps - see
+# BlackstarIDAmp.add_tap
+PACKET_SENT = 0
+PACKET_RECEIVED = 1
 
-    def __init__(self):
-        pass
 
-    def __str__(self):
-        attribs = vars(self)
-        # s = ''
-        # for key, val in attribs.items():
-        #     s += '{0}: {1}\n'.format(key, val)
-        # return s[0:-1]
-        return attribs.__str__()
+def format_packet(packet):
+    '''Format a data packet for printing with 16 columns for easy
+    comparison with tools such as wireshark.'''
 
-    @classmethod
-    def from_file(cls, filename):
-        ps = cls()
+    # Turn the entries into hex strings
+    strings = ['{0:02X}'.format(i) for i in packet]
 
-        tree = et.parse(filename)
+    # Now break up into lines, each with 16 entries
+    lines = []
+    for start in range(0, len(strings), 16):
+        lines.append(' '.join(strings[start:start + 16]))
 
-        root = tree.getroot()
+    return '\n'.join(lines)
 
-        amp = root.find('Amplifier')
-        ps.voice = int(amp.find('Voice').text)
-        ps.gain = int(amp.find('Gain').text)
-        ps.volume = int(amp.find('Volume').text)
-        ps.bass = int(amp.find('Bass').text)
-        ps.middle = int(amp.find('Middle').text)
-        ps.treble = int(amp.find('Treble').text)
-        ps.isf = int(amp.find('ISF').text)
-        ps.tvp_switch = int(amp.find('TVP').attrib['Status'])
-        ps.tvp_valve = int(amp.find('TVP').text)
 
-        fx = root.find('EffectsChain')
-        ps.effect_focus = int(fx.attrib['Focused'])
+class _ByteField(object):
 
-        # Modulation. There is a child here "Types" which we won't use
-        # - the significance of this child is unclear.
-        mod = fx.find('Modulation')
-        ps.mod_switch = int(mod.attrib['Status'])
-        ps.mod_type = int(mod.attrib['Position'])
-        ps.mod_level = int(mod.find('Level').text)
-        ps.mod_speed = int(mod.find('Rate').text)
-        ps.mod_segval = int(mod.find('Adjust1').text)
-        ps.mod_manual = int(mod.find('Adjust2').text) # Only used by Flanger
+    '''Descriptor for a single byte field of a preset, read from and
+    written to the preset's packet buffer.
 
-        # Delay. There is a child here "Types" which we won't use -
-        # the significance of this child is unclear.  Note that in the
-        # file Adjust2 is set to 127 and is not used for anything.
-        delay = fx.find('Delay')
-        ps.delay_switch = int(delay.attrib['Status'])
-        ps.delay_type = int(delay.attrib['Position'])
-        ps.delay_level = int(delay.find('Level').text)
-        ps.delay_time = int(delay.find('Tempo').text)
-        ps.delay_feedback = int(delay.find('Adjust1').text)
+    '''
 
-        # Reverb. There is a child here "Types" which we won't use -
-        # the significance of this child is unclear. Note that in the
-        # file Adjust2 is set to 0 and is not used for anything.
-        reverb = fx.find('Reverb')
-        ps.reverb_switch = int(reverb.attrib['Status'])
-        ps.reverb_type = int(reverb.attrib['Position'])
-        ps.reverb_level = int(reverb.find('Level').text)
-        ps.reverb_size = int(reverb.find('Adjust1').text)
+    __slots__ = ('offset',)
 
-        # Metadata
-        info = root.find('Info')
-        ps.name = info.find('Name').text
-        ps.creator = info.find('Creator').text
-        ps.genre = int(info.find('Genre').text)
-        ps.subgenre = int(info.find('SubGenre').text)
-        ps.search_tags = info.find('SearchTags').text
-        ps.about = info.find('About').text
+    def __init__(self, offset):
+        self.offset = offset
 
-        # Tuner - not sure what this section is for, as you can't save
-        # a preset with the tuner on in Insider. But perhaps if this
-        # was set to 1, then switching to this preset would engage the
-        # tuner. Anyway, we'll parse it for compatibility sake.
-        ps.tuner_switch = int(root.find('Tuner').text)
+    def __get__(self, ps, cls=None):
+        if ps is None:
+            return self
+        return ps._buf[self.offset]
 
-        # Bench - not sure what this is.
-        ps.bench_switch = int(root.find('Bench').text)
+    def __set__(self, ps, value):
+        ps._buf[self.offset] = value
 
-        # Audio player stuff
-        audio = root.find('Audio')
 
-        metronome = audio.find('Metronome')
-        ps.metronome_switch = int(metronome.attrib['Type'])
-        ps.metronome_bpm = int(metronome.text)
+class _StructField(object):
 
-        track = audio.find('Track')
-        ps.track_repeat = int(track.attrib['Repeat'])
-        ps.track = track.text
-    
-    @classmethod
-    def from_packet(cls, packet):
-        # Check that the packet passed is actually a packet containing
-        # preset settings.
-        if packet[0] != 0x02 or packet[1] != 0x05 or packet[3] != 0x2A:
-            raise ValueError('Packet is not a preset settings packet')
+    '''Descriptor for a multi-byte field of a preset, unpacked from the
+    preset's packet buffer using a struct format.
 
-        ps = cls()
+    '''
+
+    __slots__ = ('offset', 'struct')
+
+    def __init__(self, offset, fmt):
+        self.offset = offset
+        self.struct = struct.Struct(fmt)
+
+    def __get__(self, ps, cls=None):
+        if ps is None:
+            return self
+        return self.struct.unpack_from(ps._buf, self.offset)[0]
+
+    def __set__(self, ps, value):
+        self.struct.pack_into(ps._buf, self.offset, value)
+
+
+class _MetadataField(object):
+
+    '''Descriptor for a preset field which isn't part of the settings
+    packet. Metadata is rarely present, so it is only allocated when
+    first set.
+
+    '''
+
+    __slots__ = ('name',)
 
-        ps.preset_number = packet[2]
-
-        ps.voice = packet[4]  # 00-05
-        ps.gain = packet[5]  # 00-7F
-        ps.volume = packet[6]  # 00-7F
-        ps.bass = packet[7]  # 00-7F
-        ps.middle = packet[8]  # 00-7F
-        ps.treble = packet[9]  # 00-7F
-        ps.isf = packet[10]  # 00-7F
-        ps.tvp_switch = packet[17]  # 00 or 01
-        ps.tvp_valve = packet[11]  # 00-05
-
-        ps.reverb_switch = packet[20]  # 00 or 01
-        ps.reverb_type = packet[32]  # 00-03
-        ps.reverb_size = packet[33]  # 00-1F, segval
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, ps, cls=None):
+        if ps is None:
+            return self
+        if ps._metadata is None:
+            return None
+        return ps._metadata.get(self.name)
+
+    def __set__(self, ps, value):
+        if ps._metadata is None:
+            ps._metadata = {}
+        ps._metadata[self.name] = value
+
+
+class BlackstarIDAmpPreset(object):
+
+    '''The settings of a preset. Settings are held in a 64 byte buffer
+    with the layout of the preset settings packet sent by the amp, and
+    are only decoded when read. A preset created from a packet is a
+    view on that packet, so the packet should not be modified
+    afterwards.
+
+    Presets read from Insider files also carry metadata which is not
+    stored on the amp - see metadata_fields.
+
+    '''
+
+    # Layout of the preset settings packet: each entry is the field
+    # name, the byte offset and the struct format of the field.
+    packet_layout = (
+        ('preset_number', 2, 'B'),
+        ('voice', 4, 'B'),  # 00-05
+        ('gain', 5, 'B'),  # 00-7F
+        ('volume', 6, 'B'),  # 00-7F
+        ('bass', 7, 'B'),  # 00-7F
+        ('middle', 8, 'B'),  # 00-7F
+        ('treble', 9, 'B'),  # 00-7F
+        ('isf', 10, 'B'),  # 00-7F
+        ('tvp_switch', 17, 'B'),  # 00 or 01
+        ('tvp_valve', 11, 'B'),  # 00-05
+
+        ('reverb_switch', 20, 'B'),  # 00 or 01
+        ('reverb_type', 32, 'B'),  # 00-03
+        ('reverb_size', 33, 'B'),  # 00-1F, segval
         # There is a point of confusion here. Adjusting reverb level
         # alters packet[35], but also packet[12]. However, adjusting
         # modulation level changes only packet[12]. So we assume that
@@ -184,12 +206,12 @@ class BlackstarIDAmpPreset(object):
         # and that a firmware bug is changing packet[12] when reverb
         # level is changed. Will be interesting to see if this changes
         # with a later firmware.
-        ps.reverb_level = packet[35]  # 00-7F
+        ('reverb_level', 35, 'B'),  # 00-7F
 
-        ps.delay_switch = packet[19]  # 00 or 01
-        ps.delay_type = packet[26]  # 00-03
-        ps.delay_feedback = packet[27]  # 00-1F, segval
-        ps.delay_level = packet[29]  # 00-7F
+        ('delay_switch', 19, 'B'),  # 00 or 01
+        ('delay_type', 26, 'B'),  # 00-03
+        ('delay_feedback', 27, 'B'),  # 00-1F, segval
+        ('delay_level', 29, 'B'),  # 00-7F
         # The delay time setting is specifed with two bytes,
         # packet[30] and packet[31]. With the delay set to the minimum
         # value, packet[30,31]=[0x64, 0x00], and with the delay time
@@ -200,37 +222,579 @@ class BlackstarIDAmpPreset(object):
         # ms, and the maximum delay is 2s. So, [0x64, 0x00] = 100ms
         # makes sense. So, the actual delay in ms is:
         # delay = (packet[31] * 256 + packet[30])
-        # delay_time_1 = packet[30]  # 00-FF
-        # ps.delay_time_2 = packet[31]  # 00-07
-        ps.delay_time = 256 * packet[31] + packet[30]
+        # i.e. a little endian unsigned short.
+        ('delay_time', 30, '<H'),
 
-        ps.mod_switch = packet[18]  # 00 or 01
-        ps.mod_type = packet[21]  # 00-03
-        ps.mod_segval = packet[22]  # 00-1F
-        ps.mod_level = packet[12]  # 00-7F
-        ps.mod_speed = packet[25]  # 00-7F
+        ('mod_switch', 18, 'B'),  # 00 or 01
+        ('mod_type', 21, 'B'),  # 00-03
+        ('mod_segval', 22, 'B'),  # 00-1F
+        ('mod_level', 12, 'B'),  # 00-7F
+        ('mod_speed', 25, 'B'),  # 00-7F
 
         # The 'manual' control is exposed via Insider, but doesn't
         # seem to be available from an amp front panel setting, and
         # applies only to the Flanger modulation type.
-        ps.mod_manual = packet[23]  # 00-7F - used only for Flanger
+        ('mod_manual', 23, 'B'),  # 00-7F - used only for Flanger
 
         # This next setting is weird, it seems to reflect the absolute
         # position of the segmented selection knowb when selection
         # modulation type and segment value. It takes values between
         # 00-1F in the "1" segment, 20-3F in the "2" segment, 30-4F
         # when in the "3" segment and 40-5F when in the "4" segment.
-        ps.mod_abspos = packet[13]
+        ('mod_abspos', 13, 'B'),
 
         # This denotes which efect has "focus" (to use the term in the
         # blackstar manual) i.e. is being controlled by the level,
         # type and tap controls. This is the effect which has the
         # green LED lit on the front panel. 01 is Mod, 02 is delay, 03
         # is reverb.
-        ps.effect_focus = packet[39]
+        ('effect_focus', 39, 'B'),
+    )
+
+    packet_fields = tuple(name for name, offset, fmt in packet_layout)
+
+    # Fields only present in presets read from Insider files
+    metadata_fields = (
+        'name', 'creator', 'genre', 'subgenre', 'search_tags', 'about',
+        'tuner_switch', 'bench_switch', 'metronome_switch',
+        'metronome_bpm', 'track_repeat', 'track',
+    )
+
+    __slots__ = ('_buf', '_metadata')
+
+    def __init__(self, buf=None):
+        '''``buf`` is a writable 64 byte buffer holding a preset settings
+        packet. If not specified, an empty preset is created.
+
+        '''
+        if buf is None:
+            buf = bytearray(64)
+            buf[0:4] = [0x02, 0x05, 0x00, 0x2a]
+        self._buf = buf
+        self._metadata = None
+
+    @property
+    def packet(self):
+        '''The buffer holding the preset settings packet.'''
+        return self._buf
+
+    def as_dict(self):
+        '''Return a dictionary of all the preset settings, and any
+        metadata that is set.
+
+        '''
+        d = dict((name, getattr(self, name)) for name in self.packet_fields)
+        if self._metadata is not None:
+            for name, value in self._metadata.items():
+                if value is not None:
+                    d[name] = value
+        return d
+
+    def __str__(self):
+        return self.as_dict().__str__()
+
+    # Where each field is found in an Insider preset file: the path of
+    # the element, the attribute holding the value or None for the
+    # element text, the field name and the type of the value.
+    insider_layout = (
+        ('Amplifier/Voice', None, 'voice', int),
+        ('Amplifier/Gain', None, 'gain', int),
+        ('Amplifier/Volume', None, 'volume', int),
+        ('Amplifier/Bass', None, 'bass', int),
+        ('Amplifier/Middle', None, 'middle', int),
+        ('Amplifier/Treble', None, 'treble', int),
+        ('Amplifier/ISF', None, 'isf', int),
+        ('Amplifier/TVP', 'Status', 'tvp_switch', int),
+        ('Amplifier/TVP', None, 'tvp_valve', int),
+
+        ('EffectsChain', 'Focused', 'effect_focus', int),
+
+        # Modulation. There is a child here "Types" which we won't use
+        # - the significance of this child is unclear.
+        ('EffectsChain/Modulation', 'Status', 'mod_switch', int),
+        ('EffectsChain/Modulation', 'Position', 'mod_type', int),
+        ('EffectsChain/Modulation/Level', None, 'mod_level', int),
+        ('EffectsChain/Modulation/Rate', None, 'mod_speed', int),
+        ('EffectsChain/Modulation/Adjust1', None, 'mod_segval', int),
+        # Only used by Flanger
+        ('EffectsChain/Modulation/Adjust2', None, 'mod_manual', int),
+
+        # Delay. There is a child here "Types" which we won't use -
+        # the significance of this child is unclear.  Note that in the
+        # file Adjust2 is set to 127 and is not used for anything.
+        ('EffectsChain/Delay', 'Status', 'delay_switch', int),
+        ('EffectsChain/Delay', 'Position', 'delay_type', int),
+        ('EffectsChain/Delay/Level', None, 'delay_level', int),
+        ('EffectsChain/Delay/Tempo', None, 'delay_time', int),
+        ('EffectsChain/Delay/Adjust1', None, 'delay_feedback', int),
+
+        # Reverb. There is a child here "Types" which we won't use -
+        # the significance of this child is unclear. Note that in the
+        # file Adjust2 is set to 0 and is not used for anything.
+        ('EffectsChain/Reverb', 'Status', 'reverb_switch', int),
+        ('EffectsChain/Reverb', 'Position', 'reverb_type', int),
+        ('EffectsChain/Reverb/Level', None, 'reverb_level', int),
+        ('EffectsChain/Reverb/Adjust1', None, 'reverb_size', int),
+
+        # Metadata
+        ('Info/Name', None, 'name', str),
+        ('Info/Creator', None, 'creator', str),
+        ('Info/Genre', None, 'genre', int),
+        ('Info/SubGenre', None, 'subgenre', int),
+        ('Info/SearchTags', None, 'search_tags', str),
+        ('Info/About', None, 'about', str),
+
+        # Tuner - not sure what this section is for, as you can't save
+        # a preset with the tuner on in Insider. But perhaps if this
+        # was set to 1, then switching to this preset would engage the
+        # tuner. Anyway, we'll parse it for compatibility sake.
+        ('Tuner', None, 'tuner_switch', int),
+
+        # Bench - not sure what this is.
+        ('Bench', None, 'bench_switch', int),
+
+        # Audio player stuff
+        ('Audio/Metronome', 'Type', 'metronome_switch', int),
+        ('Audio/Metronome', None, 'metronome_bpm', int),
+        ('Audio/Track', 'Repeat', 'track_repeat', int),
+        ('Audio/Track', None, 'track', str),
+    )
+
+    @classmethod
+    def from_file(cls, filename):
+        '''Read a preset from an Insider preset file. ``filename`` may also
+        be a file object. Raises ValueError if the file is not a valid
+        preset file.
+
+        '''
+        ps = cls()
+
+        try:
+            root = et.parse(filename).getroot()
+        except et.ParseError as e:
+            raise ValueError('Invalid preset file: {0}'.format(e))
+
+        # Index the elements by path in a single pass over the tree,
+        # rather than searching for each one
+        elements = {}
+        stack = [(root, '')]
+        while stack:
+            parent, prefix = stack.pop()
+            for el in parent:
+                path = prefix + el.tag
+                elements[path] = el
+                if len(el):
+                    stack.append((el, path + '/'))
+
+        for path, attr, field, conv in cls.insider_layout:
+            try:
+                el = elements[path]
+                value = el.text if attr is None else el.attrib[attr]
+            except KeyError:
+                raise ValueError('Invalid preset file: no {0} {1}'.format(
+                    path, 'text' if attr is None else attr))
+            if conv is str:
+                setattr(ps, field, value)
+            else:
+                try:
+                    setattr(ps, field, conv(value))
+                except (TypeError, ValueError, struct.error):
+                    # struct.error: out of range for the packet field
+                    raise ValueError(
+                        'Invalid preset file: bad value {0!r} for {1}'.format(
+                            value, field))
 
         return ps
 
+    @classmethod
+    def from_packet(cls, packet):
+        # Check that the packet passed is actually a packet containing
+        # preset settings.
+        if packet[0] != 0x02 or packet[1] != 0x05 or packet[3] != 0x2A:
+            raise ValueError('Packet is not a preset settings packet')
+
+        # PyUSB returns packets as an array, which we can view without
+        # copying. Anything else is copied into a buffer.
+        try:
+            buf = memoryview(packet)
+        except TypeError:
+            buf = bytearray(packet)
+
+        return cls(buf)
+
+
+for _name, _offset, _fmt in BlackstarIDAmpPreset.packet_layout:
+    if _fmt == 'B':
+        setattr(BlackstarIDAmpPreset, _name, _ByteField(_offset))
+    else:
+        setattr(BlackstarIDAmpPreset, _name, _StructField(_offset, _fmt))
+for _name in BlackstarIDAmpPreset.metadata_fields:
+    setattr(BlackstarIDAmpPreset, _name, _MetadataField(_name))
+del _name, _offset, _fmt
+
+
+class AmpTransport(object):
+
+    '''Base class for the objects which move packets between a
+    BlackstarIDAmp instance and an amplifier. Subclasses must implement
+    the open, close, read and write methods. This allows the protocol
+    handling in BlackstarIDAmp to be exercised against something other
+    than a physical amplifier, for example the simulator in
+    blackstarid.simulator.
+
+    After a successful call to open, the product_id attribute must
+    hold the USB product ID of the amplifier so that the model can be
+    identified. Transports may also record how long each phase of
+    opening took, in seconds, in the dictionary timings.
+
+    '''
+
+    # A string telling apart amps of the same model, which stays the
+    # same across reconnections, or None if the transport can't
+    location = None
+
+    def __init__(self):
+        self.product_id = None
+        self.timings = {}
+
+    def open(self, vendor):
+        '''Find the amplifier with the USB vendor ID ``vendor`` and prepare
+        it for reading and writing. Raises NotConnectedError if no
+        amplifier can be found.
+
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''Release all resources associated with the amplifier.'''
+        raise NotImplementedError
+
+    def read(self, timeout=None):
+        '''Read a single 64 byte packet from the amplifier. ``timeout`` is
+        in seconds, and None selects the transport default. Raises
+        NoDataAvailable if no packet arrives before the timeout
+        expires.
+
+        '''
+        raise NotImplementedError
+
+    def write(self, data):
+        '''Write a single packet to the amplifier, returning the number of
+        bytes written.
+
+        '''
+        raise NotImplementedError
+
+    def wakeup(self):
+        '''Cause a read blocked in another thread to return as soon as
+        possible, raising NoDataAvailable if no packet has arrived. This
+        is used to stop reader threads promptly. Transports which can't
+        interrupt a read may leave it to time out, which is the
+        default.
+
+        '''
+        pass
+
+
+class USBTransport(AmpTransport):
+
+    '''Transport for an amplifier attached over USB, using PyUSB. If
+    ``device`` is given, it is the PyUSB device of the amplifier to
+    use, as returned by find_devices. Otherwise the only amplifier
+    attached is used; see blackstarid.manager for using several amps.
+
+    The device is reset when opened, which takes a large part of the
+    time to connect. If ``fast_reconnect`` is True, the reset is
+    skipped when this process last closed the device cleanly and it
+    hasn't been unplugged since.
+
+    open records the time taken to find the device, to reset it and
+    to claim its interfaces in timings, under 'enumerate', 'reset'
+    and 'claim'.
+
+    '''
+
+    # Bus numbers and addresses of the devices closed cleanly by this
+    # process. A device gets a new address when it is plugged in
+    # again, so this also notices the amp having been power cycled.
+    _released = set()
+
+    def __init__(self, device=None, fast_reconnect=False):
+        super(USBTransport, self).__init__()
+        self.device = None
+        self._device = device
+        self.fast_reconnect = fast_reconnect
+        self.reattach_kernel = []
+        self.interrupt_in = None
+        self.interrupt_out = None
+
+    @staticmethod
+    def find_devices(vendor):
+        '''Return a list of the PyUSB devices with the USB vendor ID
+        ``vendor``.
+
+        '''
+        _import_usb()
+        # Note usb.core.find returns an iterator if find_all is True
+        return list(usb.core.find(idVendor=vendor, find_all=True))
+
+    @staticmethod
+    def device_location(device):
+        '''Return a string identifying the bus and port ``device`` is
+        attached to, in the form used by sysfs, for example 1-2.4. This
+        stays the same across reconnections as long as the device is
+        plugged into the same port.
+
+        '''
+        ports = getattr(device, 'port_numbers', None)
+        if ports:
+            return '{0}-{1}'.format(device.bus,
+                                    '.'.join(str(p) for p in ports))
+        # Fall back to the device address if the backend can't
+        # report port numbers
+        return '{0}:{1}'.format(device.bus, device.address)
+
+    @property
+    def location(self):
+        dev = self.device if self.device is not None else self._device
+        if dev is None:
+            return None
+        return self.device_location(dev)
+
+    def open(self, vendor):
+        _import_usb()
+        timings = self.timings = {}
+        start = time.perf_counter()
+        if self._device is not None:
+            devices = [self._device]
+        else:
+            devices = self.find_devices(vendor)
+        timings['enumerate'] = time.perf_counter() - start
+
+        ndev = len(devices)
+        if ndev < 1:
+            logger.info('Amplifier device not found')
+            raise NotConnectedError('Amplifier device not found')
+        elif ndev > 1:
+            # The amp to use has to be chosen, which is done by
+            # passing the device found by AmpManager.
+            logger.info('More than one amplifier found')
+            raise NotConnectedError('More than one amplifier found')
+
+        dev = devices[0]
+        logger.debug('Device:\n' + str(dev))
+
+        key = (dev.bus, dev.address)
+        start = time.perf_counter()
+        if self.fast_reconnect and key in self._released:
+            logger.debug('Device released cleanly, not resetting it')
+        else:
+            dev.reset()
+        # Until it is closed cleanly again, the device must be reset
+        # on opening
+        self._released.discard(key)
+        timings['reset'] = time.perf_counter() - start
+        start = time.perf_counter()
+
+        # We know for this device there's only one configuration, so
+        # no need to iterate through configurations below.
+        cfg = dev.get_active_configuration()
+
+        self.reattach_kernel = [False] * cfg.bNumInterfaces
+
+        # for intf in range(cfg.bNumInterfaces):
+        for intf in cfg:
+            if dev.is_kernel_driver_active(intf.bInterfaceNumber):
+                try:
+                    dev.detach_kernel_driver(intf.bInterfaceNumber)
+                except usb.core.USBError as e:
+                    raise usb.core.USBError(
+                        "Could not detach kernel driver from interface({0}): {1}".format(intf.bInterfaceNumber, str(e)))
+                # Note that for interfaces with more than one setting
+                # we'll iterate more than once through that
+                # interface. The second and later times it won't be
+                # attached to the kernel so we won't reach here, but
+                # it's ok, as on the first time we set this to be
+                # True. Be careful with alternative strategies - it
+                # would be very easy to overwrite the True below with
+                # False on the second pass!
+                self.reattach_kernel[intf.bInterfaceNumber] = True
+
+        # Set the device to use the default (and only) configuration
+        dev.set_configuration()
+
+        # Interface 0 seems always to be the interrupt endpoint
+        # interface
+        interrupt_intf = cfg[0, 0] # same as cfg.interfaces()[0]
+        intf_out = usb.util.find_descriptor \
+                   (interrupt_intf,
+                    custom_match=lambda e: \
+                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        intf_in = usb.util.find_descriptor \
+                  (interrupt_intf,
+                   custom_match=lambda e: \
+                   usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        # Now get their addresses
+        self.interrupt_in = intf_in.bEndpointAddress
+        self.interrupt_out = intf_out.bEndpointAddress
+        timings['claim'] = time.perf_counter() - start
+
+        self.device = dev
+        self.product_id = dev.idProduct
+
+    def close(self):
+        if self.device is None:
+            return
+
+        # http://stackoverflow.com/questions/12542799/communication-with-the-usb-device-in-python
+        # This returns all resources to the state they were in after
+        # usb.core.find() returned (according to the PyUSB tutorial
+        # that is) ...
+        usb.util.dispose_resources(self.device)
+
+        # ... so we still need to reattach interfaces to kernel driver
+        # if they were were originally attached to a kernel driver.
+        cfg = self.device.get_active_configuration()
+
+        for intf in cfg:
+            if self.reattach_kernel[intf.bInterfaceNumber] is True:
+                # Note that for interfaces with more than one setting,
+                # we'll iterate more than once through that
+                # interface. So, on the second or more visits, the
+                # interface will have already been re-attached to the
+                # kernel - attempting to reattach it again will raise
+                # a Resource Busy exception.
+                if not self.device.is_kernel_driver_active(intf.bInterfaceNumber):
+                    try:
+                        self.device.attach_kernel_driver(intf.bInterfaceNumber)
+                    except usb.core.USBError as e:
+                        raise usb.core.USBError(
+                            "Could not attach kernel driver to interface({0}): {1}".format(intf.bInterfaceNumber, str(e)))
+
+        self._released.add((self.device.bus, self.device.address))
+        self.device = None
+        self.reattach_kernel = []
+        self.product_id = None
+        self.interrupt_in = None
+        self.interrupt_out = None
+
+    def read(self, timeout=None):
+        # PyUSB specifies timeouts in milliseconds
+        if timeout is not None:
+            timeout = max(1, int(timeout * 1000))
+
+        try:
+            return self.device.read(self.interrupt_in, 64, timeout)
+        except usb.core.USBError as e:
+            # Older PyUSB releases have no USBTimeoutError, and report
+            # a timeout only through errno
+            if (isinstance(e, getattr(usb.core, 'USBTimeoutError', ())) or
+                    e.errno == errno.ETIMEDOUT):
+                raise NoDataAvailable
+            if e.errno == errno.ENODEV:
+                raise NotConnectedError('Amplifier disconnected')
+            raise
+
+    def write(self, data):
+        return self.device.write(self.interrupt_out, data)
+
+
+class ControlWriteCoalescer(threading.Thread):
+
+    '''Thread which sends control writes queued with put to an amp,
+    keeping only the newest pending value of each control. Each control
+    is written at most ``max_rate`` times per second. A write queued
+    when the control hasn't been written for at least 1/max_rate
+    seconds is sent immediately.
+
+    ``on_sent``, if given, is called from this thread after each write
+    as on_sent(control, value, queued, sent), where queued and sent
+    are time.monotonic() values for when the value was queued and
+    when it was written.
+
+    '''
+
+    def __init__(self, amp, max_rate=50.0, on_sent=None):
+        super(ControlWriteCoalescer, self).__init__(name='ControlWriteCoalescer')
+        self.daemon = True
+        self.amp = amp
+        self.max_rate = max_rate
+        self.on_sent = on_sent
+        self._pending = collections.OrderedDict()
+        self._last_sent = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+
+    def put(self, control, value):
+        self.amp._check_control(control, value)
+        now = time.monotonic()
+        with self._cond:
+            if control == 'fx_focus' and value == self.amp.fx_focus:
+                # Focus wouldn't change, so cancel any pending change
+                # of focus rather than sending this.
+                self._pending.pop(control, None)
+                return
+            self._pending[control] = (value, now)
+            self._cond.notify()
+
+    def discard(self, control):
+        '''Forget any pending write of ``control``.'''
+        with self._cond:
+            self._pending.pop(control, None)
+
+    def stop(self, flush=True):
+        '''Stop the thread, first sending any pending writes if ``flush`` is
+        True.
+
+        '''
+        with self._cond:
+            if not flush:
+                self._pending.clear()
+            self._stopping = True
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def _due(self, now):
+        # Return the controls which may be written now, and the time
+        # at which the next of the others may be.
+        interval = 1.0 / self.max_rate
+        due = []
+        wakeup = None
+        for control in self._pending:
+            t = self._last_sent.get(control, 0.0) + interval
+            if t <= now or self._stopping:
+                due.append(control)
+            elif wakeup is None or t < wakeup:
+                wakeup = t
+        return due, wakeup
+
+    def run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due, wakeup = self._due(now)
+                    if due:
+                        break
+                    if self._stopping:
+                        return
+                    self._cond.wait(None if wakeup is None else wakeup - now)
+                writes = [(control, self._pending.pop(control)) for control in due]
+
+            for control, (value, queued) in writes:
+                try:
+                    self.amp._write_control(control, value)
+                except Exception:
+                    logger.exception(
+                        'Failed to write {0} to control {1}'.format(value, control))
+                    continue
+                sent = time.monotonic()
+                self._last_sent[control] = sent
+                if self.on_sent is not None:
+                    self.on_sent(control, value, queued, sent)
+
+
 # Implementation note regarding reading delay time info from the amp
 # when controls are changed on the amp:
 #
@@ -328,83 +892,104 @@ class BlackstarIDAmp(object):
     tuner_note = ['E', 'F', 'F#', 'G', 'G#', 'A',
                   'A#', 'B', 'C', 'C#', 'D', 'D#']
 
-    def __init__(self):
-        self.connected = False
-        self.reattach_kernel = []
-        self.device = None
-        self.model = None
-        self.interrupt_in = None
-        self.interrupt_out = None
+    def __init__(self, transport=None):
+        '''``transport`` is an AmpTransport instance used to communicate
+        with the amplifier. If not specified, a USBTransport is used.
 
-    def connect(self):
-
-        # Find device. Note usb.core.find returns an iterator if
-        # find_all is True
-        devices = list(usb.core.find(idVendor=self.vendor, find_all=True))
-
-        ndev = len(devices)
-        if ndev < 1:
-            logger.info('Amplifier device not found')
-            raise NotConnectedError('Amplifier device not found')
-        elif ndev > 1:
-            # In future we shouldn't bail here but change the API to
-            # deal with the possibility of multiple amps and provide
-            # mechanism for an application to allow the user to select
-            # which amp they want to connect to. For now, we'll just
-            # bail.
-            logger.info('More than one amplifier found')
-            raise NotConnectedError('More than one amplifier found')
-
-        dev = devices[0]
-        logger.debug('Device:\n' + str(dev))
+        '''
+        if transport is None:
+            transport = USBTransport()
 
-        dev.reset()
+        self.transport = transport
+        self.connected = False
+        self.model = None
 
-        # We know for this device there's only one configuration, so
-        # no need to iterate through configurations below.
-        cfg = dev.get_active_configuration()
+        # Held while reading, and while performing an exchange of
+        # packets with the amp which mustn't be interrupted.
+        self.io_lock = threading.RLock()
+
+        # Writes made with queue_control go through this, which is
+        # created when first needed
+        self.write_coalescer = None
+
+        # Time in seconds taken by each phase of the last connection:
+        # those timed by the transport, 'connect' for the whole of
+        # connect, 'startup' for the reply to the first startup packet
+        # and any others recorded by the application with timed
+        self.connect_timings = {}
+        self._startup_sent = None
+
+        # The amp's settings as last reported by or written to it,
+        # updated by read_data and by every write. The controls are
+        # forgotten when a preset is selected, until the amp reports
+        # them again.
+        self.state = AmpState()
+
+        # Functions called with the data returned by read_data. This
+        # is a tuple so that it can be iterated over without locking.
+        self._listeners = ()
+
+        # Objects whose record(direction, packet) method is called
+        # with every packet sent and received, the PacketTrace
+        # created by enable_trace and the LatencyMonitor created by
+        # enable_latency. Also a tuple for the same reason.
+        self._taps = ()
+        self.trace = None
+        self.latency = None
+
+    # Maximum rate, per control, of writes made with queue_control
+    max_write_rate = 50.0
+
+    # The entries of the dictionaries returned by read_data which are
+    # kept in state. Others, such as tuner readings and preset names,
+    # describe events rather than the state of the amp.
+    state_keys = frozenset(
+        [c for c in controls if c != 'delay_time_coarse'] +
+        ['preset', 'manual_mode', 'tuner_mode'])
+
+    @property
+    def fx_focus(self):
+        '''The effect focus last reported by or written to the amp. The
+        amp doesn't report changes of focus made on the front panel,
+        only the focus given in the reply to startup, so this is only
+        a best guess.
 
-        self.reattach_kernel = [False] * cfg.bNumInterfaces
+        '''
+        return self.state.get('fx_focus')
 
-        # for intf in range(cfg.bNumInterfaces):
-        for intf in cfg:
-            if dev.is_kernel_driver_active(intf.bInterfaceNumber):
-                try:
-                    dev.detach_kernel_driver(intf.bInterfaceNumber)
-                except usb.core.USBError as e:
-                    raise usb.core.USBError(
-                        "Could not detach kernel driver from interface({0}): {1}".format(intf.bInterfaceNumber, str(e)))
-                # Note that for interfaces with more than one setting
-                # we'll iterate more than once through that
-                # interface. The second and later times it won't be
-                # attached to the kernel so we won't reach here, but
-                # it's ok, as on the first time we set this to be
-                # True. Be careful with alternative strategies - it
-                # would be very easy to overwrite the True below with
-                # False on the second pass!
-                self.reattach_kernel[intf.bInterfaceNumber] = True
+    def connect(self):
+        start = time.perf_counter()
+        self.transport.open(self.vendor)
 
-        # Set the device to use the default (and only) configuration
-        dev.set_configuration()
+        self.connected = True
+        self.model = self.amp_models[self.transport.product_id]
+        self.connect_timings = dict(self.transport.timings)
+        self.connect_timings['connect'] = time.perf_counter() - start
+        self._startup_sent = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Connected to {0}: {1}'.format(
+                self.model, self.format_timings()))
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        '''Context manager recording the time taken by its block in
+        connect_timings under ``phase``, for timing the steps an
+        application takes after connecting, for example:
+
+            with amp.timed('drain'):
+                amp.drain()
 
-        # Interface 0 seems always to be the interrupt endpoint
-        # interface
-        interrupt_intf = cfg[0, 0] # same as cfg.interfaces()[0]
-        intf_out = usb.util.find_descriptor \
-                   (interrupt_intf,
-                    custom_match=lambda e: \
-                    usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT)
-        intf_in = usb.util.find_descriptor \
-                  (interrupt_intf,
-                   custom_match=lambda e: \
-                   usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_IN)
-        # Now get their addresses
-        self.interrupt_in = intf_in.bEndpointAddress
-        self.interrupt_out = intf_out.bEndpointAddress
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.connect_timings[phase] = time.perf_counter() - start
 
-        self.connected = True
-        self.device = dev
-        self.model = self.amp_models[dev.idProduct]
+    def format_timings(self):
+        '''Return connect_timings formatted for logging.'''
+        return ', '.join('{0} {1:.1f}ms'.format(phase, t * 1000)
+                         for phase, t in self.connect_timings.items())
 
     def __del__(self):
         if self.connected:
@@ -418,37 +1003,15 @@ class BlackstarIDAmp(object):
         if self.connected is False:
             return
 
-        # http://stackoverflow.com/questions/12542799/communication-with-the-usb-device-in-python
-        # This returns all resources to the state they were in after
-        # usb.core.find() returned (according to the PyUSB tutorial
-        # that is) ...
-        usb.util.dispose_resources(self.device)
-
-        # ... so we still need to reattach interfaces to kernel driver
-        # if they were were originally attached to a kernel driver.
-        cfg = self.device.get_active_configuration()
+        if self.write_coalescer is not None:
+            self.write_coalescer.stop()
+            self.write_coalescer = None
 
-        for intf in cfg:
-            if self.reattach_kernel[intf.bInterfaceNumber] is True:
-                # Note that for interfaces with more than one setting,
-                # we'll iterate more than once through that
-                # interface. So, on the second or more visits, the
-                # interface will have already been re-attached to the
-                # kernel - attempting to reattach it again will raise
-                # a Resource Busy exception.
-                if not self.device.is_kernel_driver_active(intf.bInterfaceNumber):
-                    try:
-                        self.device.attach_kernel_driver(intf.bInterfaceNumber)
-                    except usb.core.USBError as e:
-                        raise usb.core.USBError(
-                            "Could not attach kernel driver to interface({0}): {1}".format(intf.bInterfaceNumber, str(e)))
+        self.transport.close()
+        self.state.forget()
 
         self.connected = False
-        self.device = None
-        self.reattach_kernel = []
         self.model = None
-        self.interrupt_in = None
-        self.interrupt_out = None
 
     def _send_data(self, data):
         '''Take a list of bytes and send it to endpoint'''
@@ -459,40 +1022,93 @@ class BlackstarIDAmp(object):
             logger.warning(
                 'data length is {0} which is not 64'.format(data_length))
 
-        # Write to endpoint, returning the number of bytes written
-        bytes_written = self.device.write(self.interrupt_out, data)
+        for tap in self._taps:
+            tap.record(PACKET_SENT, data)
 
-        logger.debug("Data length {0}, bytes written {1}".format(data_length, bytes_written))
+        # Write to endpoint, returning the number of bytes written
+        bytes_written = self.transport.write(data)
 
         if bytes_written != data_length:
+            self.dump_trace()
             raise WriteToAmpError(
                 'Failed to write {0} bytes to amplifier.'.format(data_length - bytes_written))
 
         return bytes_written
 
-    def _format_data(self, packet):
-        '''Format a data packet for printing with 16 columns for easy 
-        comparison with tools such as wireshark.'''
+    def _read_packet(self, timeout=None):
+        '''Read a single packet from the amplifier. Raises NoDataAvailable if
+        no packet arrives within ``timeout`` seconds.
 
-        # Turn the entries into hex strings
-        # strings = ['%0.2X' % i for i in packet]
-        strings = ['{0:02X}'.format(i) for i in packet]
+        '''
+        packet = self.transport.read(timeout)
+        for tap in self._taps:
+            tap.record(PACKET_RECEIVED, packet)
+        return packet
+
+    def add_tap(self, tap):
+        '''Arrange for tap.record(direction, packet) to be called with
+        every packet sent to and received from the amp, where
+        direction is PACKET_SENT or PACKET_RECEIVED. Taps are called
+        in the sending or receiving thread, before the packet is
+        written or decoded, so must be quick and must not modify the
+        packet.
 
-        # Now break up into lines, each with 16 entries
-        length = len(strings)
+        '''
+        self._taps = self._taps + (tap,)
 
-        lines = (length // 16) + (length % 16 > 16)
+    def remove_tap(self, tap):
+        self._taps = tuple(t for t in self._taps if t is not tap)
 
-        string = ''
-        for line in range(lines):
-            start = line * 16
-            end = start + 16
-            string += ' '.join(strings[start:end])
-            string += '\n'
+    def enable_trace(self, capacity=1024):
+        '''Start recording the last ``capacity`` packets sent and received
+        in a PacketTrace, which is returned and also available as the
+        trace attribute. The trace is logged when a protocol error is
+        detected. Tracing is off by default, and costs nothing then.
 
-        return string[0:-1]  # remove last \n
+        '''
+        from blackstarid.trace import PacketTrace
+        self.disable_trace()
+        self.trace = PacketTrace(capacity)
+        self.add_tap(self.trace)
+        return self.trace
+
+    def disable_trace(self):
+        if self.trace is not None:
+            self.remove_tap(self.trace)
+            self.trace = None
+
+    def enable_latency(self, timeout=2.0):
+        '''Start timing the amp's echoes of control writes and its replies
+        to requests in a LatencyMonitor, which is returned and also
+        available as the latency attribute. Requests unanswered after
+        ``timeout`` seconds are counted as lost. Off by default.
 
-    def set_control(self, control, value):
+        '''
+        from blackstarid.latency import LatencyMonitor
+        self.disable_latency()
+        self.latency = LatencyMonitor(timeout)
+        self.add_tap(self.latency)
+        return self.latency
+
+    def disable_latency(self):
+        if self.latency is not None:
+            self.remove_tap(self.latency)
+            self.latency = None
+
+    def dump_trace(self, level=logging.ERROR):
+        '''Log the packet trace, if tracing is enabled.'''
+        if self.trace is not None:
+            self.trace.dump(logger, level)
+
+    def _format_data(self, packet):
+        return format_packet(packet)
+
+    def _check_control(self, control, value):
+        '''Check that ``control`` is a valid control name and ``value`` a
+        valid value for it, raising ValueError if not. Returns the
+        control ID.
+
+        '''
         try:
             ctrl_byte = self.controls[control]
         except KeyError:
@@ -508,21 +1124,156 @@ class BlackstarIDAmp(object):
             logger.error(msg)
             raise ValueError(msg)
 
+        return ctrl_byte
+
+    def control_packet(self, control, value):
+        '''Return the packet which sets ``control`` to ``value``, raising
+        ValueError if either is invalid.
+
+        '''
+        ctrl_byte = self._check_control(control, value)
+
         data = [0x00] * 64
 
-        if control is 'delay_time':
+        if control == 'delay_time':
             data[0:4] = [0x03, ctrl_byte, 0x00, 0x02]
             data[4] = value % 256
             data[5] = value // 256
         else:
             data[0:5] = [0x03, ctrl_byte, 0x00, 0x01, value]
 
+        return data
+
+    def set_control(self, control, value):
+        data = self.control_packet(control, value)
+
+        # A direct write supersedes any queued write of the same
+        # control
+        if self.write_coalescer is not None:
+            self.write_coalescer.discard(control)
+
+        return self._write_control(control, value, data)
+
+    def _write_control(self, control, value, data=None):
+        # Write a control without touching the queued writes, as the
+        # write coalescer does: discarding there could drop a newer
+        # value queued while this one was being sent
+        if data is None:
+            data = self.control_packet(control, value)
         ret = self._send_data(data)
+        self.state.set(control, value)
 
-        logger.debug('Set control: {0} to value {1}'.format(control, value))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Set control: {0} to value {1}'.format(control, value))
 
         return ret
 
+    def queue_control(self, control, value):
+        '''Queue a write of ``value`` to ``control``. Writes are sent from a
+        background thread at no more than max_write_rate writes of each
+        control per second, and if a control is queued again before its
+        previous value has been sent only the newest value is sent. This
+        is intended for controls driven by sliders and the like, which
+        generate many intermediate values.
+
+        Writes to fx_focus which wouldn't change the effect focus are
+        dropped.
+
+        Invalid controls and values raise ValueError immediately.
+
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        if self.write_coalescer is None:
+            self.write_coalescer = ControlWriteCoalescer(
+                self, self.max_write_rate)
+            self.write_coalescer.start()
+
+        self.write_coalescer.put(control, value)
+
+    # The order in which apply_settings writes controls, and the
+    # preset field holding each. The effect types are written before
+    # the parameters whose meaning depends on the type, each effect is
+    # switched on or off once its parameters are set, and the effect
+    # focus is written last so that it isn't left on an effect which
+    # is switched off by the time it is sent.
+    apply_order = (
+        ('voice', 'voice'),
+        ('tvp_valve', 'tvp_valve'),
+        ('tvp_switch', 'tvp_switch'),
+        ('gain', 'gain'),
+        ('volume', 'volume'),
+        ('bass', 'bass'),
+        ('middle', 'middle'),
+        ('treble', 'treble'),
+        ('isf', 'isf'),
+        ('mod_type', 'mod_type'),
+        ('mod_segval', 'mod_segval'),
+        ('mod_manual', 'mod_manual'),
+        ('mod_level', 'mod_level'),
+        ('mod_speed', 'mod_speed'),
+        ('mod_switch', 'mod_switch'),
+        ('delay_type', 'delay_type'),
+        ('delay_feedback', 'delay_feedback'),
+        ('delay_level', 'delay_level'),
+        ('delay_time', 'delay_time'),
+        ('delay_switch', 'delay_switch'),
+        ('reverb_type', 'reverb_type'),
+        ('reverb_size', 'reverb_size'),
+        ('reverb_level', 'reverb_level'),
+        ('reverb_switch', 'reverb_switch'),
+        ('fx_focus', 'effect_focus'),
+    )
+
+    def apply_settings(self, preset, force=False):
+        '''Set the amp's controls to the settings of ``preset``, a
+        BlackstarIDAmpPreset or a dictionary mapping control names to
+        values. Only the controls whose values differ from those in
+        state are written, unless ``force`` is True, and they are
+        written in the order given by apply_order. Any writes of those
+        controls queued with queue_control are discarded.
+
+        The values to be written are checked before anything is, so a
+        ValueError leaves the amp unchanged. Returns a dictionary of
+        the controls written and their values.
+
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        if isinstance(preset, BlackstarIDAmpPreset):
+            settings = dict((control, getattr(preset, field))
+                            for control, field in self.apply_order)
+        else:
+            settings = preset
+
+        state = self.state
+        writes = []
+        for control, field in self.apply_order:
+            value = settings.get(control)
+            if value is None:
+                continue
+            if force or state.get(control) != value:
+                writes.append((control, value,
+                               self.control_packet(control, value)))
+
+        if self.write_coalescer is not None:
+            for control in settings:
+                self.write_coalescer.discard(control)
+
+        written = {}
+        try:
+            for control, value, packet in writes:
+                self._send_data(packet)
+                written[control] = value
+        finally:
+            self.state.update(written)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Applied settings, wrote {0}'.format(written))
+        return written
+
     def startup(self):
         '''This method sends a packet to the amplifier which results in a
         reply of 3 packets. For Insider this is the first packet
@@ -546,6 +1297,10 @@ class BlackstarIDAmp(object):
         data[0] = 0x81
         data[3:8] = [0x04, 0x03, 0x06, 0x02, 0x7a]
 
+        # The first startup after connecting is timed until the amp
+        # replies with its settings - see _decode_all_controls
+        if 'startup' not in self.connect_timings:
+            self._startup_sent = time.perf_counter()
         self._send_data(data)
 
         logger.debug('Startup packet sent')
@@ -578,6 +1333,63 @@ class BlackstarIDAmp(object):
         for i in range(1, 129):
             self.get_preset_name(i)
 
+    def fetch_preset_names(self, presets=None, window=8, timeout=0.25,
+                           retries=3):
+        '''Start fetching the names of ``presets`` (by default all presets)
+        in the background, and return a PresetNameFetch handle which
+        completes when all names have been received. At most ``window``
+        requests are outstanding at once, and a request which isn't
+        answered within ``timeout`` seconds is sent again, up to
+        ``retries`` times.
+
+        Replies are picked up by listening to read_data, so another
+        thread, such as an AmpReader, must be reading from the amp.
+
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        from blackstarid.fetch import PresetNameFetch
+        fetch = PresetNameFetch(self, presets, window, timeout, retries)
+        fetch.start()
+        return fetch
+
+    def request_preset_settings(self, preset):
+        '''Send a request packet to get the settings of the specified
+        preset. The amp replies with a preset settings packet, which
+        read_data returns as preset_settings.
+
+        ``preset`` must be an integer in the range 1..128
+
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        if preset not in range(1, 129):
+            msg = 'Preset number {0} out of range'.format(preset)
+            logger.error(msg)
+            raise ValueError(msg)
+
+        data = [0x00] * 64
+        data[0:4] = [0x02, 0x05, preset, 0x00]
+
+        self._send_data(data)
+
+    def fetch_preset_settings(self, presets=None, window=4, timeout=0.5,
+                              retries=3):
+        '''As fetch_preset_names, but fetching preset settings. Returns a
+        PresetSettingsFetch handle, whose bank holds the settings
+        received.
+
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        from blackstarid.fetch import PresetSettingsFetch
+        fetch = PresetSettingsFetch(self, presets, window, timeout, retries)
+        fetch.start()
+        return fetch
+
     def set_preset_name(self, preset, name, handle_response=False):
         '''Set the name of the specified preset.
 
@@ -609,57 +1421,76 @@ class BlackstarIDAmp(object):
             logger.error(msg)
             raise ValueError(msg)
 
-        # Get relevant preset settings
-        data = [0x00] * 64
-        data[0:4] = [0x02, 0x05, preset, 0x00]
-        self._send_data(data)
-        settings = self.device.read(self.interrupt_in, 64)
-
-        # Now form a packet used to set the (unchanged) settings
-        settings[1] = 0x03 # instead of 0x02
-        settings[3] = 0x29 # instead of 0x2a - weirdly inconsistent
-
-        # Form packet for preset name
-        namepkt = [0x00] * 64
-        namepkt[0:4] = [0x02, 0x02, preset, 0x15]
-
-        # Form a list of ascii values of each character
-        namel = [ord(c) for c in name]
-        namepkt[4:4 + len(namel)] = namel
-
-        self._send_data(namepkt)
-        self._send_data(settings)
+        # Hold the I/O lock so that a thread calling read_data can't
+        # consume the packets we're waiting for
+        with self.io_lock:
+            # Get relevant preset settings
+            data = [0x00] * 64
+            data[0:4] = [0x02, 0x05, preset, 0x00]
+            self._send_data(data)
+            settings = self._read_packet()
+
+            # Now form a packet used to set the (unchanged) settings
+            settings[1] = 0x03 # instead of 0x02
+            settings[3] = 0x29 # instead of 0x2a - weirdly inconsistent
+
+            # Form packet for preset name
+            namepkt = [0x00] * 64
+            namepkt[0:4] = [0x02, 0x02, preset, 0x15]
+
+            # Form a list of ascii values of each character
+            namel = [ord(c) for c in name]
+            namepkt[4:4 + len(namel)] = namel
+
+            self._send_data(namepkt)
+            self._send_data(settings)
+
+            if handle_response == True:
+                # The amp responds with a packet confirming the new name and a
+                # packet confirming the preset settings. We don't needthose so
+                # we'll simply drop them, after checking they're sensible.
+                try:
+                    packet1 = self._read_packet()
+                    packet2 = self._read_packet()
+                except NoDataAvailable:
+                    msg = 'Failed to get response from amp when changing preset name'
+                    logger.error(msg)
+                    raise NoDataAvailable(msg)
+
+                # Check the first packet contains the same name
+                if packet1[0:4].tolist() != [0x02, 0x04, preset, 0x15] or packet1[4:25].tolist() != namepkt[4:25]:
+                    msg = 'Incorrect response packet 1 when setting preset name'
+                    logger.error(msg + '\n' + self._format_data(packet1))
+                    self.dump_trace()
+                    raise RuntimeError(msg)
+
+                # Check the second packet contains the same settings data as
+                # earlier. Note that the range here could either be [4:46] or
+                # [4:47] depending on whether there are 0x2a or 0x29 bytes of
+                # data to read - the packet containing the settings, and the
+                # form of the packet sent to set the preset are inconsistent
+                # here. It seems that 4[47] works, though, so the longer
+                # number is probably correct.
+                if packet2[0:4].tolist() != [0x02, 0x05, preset, 0x2a] or packet2[4:47] != settings[4:47]:
+                    msg = 'Incorrect response packet 2 when setting preset name'
+                    logger.error(msg + '\n' + self._format_data(packet2))
+                    self.dump_trace()
+                    raise RuntimeError(msg)
+
+    @staticmethod
+    def select_preset_packet(preset):
+        '''Return the packet which selects ``preset``, an integer between
+        1..128.
 
-        if handle_response == True:
-            # The amp responds with a packet confirming the new name and a
-            # packet confirming the preset settings. We don't needthose so
-            # we'll simply drop them, after checking they're sensible.
-            try:
-                packet1 = self.device.read(self.interrupt_in, 64)
-                packet2 = self.device.read(self.interrupt_in, 64)
-            except usb.core.USBError:
-                msg = 'Failed to get response from amp when changing preset name'
-                logger.error(msg)
-                raise NoDataAvailable(msg)
-
-            # Check the first packet contains the same name
-            if packet1[0:4].tolist() != [0x02, 0x04, preset, 0x15] or packet1[4:25].tolist() != namepkt[4:25]:
-                msg = 'Incorrect response packet 1 when setting preset name'
-                logger.error(msg + '\n' + self._format_data(packet1))
-                raise RuntimeError(msg)
-
-            # Check the second packet contains the same settings data as
-            # earlier. Note that the range here could either be [4:46] or
-            # [4:47] depending on whether there are 0x2a or 0x29 bytes of
-            # data to read - the packet containing the settings, and the
-            # form of the packet sent to set the preset are inconsistent
-            # here. It seems that 4[47] works, though, so the longer
-            # number is probably correct.
-            if packet2[0:4].tolist() != [0x02, 0x05, preset, 0x2a] or packet2[4:47] != settings[4:47]:
-                msg = 'Incorrect response packet 2 when setting preset name'
-                logger.error(msg + '\n' + self._format_data(packet2))
-                raise RuntimeError(msg)
+        '''
+        if preset not in range(1, 129):
+            msg = 'Preset number {0} out of range'.format(preset)
+            logger.debug(msg)
+            raise ValueError(msg)
 
+        data = [0x00] * 64
+        data[0:4] = [0x02, 0x01, preset, 0x00]
+        return data
 
     def select_preset(self, preset):
         '''Selects a preset.
@@ -669,19 +1500,24 @@ class BlackstarIDAmp(object):
         if self.connected is False:
             raise NotConnectedError
 
-        if preset not in range(1, 129):
-            msg = 'Preset number {0} out of range'.format(preset)
-            logger.debug(msg)
-            raise ValueError(msg)
+        self._send_data(self.select_preset_packet(preset))
+        self.state.forget(self.controls)
 
-        data = [0x00] * 64
-        data[0:4] = [0x02, 0x01, preset, 0x00]
+    def send_packet(self, packet):
+        '''Send ``packet``, as built by one of the *_packet methods, to the
+        amp. This allows packets to be built in advance of when they
+        need to be sent.
 
-        self._send_data(data)
+        '''
+        if self.connected is False:
+            raise NotConnectedError
+
+        return self._send_data(packet)
 
-    def read_data_packet(self):
+    def read_data_packet(self, timeout=None):
         '''Attempts to read a data packet from the amplifier. If no data is
-        available a usb.core.USBError exception will be raised.
+        available within ``timeout`` seconds a NoDataAvailable exception
+        will be raised.
 
         This returns a dictionary of values for the various amp
         settings, and will return info from a single packet. The
@@ -694,175 +1530,101 @@ class BlackstarIDAmp(object):
         amplifier, but this may change in the future.
 
         '''
-        try:
-            packet = self.device.read(self.interrupt_in, 64)
-        except usb.core.USBError:
-            raise NoDataAvailable
-
-        if packet[0] == 0x02:
-            if packet[1] == 0x04:
-                # Then packet specifies a preset name
-                preset = packet[2]
-                namel = filter(lambda n: n > 0, packet[4:25])
-                namec = [chr(i) for i in namel]
-                name = ''.join(namec)
-                logger.debug('Data from amp:: preset {0} has name: {1}\n'.format(preset, name))
-                return {'preset_name': [preset, name]}
-            elif packet[1] == 0x06:
-                # Then packet is indicating that the preset has been
-                # changed on the amp. This can happen if the user
-                # selects a preset with an amp button. But, this
-                # packet is also sent after the amp changes channel in
-                # response to sending a packet to change channel.
-                logger.debug('Data from amp:: preset: {0}\n'.format(packet[2]))
-                return {'preset': packet[2]}
-            else:
-                pass
-            if packet[1] == 0x05:# and packet[3] == 0x2A:
-                # Then packet contains settings for the preset
-                settings = BlackstarIDAmpPreset.from_packet(packet)
-                logger.debug('Data from amp:: preset {0} settings'.format(packet[2]))
-                return {'preset_settings': settings}
-
-        elif packet[0] == 0x03:
-            # The 4th byte (packet[3]) specifies the subsequent number of
-            # bytes specifying a value.
-            if packet[3] == 0x01 or packet[3] == 0x02:
-                # Identify which control was changed
-                id = packet[1]
-                try:
-                    control = self.control_ids[id]
-                except KeyError:
-                    errstr = ('Unrecognized control ID: {0:02X}\n'.format(
-                        packet[1]) + self._format_data(packet))
-                    logger.error(errstr)
-                    raise KeyError(errstr)
-            if packet[3] == 0x01:
-                value = packet[4]
-                logger.debug(
-                    'Data from amp:: control: {0} value: {1}'.format(control, value))
-                if control == 'delay_time':
-                    return {'delay_time_fine': value}
-                else:
-                    return {control: value}
-            elif packet[3] == 0x02:
-                if control == 'delay_time':
-                    value = packet[4] + 256 * packet[5]
-                    logger.debug(
-                        'Data from amp:: control: {0} value: {1}'.format(control, value))
-                    return {control: value}
-                elif control == 'delay_type':
-                    delay_type = packet[4]
-                    delay_feedback = packet[5]
-                    logger.debug('Data from amp:: delay_type: {0} delay_feedback: {1}\n'.format(
-                        delay_type, delay_feedback))
-                    return {'delay_type': packet[4], 'delay_feedback': packet[5]}
-                elif control == 'reverb_type':
-                    reverb_type = packet[4]
-                    reverb_size = packet[5]
-                    logger.debug('Data from amp:: reverb_type: {0} reverb_size: {1}\n'.format(
-                        reverb_type, reverb_size))
-                    return {'reverb_type': packet[4], 'reverb_size': packet[5]}
-                elif control == 'mod_type':
-                    mod_type = packet[4]
-                    mod_segval = packet[5]
-                    logger.debug(
-                        'Data from amp:: mod_type: {0} mod_segval: {1}\n'.format(mod_type, mod_segval))
-                    return {'mod_type': packet[4], 'mod_segval': packet[5]}
-            elif packet[3] == 0x2a:
-                # Then packet is a packet describing all current control
-                # settings - note that the 4th byte being 42 (0x2a)
-                # distinguishes this from a packet specifying the voice
-                # setting for which the 4th byte would be 0x01. This is
-                # the 2nd of 3 response packets to the startup packet.
-                # Conveniently the byte address for each control setting
-                # corresponds to the ID number of the control plus
-                # 3. Weird, but handy.
-                logger.debug('All controls info packet received\n' + self._format_data(packet))
-                settings = {}
-                for control, id in self.controls.items():
-                    if control == 'delay_time':
-                        settings[control] = (
-                            packet[id + 4] * 256) + packet[id + 3]
-                        logger.debug('All controls data:: control: {0} value: {1}'.format(
-                            control, settings[control]))
-                    elif control == 'delay_time_coarse':
-                        # Skip this one, as we already deal with it
-                        # for the delay_time entry
-                        pass
-                    else:
-                        settings[control] = packet[id + 3]
-
-                return settings
-
-        elif packet[0] == 0x07:
-            # This is the first of the three response packets to the
-            # startup packet. At this point, I don't know what this
-            # packet describes. Firmware version? For TVP60h it is:
-            # 07 00 00 03 04 00 01 01 40 00 00 00 00 3D 00 00
-            # 10 00 01 00 00 00 00 00 00 00 00 02 00 01 01 03
-            # 00 15 00 00 00 00 00 00 00 00 00 00 00 00 00 00
-            # 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00
-            logger.debug(
-                'Unhandled startup packet 1\n' + self._format_data(packet))
-
-            return {}
-
-        elif packet[0] == 0x08:
-            if packet[1] == 0x03:
-                # This packet indicates if the amp is in manual mode
-                # or not and has the form 08 03 00 01 XX ... if XX is
-                # 01, then the amp has been switched to manual mode,
-                # and if it's 00, then the amp has been switched into
-                # a preset.
-                logger.debug('Data from amp:: manual mode: {0}'.format(packet[4]))
-                return {'manual_mode': packet[4]}
-            if packet[1] == 0x11:
-                # Packet indicates entering or leaving tuner
-                # mode. Packet has the form 08 11 00 01 XX, where XX
-                # is 01 if amp is in tuner mode, and 00 if amp has
-                # left tuner mode.
-                logger.debug('Data from amp:: tuner mode: {0}'.format(packet[4]))
-                return {'tuner_mode': packet[4]}
-            else:
-                # This is the third of the three response packets to the
-                # startup packet. This packet seems to indicate what
-                # preset is selected (or manual).
-                # 08 01 00 1B F0 00 01 01 40 00 00 00 00 3D 00 00
-                # 10 00 01 00 00 00 00 00 00 00 00 02 00 01 01 03
-                # 00 15 00 00 00 00 00 00 00 00 00 00 00 00 00 00
-                # 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00
-                logger.debug(
-                    'Unhandled packet 3\n' + self._format_data(packet))
-
-            return {}
-        elif packet[0] == 0x09:
-            # In this case, the amp is in tuner mode and this data is
-            # tuning data. It has the form 09 NN PP ...  If there is
-            # no note, nn and pp are 00.  Otherwise nn indicates the
-            # note w/in the scale from E == 01 to Eb == 0C, and pp
-            # indicates the variance in pitch (based on A440 tuning),
-            # from 0 (very flat) to 63 (very sharp), i.e, 0-99
-            # decimal.  So, standard tuning is:
-            # E  01 32 (same for low and high E strings)
-            # A  06 32
-            # D  0B 32
-            # G  04 32
-            # B  08 32
-            note = self.tuner_note[packet[1]]
-            delta = 50 - packet[2]
-            logger.debug(
-                'Data from amp:: tuner_note: {0} tuner_delta: {1}\n'.format(note, delta))
-            return {'tuner_note': note, 'tuner_delta': delta}
-
-        # We'll only reach here if we haven't handled the packet and returned
-        # earlier
-        logger.debug(
-            'Unhandled data packet in read_data\n' + self._format_data(packet))
-        return {}
+        return self.decode_packet(self._read_packet(timeout))
+
+    # Packet decoders, keyed on the tuple (packet[0], packet[1],
+    # packet[3]). See register_decoder.
+    packet_decoders = {}
+
+    @classmethod
+    def register_decoder(cls, kind, decoder):
+        '''Register a function to decode a kind of packet received from the
+        amplifier.
+
+        ``kind`` is a tuple (type, subtype, length) which is matched
+        against bytes 0, 1 and 3 of the packet. Either of subtype and
+        length may be None, in which case that byte is not
+        considered. Packets are matched exactly if possible, then
+        ignoring length, then ignoring subtype and finally on type
+        alone.
+
+        ``decoder`` is called as decoder(amp, packet) and must return a
+        dictionary as described for read_data_packet. A decoder
+        registered for a kind replaces any existing one.
+
+        '''
+        cls.packet_decoders[kind] = decoder
+
+    def decode_packet(self, packet):
+        '''Decode a packet received from the amplifier, returning a
+        dictionary as described for read_data_packet.
+
+        '''
+        decoders = self.packet_decoders
+        ptype = packet[0]
+        subtype = packet[1]
+        length = packet[3]
+
+        decoder = decoders.get((ptype, subtype, length))
+        if decoder is None:
+            decoder = decoders.get((ptype, subtype, None))
+            if decoder is None:
+                decoder = decoders.get((ptype, None, length))
+                if decoder is None:
+                    decoder = decoders.get((ptype, None, None),
+                                           _decode_unhandled)
+
+        return decoder(self, packet)
+
+    def add_listener(self, listener):
+        '''Arrange for listener(data) to be called with each dictionary
+        returned by read_data, in the thread calling read_data.
+
+        '''
+        self._listeners = self._listeners + (listener,)
+
+    def remove_listener(self, listener):
+        self._listeners = tuple(l for l in self._listeners if l != listener)
 
-    def read_data(self):
-        settings = self.read_data_packet()
+    def read_data(self, timeout=None):
+        '''Read and decode data from the amplifier, returning a dictionary
+        as for read_data_packet. Unlike read_data_packet, the pair of
+        packets sent when the delay time is adjusted with the tap button
+        held is combined into a single delay_time entry.
+
+        Reads are serialised with io_lock, so this may safely be called
+        from a different thread to set_preset_name. Listeners added with
+        add_listener are called with the result before it is returned.
+
+        '''
+        with self.io_lock:
+            settings = self._read_data(timeout)
+            if settings:
+                self._update_state(settings)
+
+        for listener in self._listeners:
+            listener(settings)
+
+        return settings
+
+    def _update_state(self, settings):
+        if 'preset' in settings:
+            # A preset was selected on the amp; unless its settings
+            # arrived with the change, they are unknown
+            self.state.forget(self.controls)
+        state_keys = self.state_keys
+        if len(settings) == 1:
+            # The usual case of a single control changing
+            for key, value in settings.items():
+                if key in state_keys:
+                    self.state.set(key, value)
+            return
+        changes = dict((k, v) for k, v in settings.items() if k in state_keys)
+        if changes:
+            self.state.update(changes)
+
+    def _read_data(self, timeout):
+        settings = self.read_data_packet(timeout)
         if 'delay_time_fine' in settings:
             # We received the least significant part of the delay_time
             # only, so we need to store it and wait for the next
@@ -877,7 +1639,7 @@ class BlackstarIDAmp(object):
             # for sure.
             delay_time_fine = settings.pop('delay_time_fine')
             while True:
-                s = self.read_data_packet()
+                s = self.read_data_packet(timeout)
                 if 'delay_time_coarse' in s:
                     delay_time_coarse = s.pop('delay_time_coarse')
                     settings.update(s)
@@ -896,34 +1658,229 @@ class BlackstarIDAmp(object):
         '''
         while True:
             try:
-                ret = self.device.read(self.interrupt_in, 64)
+                ret = self._read_packet()
                 logger.debug('Polled packet\n' + self._format_data(ret))
-            except usb.core.USBError:  # Ignore timeouts
+            except NoDataAvailable:  # Ignore timeouts
                 pass
 
-    def drain(self):
-        '''Read data until no more is available and then return. Packets are
-        discarded.
+    def drain(self, quiet_time=0.05, max_time=1.0):
+        '''Read and discard packets until the amp has sent nothing for
+        ``quiet_time`` seconds, returning the number of packets
+        discarded. If the amp is still sending after ``max_time``
+        seconds, for example because it is in tuner mode, give up.
+
+        A ``quiet_time`` of None waits for the transport's default read
+        timeout, and a ``max_time`` of None never gives up.
 
         '''
-        while True:
+        drained = 0
+        deadline = None
+        if max_time is not None:
+            deadline = time.monotonic() + max_time
+        while deadline is None or time.monotonic() < deadline:
             try:
-                ret = self.device.read(self.interrupt_in, 64)
-                logger.debug('Drained packet\n' + self._format_data(ret))
-            except usb.core.USBError:  # No more data available
-                return
-
-    def get_preset_settings(self, preset):
-        # This is an unfinished test function, will be removed.
-        data = [0x00] * 64
-
-        data[0:4] = [0x02, 0x05, preset, 0x00]
-
-        self._send_data(data)
+                self._read_packet(quiet_time)
+                drained += 1
+            except NoDataAvailable:  # No more data available
+                break
+        if drained and logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Drained {0} packets'.format(drained))
+        return drained
+
+######################################################################
+# Decoders for the packets received from the amplifier. These are
+# registered with BlackstarIDAmp.register_decoder below.
+######################################################################
+
+def _decode_unhandled(amp, packet):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            'Unhandled data packet in read_data\n' + amp._format_data(packet))
+    return {}
+
+
+def _decode_preset_name(amp, packet):
+    # Packet specifies a preset name, padded with zeros
+    name = bytes(packet[4:25]).replace(b'\x00', b'').decode('latin-1')
+    return {'preset_name': [packet[2], name]}
+
+
+def _decode_preset(amp, packet):
+    # Packet is indicating that the preset has been changed on the
+    # amp. This can happen if the user selects a preset with an amp
+    # button. But, this packet is also sent after the amp changes
+    # channel in response to sending a packet to change channel.
+    return {'preset': packet[2]}
+
+
+def _decode_preset_settings(amp, packet):
+    # Packet contains settings for the preset
+    return {'preset_settings': BlackstarIDAmpPreset.from_packet(packet)}
+
+
+def _decode_unknown_control(amp, packet):
+    errstr = ('Unrecognized control ID: {0:02X}\n'.format(packet[1]) +
+              amp._format_data(packet))
+    logger.error(errstr)
+    amp.dump_trace()
+    raise KeyError(errstr)
+
+
+def _decode_unexpected_control_length(amp, packet):
+    # A known control reporting a value of a length it isn't known to
+    # use: ignore it rather than guess at the value
+    logger.warning('Unexpected value length {0} for control {1}\n'.format(
+        packet[3], amp.control_ids[packet[1]]) + amp._format_data(packet))
+    return {}
+
+
+def _control_decoder(control):
+    # The 4th byte (packet[3]) specifies the subsequent number of
+    # bytes specifying a value. This returns the decoder for a single
+    # byte value of ``control``.
+    def decoder(amp, packet):
+        return {control: packet[4]}
+    return decoder
+
+
+def _paired_control_decoder(control1, control2):
+    # Some controls, such as the effect type selectors, report two
+    # values in one packet, with the second being the segment value
+    # of the effect.
+    def decoder(amp, packet):
+        return {control1: packet[4], control2: packet[5]}
+    return decoder
+
+
+def _decode_delay_time(amp, packet):
+    return {'delay_time': packet[4] + 256 * packet[5]}
+
+
+# Byte offsets of each control in the all controls packet.
+# Conveniently the byte address for each control setting corresponds
+# to the ID number of the control plus 3. Weird, but handy. The delay
+# time occupies two bytes and is dealt with separately.
+_all_controls_offsets = tuple(
+    (control, id + 3) for control, id in BlackstarIDAmp.controls.items()
+    if control not in ('delay_time', 'delay_time_coarse'))
+_delay_time_offset = BlackstarIDAmp.controls['delay_time'] + 3
+
+
+def _decode_all_controls(amp, packet):
+    # Packet describing all current control settings - note that the
+    # 4th byte being 42 (0x2a) distinguishes this from a packet
+    # specifying the voice setting for which the 4th byte would be
+    # 0x01. This is the 2nd of 3 response packets to the startup
+    # packet.
+    settings = dict((control, packet[offset])
+                    for control, offset in _all_controls_offsets)
+    settings['delay_time'] = (packet[_delay_time_offset + 1] * 256 +
+                              packet[_delay_time_offset])
+    if amp._startup_sent is not None:
+        amp.connect_timings['startup'] = (time.perf_counter() -
+                                          amp._startup_sent)
+        amp._startup_sent = None
+    return settings
+
+
+def _decode_startup_1(amp, packet):
+    # This is the first of the three response packets to the startup
+    # packet. At this point, I don't know what this packet
+    # describes. Firmware version? For TVP60h it is:
+    # 07 00 00 03 04 00 01 01 40 00 00 00 00 3D 00 00
+    # 10 00 01 00 00 00 00 00 00 00 00 02 00 01 01 03
+    # 00 15 00 00 00 00 00 00 00 00 00 00 00 00 00 00
+    # 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00
+    # Whatever it is, it identifies the amp and its firmware well
+    # enough to key the preset cache on, so it's passed on unparsed.
+    return {'amp_identity': bytes(packet)}
+
+
+def _decode_startup_3(amp, packet):
+    # This is the third of the three response packets to the startup
+    # packet. This packet seems to indicate what preset is selected
+    # (or manual).
+    # 08 01 00 1B F0 00 01 01 40 00 00 00 00 3D 00 00
+    # 10 00 01 00 00 00 00 00 00 00 00 02 00 01 01 03
+    # 00 15 00 00 00 00 00 00 00 00 00 00 00 00 00 00
+    # 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00 00
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Unhandled packet 3\n' + amp._format_data(packet))
+    return {}
+
+
+def _decode_manual_mode(amp, packet):
+    # This packet indicates if the amp is in manual mode or not and
+    # has the form 08 03 00 01 XX ... if XX is 01, then the amp has
+    # been switched to manual mode, and if it's 00, then the amp has
+    # been switched into a preset.
+    return {'manual_mode': packet[4]}
+
+
+def _decode_tuner_mode(amp, packet):
+    # Packet indicates entering or leaving tuner mode. Packet has the
+    # form 08 11 00 01 XX, where XX is 01 if amp is in tuner mode, and
+    # 00 if amp has left tuner mode.
+    return {'tuner_mode': packet[4]}
+
+
+def _decode_tuner(amp, packet):
+    # In this case, the amp is in tuner mode and this data is tuning
+    # data. It has the form 09 NN PP ...  If there is no note, nn and
+    # pp are 00.  Otherwise nn indicates the note w/in the scale from
+    # E == 01 to Eb == 0C, and pp indicates the variance in pitch
+    # (based on A440 tuning), from 0 (very flat) to 63 (very sharp),
+    # i.e, 0-99 decimal.  So, standard tuning is:
+    # E  01 32 (same for low and high E strings)
+    # A  06 32
+    # D  0B 32
+    # G  04 32
+    # B  08 32
+    return {'tuner_note': amp.tuner_note[packet[1]],
+            'tuner_delta': 50 - packet[2]}
+
+
+def _register_decoders():
+    register = BlackstarIDAmp.register_decoder
+
+    register((0x02, 0x04, None), _decode_preset_name)
+    register((0x02, 0x05, None), _decode_preset_settings)
+    register((0x02, 0x06, None), _decode_preset)
+
+    # Control changes. Single byte values are decoded the same way
+    # for every control, except the delay time, for which a single
+    # byte packet carries only the least significant part - see the
+    # implementation note above and BlackstarIDAmp.read_data.
+    for control, id in BlackstarIDAmp.controls.items():
+        register((0x03, id, 0x01), _control_decoder(control))
+        register((0x03, id, None), _decode_unexpected_control_length)
+    register((0x03, None, 0x01), _decode_unknown_control)
+    register((0x03, None, 0x02), _decode_unknown_control)
+
+    controls = BlackstarIDAmp.controls
+    register((0x03, controls['delay_time'], 0x01),
+             _control_decoder('delay_time_fine'))
+    register((0x03, controls['delay_time'], 0x02), _decode_delay_time)
+    register((0x03, controls['delay_time_coarse'], 0x02),
+             _control_decoder('delay_time_coarse'))
+    register((0x03, controls['delay_type'], 0x02),
+             _paired_control_decoder('delay_type', 'delay_feedback'))
+    register((0x03, controls['reverb_type'], 0x02),
+             _paired_control_decoder('reverb_type', 'reverb_size'))
+    register((0x03, controls['mod_type'], 0x02),
+             _paired_control_decoder('mod_type', 'mod_segval'))
+    register((0x03, None, 0x2a), _decode_all_controls)
+
+    register((0x07, None, None), _decode_startup_1)
+
+    register((0x08, 0x03, None), _decode_manual_mode)
+    register((0x08, 0x11, None), _decode_tuner_mode)
+    register((0x08, None, None), _decode_startup_3)
+
+    register((0x09, None, None), _decode_tuner)
+
+_register_decoders()
 
-        ret = self.device.read(0x81, 64)
-        logger.debug('Preset settings for preset {0}\n'.format(preset)
-                     + self._format_data(ret))
 
 if __name__ == '__main__':
     import logging
@@ -0,0 +1,327 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''On-disk cache of the preset names and settings of each amplifier,
+so that the preset list is available as soon as a known amp is
+connected. For example:
+
+    sync = PresetSync(amp, PresetCache(), identity)
+    show(sync.names)   # From the cache, possibly stale
+    sync.start()       # Revalidate against the amp in the background
+
+'''
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from blackstarid.bank import PresetBank
+
+logger = logging.getLogger('outsider.blackstarid.cache')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+def cache_directory():
+    '''Return the directory outsider caches data in, following the XDG
+    base directory specification.
+
+    '''
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'outsider')
+
+
+class PresetCache(object):
+
+    '''Stores the preset names and settings of amps in ``directory``,
+    one file per amp, keyed on the amp model, the unparsed first
+    packet of the amp's reply to the startup packet (amp_identity in
+    the data returned by read_data) and the device, if known. The
+    identity packet is the same for amps of the same model and
+    firmware, so the device, the location given by the transport, is
+    what keeps their presets apart; an amp moved to another USB port
+    starts with an empty cache. The directory defaults to outsider in
+    the XDG cache directory.
+
+    '''
+
+    version = 1
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = cache_directory()
+        self.directory = directory
+
+    def key(self, model, identity, device=None):
+        h = hashlib.sha1(model.encode('ascii'))
+        h.update(bytes(identity))
+        if device is not None:
+            h.update(b'\0' + device.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, model, identity, device=None):
+        return os.path.join(self.directory, '{0}-{1}.json'.format(
+            model, self.key(model, identity, device)))
+
+    def load(self, model, identity, device=None):
+        '''Return a tuple of the list of 128 preset names, with None for
+        unknown names, and a PresetBank of the cached settings. Returns
+        None if nothing is cached for the amp or the cache file can't
+        be read.
+
+        '''
+        path = self.path(model, identity, device)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if entry['version'] != self.version:
+                logger.info('Ignoring old preset cache {0}'.format(path))
+                return None
+            names = entry['names']
+            if len(names) != PresetBank.size:
+                raise ValueError('Wrong number of preset names')
+            bank = PresetBank.frombytes(base64.b64decode(entry['bank']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Ignoring unreadable preset cache {0}: {1}'.format(
+                path, e))
+            return None
+
+        return names, bank
+
+    def save(self, model, identity, names, bank, device=None):
+        '''Store the preset names and settings for an amp. The file is
+        replaced atomically, so a crash can't leave a corrupt cache.
+
+        '''
+        entry = {
+            'version': self.version,
+            'model': model,
+            'identity': bytes(identity).hex(),
+            'device': device,
+            'names': list(names),
+            'bank': base64.b64encode(bank.tobytes()).decode('ascii'),
+        }
+
+        path = self.path(model, identity, device)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        logger.debug('Saved preset cache {0}'.format(path))
+
+
+class PresetSync(object):
+
+    '''Keeps a cached copy of the preset names and settings of a
+    connected amp up to date.
+
+    On creation names and bank are loaded from ``cache``, and
+    from_cache says whether anything was found. start then
+    revalidates them in the background: all names are fetched again,
+    which is cheap, and then the settings, starting with the presets
+    whose name has changed or whose settings aren't cached. A preset
+    saved again on the amp under the same name keeps its name, so
+    only fetching the settings reveals the change. If
+    ``revalidate_settings`` is False, settings are fetched only for
+    the presets whose name has changed or whose settings aren't
+    cached. Names and settings the amp sends while the sync is
+    running, for example after a preset is renamed, are also picked
+    up. The cache is saved when revalidation completes and again by
+    stop.
+
+    An AmpReader or similar must be reading from the amp.
+
+    ``device`` tells apart amps of the same model in the cache, and
+    defaults to the location of the amp's transport.
+
+    '''
+
+    def __init__(self, amp, cache, identity, device=None,
+                 revalidate_settings=True):
+        self.amp = amp
+        self.revalidate_settings = revalidate_settings
+        self.cache = cache
+        self.model = amp.model
+        self.identity = bytes(identity)
+        if device is None:
+            device = amp.transport.location
+        self.device = device
+
+        cached = cache.load(self.model, self.identity, self.device)
+        self.from_cache = cached is not None
+        if cached is None:
+            self.names = [None] * PresetBank.size
+            self.bank = PresetBank()
+        else:
+            self.names, self.bank = cached
+
+        # Presets whose settings were fetched by the last
+        # revalidation, and those of them whose settings differed from
+        # the cached ones
+        self.refetched = []
+        self.changed = []
+        self._lock = threading.Lock()
+        self._cached_names = None
+        self._cached_bank = None
+        self._fetch = None
+        self._stopped = False
+        self._callbacks = []
+        self._done = threading.Event()
+
+    def start(self):
+        # Names arriving in reply to the fetch are also seen by
+        # _data_from_amp, so compare them against a snapshot
+        self._cached_names = list(self.names)
+        self._cached_bank = PresetBank.frombytes(self.bank.tobytes())
+        self.amp.add_listener(self._data_from_amp)
+        self._start_fetch(self.amp.fetch_preset_names, self._names_fetched)
+
+    def _start_fetch(self, fn, callback, *args):
+        with self._lock:
+            if self._stopped:
+                fetch = None
+            else:
+                fetch = self._fetch = fn(*args)
+        if fetch is None:
+            self._finish()
+        else:
+            fetch.add_done_callback(callback)
+
+    def _names_fetched(self, fetch):
+        with self._lock:
+            stale = [p for p in range(1, PresetBank.size + 1)
+                     if fetch.names[p - 1] is not None and
+                     (fetch.names[p - 1] != self._cached_names[p - 1] or
+                      p not in self.bank)]
+            for p in range(1, PresetBank.size + 1):
+                if fetch.names[p - 1] is not None:
+                    self.names[p - 1] = fetch.names[p - 1]
+
+        logger.debug('Preset names revalidated, {0} presets stale'.format(
+            len(stale)))
+
+        presets = stale
+        if self.revalidate_settings:
+            presets = stale + [p for p in range(1, PresetBank.size + 1)
+                               if fetch.names[p - 1] is not None and
+                               p not in stale]
+        if presets:
+            self._start_fetch(self.amp.fetch_preset_settings,
+                              self._settings_fetched, presets)
+        else:
+            self._finish()
+
+    def _settings_fetched(self, fetch):
+        cached = self._cached_bank
+        with self._lock:
+            changed = []
+            for preset in fetch.bank:
+                settings = fetch.bank[preset]
+                if (preset not in cached or
+                        bytes(settings.packet) != bytes(cached[preset].packet)):
+                    changed.append(preset)
+                self.bank.update(settings)
+            self.refetched = sorted(fetch.bank)
+            self.changed = sorted(changed)
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._fetch = None
+            stopped = self._stopped
+        if not stopped:
+            self.save()
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception('Error in preset sync callback')
+
+    def _data_from_amp(self, data):
+        # Called in the thread reading from the amp
+        if 'preset_name' in data:
+            preset, name = data['preset_name']
+            with self._lock:
+                self.names[preset - 1] = name
+        if 'preset_settings' in data:
+            with self._lock:
+                self.bank.update(data['preset_settings'])
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''Wait for revalidation to complete. Returns True if it has.'''
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        '''Call fn(sync) when revalidation completes, from the thread
+        which completes it, or immediately if it already has.
+
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def save(self):
+        # Save a copy, so that the lock isn't held while writing
+        with self._lock:
+            names = list(self.names)
+            bank = PresetBank.frombytes(self.bank.tobytes())
+        try:
+            self.cache.save(self.model, self.identity, names, bank,
+                            self.device)
+        except OSError as e:
+            logger.warning('Failed to save preset cache: {0}'.format(e))
+
+    def stop(self, save=True):
+        '''Stop revalidating and listening to the amp, and save the cache
+        if ``save`` is True.
+
+        '''
+        with self._lock:
+            self._stopped = True
+            fetch = self._fetch
+        if fetch is not None:
+            fetch.cancel()
+        self.amp.remove_listener(self._data_from_amp)
+        if save:
+            self.save()
@@ -0,0 +1,406 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Recording of the packets exchanged with an amplifier to a capture
+file, and replay of captures in place of an amplifier.
+
+To record a capture of whatever is done on the amp until Ctrl-C is
+pressed, and then replay it at twice the original speed:
+
+    python3 -m blackstarid.capture record knobs.cap
+    python3 -m blackstarid.capture replay --speed 2 knobs.cap
+
+A capture file is a 16 byte header followed by fixed size records,
+one per packet, each holding a time.monotonic_ns timestamp, the
+direction of the packet and the packet itself. See header_format
+and record_format.
+
+'''
+
+import argparse
+import array
+import logging
+import mmap
+import struct
+import sys
+import threading
+import time
+
+from blackstarid.blackstarid import (AmpTransport, BlackstarIDAmp,
+                                     NoDataAvailable, PACKET_RECEIVED,
+                                     PACKET_SENT, format_packet)
+
+logger = logging.getLogger('outsider.blackstarid.capture')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+magic = b'BSIDCAP\x00'
+version = 1
+
+# Magic, version, record size and the USB product ID of the amp
+header_format = struct.Struct('<8sHHH2x')
+
+# Timestamp in nanoseconds, direction, packet length and the packet,
+# padded to 64 bytes
+record_format = struct.Struct('<qBB6x64s')
+
+
+class CaptureWriter(object):
+
+    '''Appends packets to a new capture file at ``path``. A
+    CaptureWriter is an amp tap, so a capture of all packets sent
+    and received is made with:
+
+        writer = CaptureWriter(path, amp.transport.product_id)
+        amp.add_tap(writer)
+
+    '''
+
+    def __init__(self, path, product_id=0):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'wb')
+        self._file.write(header_format.pack(
+            magic, version, record_format.size, product_id or 0))
+        self._lock = threading.Lock()
+
+    def record(self, direction, packet):
+        t = time.monotonic_ns()
+        packet = bytes(packet[0:64])
+        data = record_format.pack(t, direction, len(packet), packet)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(data)
+                self.count += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CaptureReader(object):
+
+    '''Read access to the capture file at ``path``, which is memory
+    mapped rather than read into memory. Records are indexed from 0
+    and returned as (timestamp_ns, direction, packet) tuples, where
+    packet is bytes.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            m, v, size, self.product_id = header_format.unpack_from(self._map)
+        except struct.error:
+            self.close()
+            raise ValueError('{0} is not a capture file'.format(path))
+        if m != magic or v != version or size != record_format.size:
+            self.close()
+            raise ValueError('{0} is not a version {1} capture file'.format(
+                path, version))
+
+        # A capture which was still being written when the recorder
+        # died may end with a partial record, which is ignored
+        self._count = (len(self._map) - header_format.size) // size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if i not in range(self._count):
+            raise IndexError('Capture record index out of range')
+        offset = header_format.size + i * record_format.size
+        t, direction, length = struct.unpack_from('<qBB', self._map, offset)
+        start = offset + record_format.size - 64
+        return t, direction, self._map[start:start + length]
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def timestamp(self, i):
+        return struct.unpack_from(
+            '<q', self._map, header_format.size + i * record_format.size)[0]
+
+    def indices(self, direction=PACKET_RECEIVED):
+        '''Return an array of the indices of the records with the given
+        direction.
+
+        '''
+        offset = header_format.size + 8
+        size = record_format.size
+        m = self._map
+        return array.array('L', [i for i in range(self._count)
+                                 if m[offset + i * size] == direction])
+
+    def packets(self, direction=PACKET_RECEIVED):
+        '''Iterate over the (timestamp_ns, packet) pairs of the records
+        with the given direction.
+
+        '''
+        for i in self.indices(direction):
+            t, d, packet = self[i]
+            yield t, packet
+
+    @property
+    def duration(self):
+        '''Time in seconds between the first and last records.'''
+        if self._count < 2:
+            return 0.0
+        return (self.timestamp(self._count - 1) - self.timestamp(0)) / 1e9
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ReplayTransport(AmpTransport):
+
+    '''Transport which plays back the packets received in a capture, so
+    that a BlackstarIDAmp behaves as it did while the capture was
+    recorded. ``capture`` is a CaptureReader or the path of a capture
+    file.
+
+    If the capture contains sent packets, playback starts when the
+    first packet is written, which normally is the startup packet, so
+    that the amp's response isn't lost to drain. Packets received
+    before the first sent packet in the capture are skipped.
+    Otherwise playback starts on the first read.
+
+    Packets are returned by read at their original times scaled by
+    1 / ``speed``, or as fast as possible if ``speed`` is None. When
+    the capture is exhausted, it starts again if ``loop`` is True and
+    otherwise reads time out. Written packets are discarded.
+
+    '''
+
+    def __init__(self, capture, speed=1.0, loop=False):
+        super(ReplayTransport, self).__init__()
+        if not isinstance(capture, CaptureReader):
+            capture = CaptureReader(capture)
+        self.capture = capture
+        self.speed = speed
+        self.loop = loop
+
+        # Indices of the records to play back, and the time
+        # corresponding to the start of playback
+        sent = capture.indices(PACKET_SENT)
+        if len(sent) > 0:
+            self._epoch = capture.timestamp(sent[0])
+            self._records = array.array('L', [
+                i for i in capture.indices(PACKET_RECEIVED) if i > sent[0]])
+        else:
+            self._records = capture.indices(PACKET_RECEIVED)
+            if len(self._records) > 0:
+                self._epoch = capture.timestamp(self._records[0])
+        self._triggered = len(sent) == 0
+
+        self._index = 0
+        self._start = None
+        self._wakeup = threading.Event()
+
+    def open(self, vendor):
+        self.product_id = self.capture.product_id
+        self.rewind()
+
+    def close(self):
+        self.product_id = None
+
+    def rewind(self):
+        self._index = 0
+        self._start = None
+
+    @property
+    def finished(self):
+        return self._index >= len(self._records) and not self.loop
+
+    def _idle(self, timeout):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        raise NoDataAvailable
+
+    def read(self, timeout=None):
+        if timeout is None:
+            timeout = 1.0
+
+        if not self._triggered:
+            self._idle(timeout)
+
+        if self._index >= len(self._records):
+            if not self.loop or not self._records:
+                self._idle(timeout)
+            self.rewind()
+
+        t, direction, packet = self.capture[self._records[self._index]]
+        if self.speed is not None:
+            now = time.monotonic()
+            offset = (t - self._epoch) / 1e9 / self.speed
+            if self._start is None:
+                self._start = now - offset
+            due = self._start + offset
+            if due > now:
+                if due - now > timeout:
+                    self._idle(timeout)
+                time.sleep(due - now)
+
+        self._index += 1
+        return packet
+
+    def write(self, data):
+        if not self._triggered:
+            self._triggered = True
+            self._start = time.monotonic()
+            self._wakeup.set()
+        return len(data)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+
+def record(args):
+    amp = BlackstarIDAmp()
+    amp.connect()
+    amp.drain()
+
+    with CaptureWriter(args.file, amp.transport.product_id) as writer:
+        amp.add_tap(writer)
+        amp.startup()
+        print('Recording to {0}, press Ctrl-C to stop'.format(args.file))
+        try:
+            while True:
+                try:
+                    data = amp.read_data(0.5)
+                except NoDataAvailable:
+                    continue
+                if args.verbose:
+                    print(data)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            amp.remove_tap(writer)
+            amp.disconnect()
+        print('Recorded {0} packets'.format(writer.count))
+
+
+def replay(args):
+    transport = ReplayTransport(args.file, speed=args.speed)
+    amp = BlackstarIDAmp(transport=transport)
+    amp.connect()
+    # A capture made by record starts with the startup packet, and
+    # playback waits for it to be sent again
+    amp.startup()
+    count = 0
+    start = time.monotonic()
+    while not transport.finished:
+        try:
+            data = amp.read_data(0.5)
+        except NoDataAvailable:
+            continue
+        count += 1
+        if not args.quiet:
+            print(data)
+    print('Replayed {0} updates in {1:.3f}s'.format(
+        count, time.monotonic() - start))
+
+
+def dump(args):
+    with CaptureReader(args.file) as capture:
+        print('{0}: {1} packets over {2:.3f}s, product ID {3:04X}'.format(
+            args.file, len(capture), capture.duration, capture.product_id))
+        if len(capture) == 0:
+            return
+        t0 = capture[0][0]
+        for t, direction, packet in capture:
+            header = '{0:12.6f} {1} '.format(
+                (t - t0) / 1e9, '>' if direction == PACKET_SENT else '<')
+            lines = format_packet(packet).split('\n')
+            print(header + lines[0])
+            for line in lines[1:]:
+                print(' ' * len(header) + line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blackstarid.capture',
+        description='Record and replay captures of amplifier traffic')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('record', help='record a capture from a connected amp')
+    p.add_argument('file')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='print the data decoded while recording')
+    p.set_defaults(fn=record)
+
+    p = sub.add_parser('replay', help='decode a capture in real time')
+    p.add_argument('file')
+    p.add_argument('-s', '--speed', type=float, default=1.0,
+                   help='replay speed relative to the original, or 0 for '
+                   'as fast as possible')
+    p.add_argument('-q', '--quiet', action='store_true',
+                   help="don't print the decoded data")
+    p.set_defaults(fn=replay)
+
+    p = sub.add_parser('dump', help='print the packets in a capture')
+    p.add_argument('file')
+    p.set_defaults(fn=dump)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'speed', None) == 0:
+        args.speed = None
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,666 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''A daemon which owns the connection to an amplifier and shares it
+with any number of local clients over a Unix socket. Start it with:
+
+    python3 -m blackstarid.daemon serve
+
+and then, from any number of processes:
+
+    client = DaemonClient()
+    client.subscribe()
+    client.set_control('gain', 64)
+    event = client.get_event()
+
+The Outsider GUI can use the daemon rather than the amp with
+outsider --daemon, and any BlackstarIDAmp can with DaemonTransport.
+
+The protocol is newline delimited JSON. A request is an object with
+an 'op' member naming the operation, its parameters as further
+members, and optionally an 'id' member. A request with an id is
+answered with {"id": ..., "result": ...} or {"id": ..., "error":
+"..."}; one without gets no answer. The operations are those of the
+_op_* methods of AmpDaemon.
+
+Clients which subscribe receive {"event": {...}} for each dictionary
+of data decoded from the amp, with presets given as dictionaries and
+bytes as hex, and with raw=true also {"packet": "<hex>"} for each
+packet received. Events for a client are queued up to a limit, beyond
+which they are dropped and the client is sent {"dropped": N} once it
+catches up, so a slow client never holds up the amp or the other
+clients.
+
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+
+from blackstarid.asyncamp import AsyncBlackstarIDAmp
+from blackstarid.blackstarid import (AmpTransport, BlackstarIDAmpPreset,
+                                     NoDataAvailable, NotConnectedError,
+                                     PACKET_RECEIVED)
+
+logger = logging.getLogger('outsider.blackstarid.daemon')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+def socket_path():
+    '''Return the default path of the daemon's socket, in
+    $XDG_RUNTIME_DIR if set.
+
+    '''
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'blackstarid.sock')
+    return '/tmp/blackstarid-{0}.sock'.format(os.getuid())
+
+
+def event_to_json(data):
+    '''Return a JSON serialisable copy of a dictionary returned by
+    BlackstarIDAmp.read_data.
+
+    '''
+    result = {}
+    for key, value in data.items():
+        if isinstance(value, BlackstarIDAmpPreset):
+            value = value.as_dict()
+        elif isinstance(value, (bytes, bytearray)):
+            value = bytes(value).hex()
+        result[key] = value
+    return result
+
+
+def _line(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode()
+
+
+class DaemonError(Exception):
+    pass
+
+
+class _Client(object):
+
+    # One connection to the daemon, with its queue of event lines.
+    # Answers to requests bypass the queue, so are never dropped.
+
+    def __init__(self, reader, writer, queue_size):
+        self.reader = reader
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.events = False
+        self.raw = False
+        self.dropped = 0
+        self.name = writer.get_extra_info('peername') or 'client'
+
+    def post(self, line):
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def send(self, line):
+        self.writer.write(line)
+        await self.writer.drain()
+
+    async def send_events(self):
+        while True:
+            line = await self.queue.get()
+            if line is None:
+                return
+            if self.dropped:
+                dropped = self.dropped
+                self.dropped = 0
+                logger.debug('Dropped {0} events for a slow client'.format(
+                    dropped))
+                self.writer.write(_line({'dropped': dropped}))
+            await self.send(line)
+
+
+class _PacketTap(object):
+
+    # Amp tap passing received packets to the event loop
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+
+    def record(self, direction, packet):
+        if direction == PACKET_RECEIVED:
+            self.loop.call_soon_threadsafe(self.callback, bytes(packet))
+
+
+class AmpDaemon(object):
+
+    '''Serves the amp ``amp``, a BlackstarIDAmp which by default uses
+    USB, on the Unix socket at ``path``. ``queue_size`` is the number
+    of events which may be waiting to be sent to a client before
+    further events are dropped. If ``latency`` is True the amp's
+    answers to all clients are timed, for the latency operation.
+
+    '''
+
+    def __init__(self, amp=None, path=None, queue_size=256, latency=False):
+        self.amp = AsyncBlackstarIDAmp(amp)
+        self.path = path or socket_path()
+        self.queue_size = queue_size
+        self.latency = latency
+        self.clients = set()
+        self._server = None
+        self._events_task = None
+        self._tap = None
+        self._stopped = None
+
+    def _check_socket(self):
+        # Remove a socket left behind by a daemon which died, but not
+        # one which is in use
+        if not os.path.exists(self.path):
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.path)
+        except OSError:
+            os.unlink(self.path)
+        else:
+            raise DaemonError('A daemon is already listening on {0}'.format(
+                self.path))
+        finally:
+            s.close()
+
+    async def start(self):
+        '''Connect to the amp and start listening for clients.'''
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._check_socket()
+        await self.amp.connect()
+        if self.latency:
+            self.amp.amp.enable_latency()
+        self._tap = _PacketTap(loop, self._packet_from_amp)
+        self.amp.amp.add_tap(self._tap)
+        self._events_task = loop.create_task(self._fan_out())
+        await self.amp.startup()
+
+        old_umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._serve_client, path=self.path)
+        finally:
+            os.umask(old_umask)
+        logger.info('Serving {0} on {1}'.format(self.amp.model, self.path))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        for client in list(self.clients):
+            client.writer.close()
+        if self._tap is not None:
+            self.amp.amp.remove_tap(self._tap)
+            self._tap = None
+        await self.amp.disconnect()
+        if self._events_task is not None:
+            await self._events_task
+            self._events_task = None
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def serve_forever(self):
+        await self.start()
+        await self._stopped.wait()
+
+    async def _fan_out(self):
+        async for event in self.amp.events():
+            line = None
+            for client in self.clients:
+                if client.events:
+                    if line is None:
+                        line = _line({'event': event_to_json(event)})
+                    client.post(line)
+
+    def _packet_from_amp(self, packet):
+        line = None
+        for client in self.clients:
+            if client.raw:
+                if line is None:
+                    line = _line({'packet': packet.hex()})
+                client.post(line)
+
+    async def _serve_client(self, reader, writer):
+        client = _Client(reader, writer, self.queue_size)
+        self.clients.add(client)
+        sender = asyncio.get_running_loop().create_task(client.send_events())
+        logger.debug('Client connected, {0} clients'.format(len(self.clients)))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._handle(client, line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+            logger.debug('Client disconnected, {0} clients'.format(
+                len(self.clients)))
+
+    async def _handle(self, client, line):
+        request_id = None
+        try:
+            request = json.loads(line.decode())
+            request_id = request.pop('id', None)
+            op = request.pop('op')
+            fn = getattr(self, '_op_' + op, None)
+            if fn is None:
+                raise DaemonError('Unknown operation {0}'.format(op))
+            result = await fn(client, **request)
+        except Exception as e:
+            if request_id is None:
+                logger.warning('Request failed: {0}'.format(e))
+                return
+            await client.send(_line({'id': request_id, 'error': str(e)}))
+        else:
+            if request_id is not None:
+                await client.send(_line({'id': request_id, 'result': result}))
+
+    # The operations clients may request
+
+    async def _op_info(self, client):
+        amp = self.amp.amp
+        return {'model': amp.model,
+                'product_id': amp.transport.product_id,
+                'clients': len(self.clients),
+                'state_version': amp.state.version}
+
+    async def _op_subscribe(self, client, events=True, raw=False):
+        client.events = events
+        client.raw = raw
+
+    async def _op_unsubscribe(self, client):
+        client.events = False
+        client.raw = False
+
+    async def _op_state(self, client):
+        version, settings = self.amp.state.snapshot()
+        return {'version': version, 'settings': settings}
+
+    async def _op_startup(self, client):
+        await self.amp.startup()
+
+    async def _op_set_control(self, client, control, value):
+        await self.amp.set_control(control, value)
+
+    async def _op_queue_control(self, client, control, value):
+        self.amp.amp.queue_control(control, value)
+
+    async def _op_apply_settings(self, client, settings, force=False):
+        return await self.amp.apply_settings(settings, force)
+
+    async def _op_select_preset(self, client, preset):
+        await self.amp.select_preset(preset)
+
+    async def _op_get_preset_name(self, client, preset, timeout=1.0):
+        return await self.amp.get_preset_name(preset, timeout)
+
+    async def _op_set_preset_name(self, client, preset, name):
+        await self.amp.set_preset_name(preset, name)
+
+    async def _op_send(self, client, packet):
+        await self.amp.send_packet(bytes.fromhex(packet))
+
+    async def _op_latency(self, client, reset=False):
+        latency = self.amp.amp.latency
+        if latency is None:
+            raise DaemonError('Latency is not being measured; start the '
+                              'daemon with --latency')
+        summary = latency.summary()
+        if reset:
+            latency.reset()
+        return summary
+
+
+class DaemonClient(object):
+
+    '''Blocking client of an AmpDaemon listening at ``path``. Answers to
+    requests are waited for at most ``timeout`` seconds. Events and
+    packets the client has subscribed to are read by a background
+    thread and collected in the queues events and packets, in which
+    None marks the connection having closed. Each queue holds at most
+    ``queue_size`` entries; beyond that the oldest are dropped, so a
+    client which subscribes and doesn't read can't grow without
+    limit.
+
+    '''
+
+    def __init__(self, path=None, timeout=5.0, queue_size=1024):
+        self.path = path or socket_path()
+        self.timeout = timeout
+        self.events = queue.Queue(queue_size)
+        self.packets = queue.Queue(queue_size)
+        # Number of events and packets dropped because the client
+        # didn't keep up, by the daemon or by this client
+        self.dropped = 0
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(self.path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rb')
+        self._write_lock = threading.Lock()
+        self._next_id = 1
+        self._pending = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._read, daemon=True,
+                                        name='DaemonClient')
+        self._thread.start()
+
+    def _write(self, message):
+        with self._write_lock:
+            self._sock.sendall(_line(message))
+
+    def _post(self, q, item):
+        # Called from the reading thread, the only one putting items
+        # on the queues, so once there is room the put succeeds
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                q.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def _read(self):
+        try:
+            for line in self._file:
+                message = json.loads(line.decode())
+                if 'packet' in message:
+                    self._post(self.packets, bytes.fromhex(message['packet']))
+                elif 'event' in message:
+                    self._post(self.events, message['event'])
+                elif 'dropped' in message:
+                    self.dropped += message['dropped']
+                else:
+                    waiter = self._pending.pop(message.get('id'), None)
+                    if waiter is not None:
+                        waiter[1] = message
+                        waiter[0].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._closed = True
+            for waiter in list(self._pending.values()):
+                waiter[0].set()
+            self._post(self.events, None)
+            self._post(self.packets, None)
+
+    def call(self, op, **params):
+        '''Make the request ``op`` and return its result, raising
+        DaemonError if it fails.
+
+        '''
+        if self._closed:
+            raise DaemonError('Connection to daemon closed')
+        with self._write_lock:
+            request_id = self._next_id
+            self._next_id += 1
+        waiter = [threading.Event(), None]
+        self._pending[request_id] = waiter
+        params['op'] = op
+        params['id'] = request_id
+        self._write(params)
+        if not waiter[0].wait(self.timeout):
+            self._pending.pop(request_id, None)
+            raise DaemonError('No answer to {0} from daemon'.format(op))
+        answer = waiter[1]
+        if answer is None:
+            raise DaemonError('Connection to daemon closed')
+        if 'error' in answer:
+            raise DaemonError(answer['error'])
+        return answer.get('result')
+
+    def send(self, op, **params):
+        '''Make the request ``op`` without waiting for an answer.'''
+        params['op'] = op
+        self._write(params)
+
+    def get_event(self, timeout=None):
+        '''Return the next event, waiting at most ``timeout`` seconds.
+        Raises queue.Empty on timeout, and returns None once the
+        connection has closed.
+
+        '''
+        return self.events.get(timeout=timeout)
+
+    def subscribe(self, events=True, raw=False):
+        return self.call('subscribe', events=events, raw=raw)
+
+    def info(self):
+        return self.call('info')
+
+    def state(self):
+        return self.call('state')['settings']
+
+    def set_control(self, control, value):
+        return self.call('set_control', control=control, value=value)
+
+    def queue_control(self, control, value):
+        return self.call('queue_control', control=control, value=value)
+
+    def select_preset(self, preset):
+        return self.call('select_preset', preset=preset)
+
+    def get_preset_name(self, preset):
+        return self.call('get_preset_name', preset=preset)
+
+    def latency(self, reset=False):
+        '''Return the summary of the daemon's LatencyMonitor, see
+        LatencyMonitor.summary, optionally resetting it.
+
+        '''
+        return self.call('latency', reset=reset)
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join()
+
+
+class DaemonTransport(AmpTransport):
+
+    '''Transport reaching the amp through an AmpDaemon listening at
+    ``path``, so that a BlackstarIDAmp can share the amp with other
+    clients. Every packet the amp sends is received, including the
+    responses to other clients' requests.
+
+    '''
+
+    def __init__(self, path=None):
+        super(DaemonTransport, self).__init__()
+        self.path = path
+        self.client = None
+
+    def open(self, vendor):
+        try:
+            self.client = DaemonClient(self.path)
+        except OSError as e:
+            raise NotConnectedError('Could not connect to daemon: {0}'.format(e))
+        self.product_id = self.client.info()['product_id']
+        self.client.subscribe(events=False, raw=True)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.product_id = None
+
+    def read(self, timeout=None):
+        if timeout is None:
+            timeout = 1.0
+        try:
+            packet = self.client.packets.get(timeout=timeout)
+        except queue.Empty:
+            raise NoDataAvailable
+        if packet is None:
+            # Closed, or woken up
+            raise NoDataAvailable
+        return packet
+
+    def write(self, data):
+        self.client.send('send', packet=bytes(data).hex())
+        return len(data)
+
+    def wakeup(self):
+        if self.client is not None:
+            try:
+                self.client.packets.put_nowait(None)
+            except queue.Full:
+                # A read won't block while packets are waiting
+                pass
+
+
+def serve(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    daemon = AmpDaemon(path=args.socket, queue_size=args.queue_size,
+                       latency=args.latency)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            signum, lambda: loop.create_task(daemon.stop()))
+    try:
+        loop.run_until_complete(daemon.serve_forever())
+    except (NotConnectedError, DaemonError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def monitor(args):
+    client = DaemonClient(args.socket)
+    info = client.info()
+    print('Connected to {0}, {1} clients'.format(info['model'],
+                                                 info['clients']))
+    client.subscribe()
+    try:
+        while True:
+            event = client.get_event()
+            if event is None:
+                break
+            print(event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+def set_control(args):
+    client = DaemonClient(args.socket)
+    try:
+        client.set_control(args.control, args.value)
+    finally:
+        client.close()
+
+
+def latency(args):
+    from blackstarid.latency import format_summary
+    client = DaemonClient(args.socket)
+    try:
+        summary = client.latency(args.reset)
+    finally:
+        client.close()
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print(format_summary(summary))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='blackstarid-daemon',
+        description='Share an amplifier between several programs')
+    parser.add_argument('--socket', help='path of the daemon socket, by '
+                        'default {0}'.format(socket_path()))
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('serve', help='connect to the amp and serve clients')
+    p.add_argument('--queue-size', type=int, default=256,
+                   help='events queued for a client before dropping')
+    p.add_argument('--latency', action='store_true',
+                   help="time the amp's answers, see the latency command")
+    p.set_defaults(fn=serve)
+
+    p = sub.add_parser('monitor', help='print the events from the amp')
+    p.set_defaults(fn=monitor)
+
+    p = sub.add_parser('set', help='set a control')
+    p.add_argument('control')
+    p.add_argument('value', type=int)
+    p.set_defaults(fn=set_control)
+
+    p = sub.add_parser('latency', help="print histograms of the amp's "
+                       'latency, if the daemon was started with --latency')
+    p.add_argument('--reset', action='store_true',
+                   help='start timing afresh')
+    p.add_argument('--json', action='store_true',
+                   help='print the summary as JSON')
+    p.set_defaults(fn=latency)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    try:
+        return args.fn(args)
+    except (OSError, DaemonError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
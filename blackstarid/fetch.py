@@ -0,0 +1,264 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+import collections
+import logging
+import threading
+import time
+
+from blackstarid.bank import PresetBank
+
+logger = logging.getLogger('outsider.blackstarid.fetch')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class _PresetFetch(object):
+
+    '''Base class for fetching data for a set of presets from an amp,
+    keeping a bounded number of requests in flight and matching each
+    reply to its request by preset number. Requests which go
+    unanswered are retried.
+
+    Subclasses set name and reply_key, the key of the read_data
+    dictionary holding replies, and implement _request, _preset_of
+    and _store.
+
+    '''
+
+    name = 'PresetFetch'
+    reply_key = None
+
+    def __init__(self, amp, presets=None, window=8, timeout=0.25, retries=3):
+        if presets is None:
+            presets = range(1, 129)
+        if window < 1:
+            raise ValueError('Window must be at least 1')
+
+        self.amp = amp
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+
+        self.failed = []
+        self.requests_sent = 0
+        self.started = None
+        self.finished = None
+
+        self._queue = collections.deque(presets)
+        self._total = len(self._queue)
+        # Maps preset number to [deadline, attempts]
+        self._in_flight = {}
+        self._received = set()
+        self._callbacks = []
+        self._cond = threading.Condition()
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.monotonic()
+        self.amp.add_listener(self._data_from_amp)
+        self._thread = threading.Thread(target=self._run,
+                                        name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def elapsed(self):
+        '''Seconds from starting until completion, or until now if not yet
+        complete.
+
+        '''
+        if self.started is None:
+            return None
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    @property
+    def progress(self):
+        '''Tuple of the number of replies received and the number requested.'''
+        return len(self._received), self._total
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        '''Wait for the fetch to complete. Returns True if it has.'''
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn):
+        '''Call fn(fetch) when the fetch completes. The callback is called
+        immediately if the fetch has already completed, and otherwise
+        from the fetch's thread.
+
+        '''
+        with self._cond:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def cancel(self):
+        '''Stop fetching. Presets not yet received are marked as failed.'''
+        with self._cond:
+            self.failed.extend(self._in_flight)
+            self.failed.extend(p for p in self._queue if p not in self._received)
+            self._queue.clear()
+            self._in_flight.clear()
+            self._cond.notify()
+
+    def _data_from_amp(self, data):
+        # Called in the thread reading from the amp
+        try:
+            reply = data[self.reply_key]
+        except KeyError:
+            return
+
+        preset = self._preset_of(reply)
+        with self._cond:
+            if preset in self._in_flight:
+                del self._in_flight[preset]
+                self._received.add(preset)
+                self._store(preset, reply)
+                self._cond.notify()
+
+    def _send(self, preset):
+        try:
+            self._request(preset)
+        except Exception:
+            logger.exception('{0}: request for preset {1} failed'.format(
+                self.name, preset))
+        self.requests_sent += 1
+
+    def _run(self):
+        while True:
+            to_send = []
+            with self._cond:
+                now = time.monotonic()
+
+                for preset, request in list(self._in_flight.items()):
+                    if request[0] <= now:
+                        if request[1] > self.retries:
+                            logger.warning('{0}: no reply for preset {1}'.format(
+                                self.name, preset))
+                            del self._in_flight[preset]
+                            self.failed.append(preset)
+                        else:
+                            request[0] = now + self.timeout
+                            request[1] += 1
+                            to_send.append(preset)
+
+                while self._queue and len(self._in_flight) < self.window:
+                    preset = self._queue.popleft()
+                    if preset in self._received:
+                        continue
+                    self._in_flight[preset] = [now + self.timeout, 1]
+                    to_send.append(preset)
+
+                if not to_send:
+                    if not self._in_flight and not self._queue:
+                        break
+                    deadline = min(r[0] for r in self._in_flight.values())
+                    self._cond.wait(max(0.0, deadline - now))
+                    continue
+
+            for preset in to_send:
+                self._send(preset)
+
+        self.amp.remove_listener(self._data_from_amp)
+
+        with self._cond:
+            self.finished = time.monotonic()
+            self.failed.extend(p for p in self._queue if p not in self._received)
+            self.failed.sort()
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        logger.debug('{0}: {1} presets in {2:.3f}s with {3} requests'.format(
+            self.name, len(self._received), self.elapsed, self.requests_sent))
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception('Error in {0} callback'.format(self.name))
+
+
+class PresetNameFetch(_PresetFetch):
+
+    '''Fetches the names of a set of presets, using 0x02/0x04 requests
+    and replies. Normally created with
+    BlackstarIDAmp.fetch_preset_names.
+
+    Once complete, names holds the names of all 128 presets, with None
+    for those which weren't fetched, and failed holds the numbers of
+    the presets whose names couldn't be fetched.
+
+    '''
+
+    name = 'PresetNameFetch'
+    reply_key = 'preset_name'
+
+    def __init__(self, *args, **kwargs):
+        super(PresetNameFetch, self).__init__(*args, **kwargs)
+        self.names = [None] * 128
+
+    def _request(self, preset):
+        self.amp.get_preset_name(preset)
+
+    def _preset_of(self, reply):
+        return reply[0]
+
+    def _store(self, preset, reply):
+        self.names[preset - 1] = reply[1]
+
+
+class PresetSettingsFetch(_PresetFetch):
+
+    '''Fetches the settings of a set of presets, using 0x02/0x05
+    requests and replies. Normally created with
+    BlackstarIDAmp.fetch_preset_settings.
+
+    Once complete, bank is a PresetBank holding the settings which
+    were received, and failed holds the numbers of the presets whose
+    settings couldn't be fetched.
+
+    '''
+
+    name = 'PresetSettingsFetch'
+    reply_key = 'preset_settings'
+
+    def __init__(self, *args, **kwargs):
+        super(PresetSettingsFetch, self).__init__(*args, **kwargs)
+        self.bank = PresetBank()
+
+    def _request(self, preset):
+        self.amp.request_preset_settings(preset)
+
+    def _preset_of(self, reply):
+        return reply.preset_number
+
+    def _store(self, preset, reply):
+        self.bank.update(reply)
@@ -0,0 +1,482 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Histograms of the time the amp takes to answer, for each control
+and each kind of request. For example:
+
+    latency = amp.enable_latency()
+    ...
+    print(latency.format())
+
+or, to measure an attached amp, or the amp behind blackstarid-daemon:
+
+    python3 -m blackstarid.latency --count 50
+    python3 -m blackstarid.latency --daemon --listen 30
+
+The amp echoes every control write, so the time from a write to its
+echo is the round trip for that control. Requests for the startup
+reply, a preset's name or settings and preset selection are timed to
+their replies. A program displaying the amp's settings can also
+report when it has shown the controls turned on the amp, with
+displayed, to time the whole path from knob to screen.
+
+'''
+
+import argparse
+import array
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+
+from blackstarid.blackstarid import BlackstarIDAmp, PACKET_SENT
+
+logger = logging.getLogger('outsider.blackstarid.latency')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class LatencyHistogram(object):
+
+    '''Histogram of latencies in the manner of HdrHistogram. Latencies
+    are recorded in whole microseconds: exactly below
+    2**sub_bucket_bits, and above that in buckets whose width grows
+    with the latency, so that any value reported is within
+    2**-(sub_bucket_bits - 1) of the true one. A latency of a minute
+    needs fewer than 1500 counts.
+
+    Not locked; LatencyMonitor serialises access to its histograms.
+
+    '''
+
+    sub_bucket_bits = 7
+
+    # The percentiles reported by summary
+    percentiles = ((50, 'p50'), (90, 'p90'), (99, 'p99'), (99.9, 'p999'))
+
+    def __init__(self):
+        self._counts = array.array('Q')
+        self.count = 0
+        # Sum, minimum and maximum of the recorded values, in
+        # microseconds
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @classmethod
+    def bucket(cls, value):
+        '''Return the index of the bucket holding ``value`` microseconds.'''
+        shift = value.bit_length() - cls.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return (shift << (cls.sub_bucket_bits - 1)) + (value >> shift)
+
+    @classmethod
+    def bucket_range(cls, index):
+        '''Return the lowest and highest values, in microseconds, held by
+        the bucket ``index``.
+
+        '''
+        half = 1 << (cls.sub_bucket_bits - 1)
+        if index < 2 * half:
+            return index, index
+        shift = index // half - 1
+        low = (index - shift * half) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, seconds):
+        '''Record a latency of ``seconds``.'''
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        index = self.bucket(value)
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''Add the latencies recorded in the LatencyHistogram ``other``.'''
+        if not other.count:
+            return
+        counts = self._counts
+        if len(other._counts) > len(counts):
+            counts.extend([0] * (len(other._counts) - len(counts)))
+        for index, n in enumerate(other._counts):
+            counts[index] += n
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        self._counts = array.array('Q')
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def value_at_percentile(self, percentile):
+        '''Return the latency, in seconds, which ``percentile`` percent of
+        the recorded latencies don't exceed, or None if none have been
+        recorded.
+
+        '''
+        if not self.count:
+            return None
+        target = max(1, int(percentile * self.count / 100.0 + 0.5))
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= target:
+                value = self.bucket_range(index)[1]
+                return min(value, self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def buckets(self):
+        '''Return a list of (low, high, count) tuples, with low and high
+        in seconds, for the non-empty buckets in increasing order.
+
+        '''
+        result = []
+        for index, n in enumerate(self._counts):
+            if n:
+                low, high = self.bucket_range(index)
+                result.append((low / 1000000.0, high / 1000000.0, n))
+        return result
+
+    def summary(self):
+        '''Return a dictionary of the count and of the minimum, mean,
+        percentiles and maximum in milliseconds.
+
+        '''
+        result = {'count': self.count}
+        if self.count:
+            result['min_ms'] = self.min / 1000.0
+            result['mean_ms'] = self.total / 1000.0 / self.count
+            for percentile, name in self.percentiles:
+                result[name + '_ms'] = \
+                    self.value_at_percentile(percentile) * 1000
+            result['max_ms'] = self.max / 1000.0
+        return result
+
+
+# The groups of histograms kept by LatencyMonitor, with their titles
+latency_groups = (
+    ('controls', 'Control write to echo'),
+    ('requests', 'Request to reply'),
+    ('display', 'Amp to display'),
+)
+
+
+def format_summary(summary):
+    '''Format ``summary``, as returned by LatencyMonitor.summary, as a
+    table, in milliseconds.
+
+    '''
+    columns = ['min', 'p50', 'p90', 'p99', 'p999', 'max']
+    header = '{0:<24}{1:>8}'.format('', 'count') + ''.join(
+        '{0:>9}'.format(c) for c in columns) + '  (ms)'
+    lines = []
+    for group, title in latency_groups:
+        histograms = summary.get(group)
+        if not histograms:
+            continue
+        lines.append(title)
+        for name in sorted(histograms):
+            h = histograms[name]
+            line = '  {0:<22}{1:>8}'.format(name, h['count'])
+            if h['count']:
+                line += ''.join('{0:>9.3f}'.format(h[c + '_ms'])
+                                for c in columns)
+            lines.append(line)
+    if not lines:
+        return '(no latencies recorded)'
+    lost = summary.get('lost')
+    if lost:
+        lines.append('Unanswered: ' + ', '.join(
+            '{0} {1}'.format(name, lost[name]) for name in sorted(lost)))
+    return '\n'.join([header] + lines)
+
+
+class LatencyMonitor(object):
+
+    '''Amp tap (see BlackstarIDAmp.add_tap) timing the amp's answers.
+    The time of each control write and each request the amp answers
+    is noted, and when the echo or reply arrives the time taken is
+    recorded in a LatencyHistogram: in controls under the control's
+    name, or in requests under the kind of request.
+
+    A request not answered within ``timeout`` seconds is counted as
+    unanswered, in lost. If track_display is True, the arrival of
+    each control change the amp makes of its own accord, for example
+    when a knob is turned, is noted, and displayed records the time
+    until the change is shown in display.
+
+    '''
+
+    # For each request the amp answers, keyed by packet type and
+    # subtype (None for any), its kind and the type and subtype of
+    # the reply, which also repeats the request's third byte unless
+    # that is None
+    request_kinds = {
+        (0x81, None): ('startup', (0x07, None)),
+        (0x02, 0x01): ('select_preset', (0x02, 0x06)),
+        (0x02, 0x04): ('preset_name', (0x02, 0x04)),
+        (0x02, 0x05): ('preset_settings', (0x02, 0x05)),
+    }
+
+    def __init__(self, timeout=2.0):
+        self.timeout = timeout
+        self.track_display = False
+        self.controls = {}
+        self.requests = {}
+        self.display = {}
+        self.lost = collections.Counter()
+
+        # The requests awaiting replies, keyed by the first three
+        # bytes of the reply, mapped to (histograms, name, time sent)
+        self._pending = {}
+        # The time each control changed on the amp, until displayed
+        self._undisplayed = {}
+        self._lock = threading.Lock()
+
+    def _histogram(self, histograms, name):
+        h = histograms.get(name)
+        if h is None:
+            h = histograms[name] = LatencyHistogram()
+        return h
+
+    def record(self, direction, packet):
+        t = time.perf_counter()
+        ptype = packet[0]
+        if direction == PACKET_SENT:
+            if ptype == 0x03:
+                control = BlackstarIDAmp.control_ids.get(packet[1])
+                if control is None:
+                    return
+                key = (0x03, packet[1], packet[2])
+                entry = (self.controls, control, t)
+            else:
+                request = (self.request_kinds.get((ptype, packet[1])) or
+                           self.request_kinds.get((ptype, None)))
+                if request is None:
+                    return
+                kind, (rtype, rsubtype) = request
+                if rsubtype is None:
+                    key = (rtype, None, None)
+                else:
+                    key = (rtype, rsubtype, packet[2])
+                entry = (self.requests, kind, t)
+            with self._lock:
+                # While a write is awaiting its echo, a second write of
+                # the same control can't be told apart from it, so
+                # only the first is timed
+                if key not in self._pending:
+                    self._pending[key] = entry
+            return
+
+        key = (ptype, packet[1], packet[2])
+        with self._lock:
+            entry = self._pending.pop(key, None)
+            if entry is None and ptype == 0x07:
+                entry = self._pending.pop((ptype, None, None), None)
+            if entry is not None:
+                histograms, name, sent = entry
+                if t - sent <= self.timeout:
+                    self._histogram(histograms, name).record(t - sent)
+                    return
+                # The request went unanswered, and this is something
+                # else
+                self.lost[name] += 1
+            if ptype == 0x03 and self.track_display:
+                control = BlackstarIDAmp.control_ids.get(packet[1])
+                if control is not None and control not in self._undisplayed:
+                    self._undisplayed[control] = t
+
+    def displayed(self, controls):
+        '''Record that the latest values of ``controls``, an iterable of
+        control names, have been displayed.
+
+        '''
+        t = time.perf_counter()
+        with self._lock:
+            if not self._undisplayed:
+                return
+            for control in controls:
+                arrived = self._undisplayed.pop(control, None)
+                if arrived is not None:
+                    self._histogram(self.display, control).record(
+                        t - arrived)
+
+    def outstanding(self):
+        '''Return the number of requests awaiting replies.'''
+        with self._lock:
+            return len(self._pending)
+
+    def histograms(self, group):
+        '''Return a copy of the histograms of ``group``, one of
+        'controls', 'requests' and 'display', keyed by name.
+
+        '''
+        source = {'controls': self.controls, 'requests': self.requests,
+                  'display': self.display}[group]
+        result = {}
+        with self._lock:
+            for name, h in source.items():
+                copy = result[name] = LatencyHistogram()
+                copy.merge(h)
+        return result
+
+    def summary(self):
+        '''Return a dictionary, suitable for JSON, holding the summary of
+        each histogram (see LatencyHistogram.summary) keyed by group
+        and name, and the numbers of unanswered requests under 'lost'.
+
+        '''
+        result = {}
+        with self._lock:
+            result['controls'] = dict(
+                (name, h.summary()) for name, h in self.controls.items())
+            result['requests'] = dict(
+                (name, h.summary()) for name, h in self.requests.items())
+            result['display'] = dict(
+                (name, h.summary()) for name, h in self.display.items())
+            result['lost'] = dict(self.lost)
+        return result
+
+    def format(self):
+        return format_summary(self.summary())
+
+    def reset(self):
+        with self._lock:
+            self.controls.clear()
+            self.requests.clear()
+            self.display.clear()
+            self.lost.clear()
+            self._pending.clear()
+            self._undisplayed.clear()
+
+    def dump(self, log=None, level=logging.INFO):
+        '''Write the histograms to the logger ``log``, by default this
+        module's logger, at ``level``.
+
+        '''
+        if log is None:
+            log = logger
+        if log.isEnabledFor(level):
+            log.log(level, 'Amp latency:\n{0}'.format(self.format()))
+
+
+def probe(amp, controls, count, interval=0.01, timeout=0.5):
+    '''Write each of ``controls`` ``count`` times with its current value,
+    so the amp's sound doesn't change, waiting up to ``timeout``
+    seconds for each echo. Something must be reading from ``amp``.
+
+    '''
+    latency = amp.latency
+    for i in range(count):
+        for control in controls:
+            value = amp.state.get(control)
+            if value is None:
+                continue
+            amp.set_control(control, value)
+            deadline = time.monotonic() + timeout
+            while latency.outstanding() and time.monotonic() < deadline:
+                time.sleep(0.001)
+            time.sleep(interval)
+
+
+def main(argv=None):
+    from blackstarid.reader import AmpReader
+
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blackstarid.latency',
+        description='Measure how long the amplifier takes to answer')
+    parser.add_argument('--count', type=int, default=20,
+                        help='writes of each control to time')
+    parser.add_argument('--controls',
+                        help='comma separated controls to write, by default '
+                        'all of them')
+    parser.add_argument('--listen', type=float, default=0,
+                        metavar='SECONDS', help='then carry on timing the '
+                        'packets of other programs for this long')
+    parser.add_argument('--daemon', nargs='?', const='', metavar='SOCKET',
+                        help='reach the amp through blackstarid-daemon')
+    parser.add_argument('--json', action='store_true',
+                        help='print the summary as JSON')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    if args.controls:
+        controls = args.controls.split(',')
+        for control in controls:
+            if control not in BlackstarIDAmp.controls:
+                parser.error('Unknown control {0}'.format(control))
+    else:
+        controls = sorted(c for c in BlackstarIDAmp.controls
+                          if c in BlackstarIDAmp.state_keys)
+
+    transport = None
+    if args.daemon is not None:
+        from blackstarid.daemon import DaemonTransport
+        transport = DaemonTransport(args.daemon or None)
+    amp = BlackstarIDAmp(transport=transport)
+    amp.connect()
+    amp.drain()
+    latency = amp.enable_latency()
+    reader = AmpReader(amp, lambda data: None)
+    reader.start()
+    try:
+        version = amp.state.version
+        amp.startup()
+        amp.state.wait(version, 1.0)
+        probe(amp, controls, args.count)
+        if args.listen:
+            time.sleep(args.listen)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.stop()
+        amp.disconnect()
+
+    if args.json:
+        print(json.dumps(latency.summary(), indent=2, sort_keys=True))
+    else:
+        print(latency.format())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,445 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''A searchable index of a collection of Insider preset files. For
+example:
+
+    library = PresetLibrary()
+    library.import_tree('~/presets')
+    for row in library.search('blues', gain=('>', 100), genre=3):
+        print(row['path'], row['name'])
+    preset = library.preset(row['path'])
+
+The index is an SQLite database, by default in the outsider cache
+directory, with a column for every control and metadata field of a
+preset. Files are parsed in parallel when importing, and only files
+which are new or have changed since the last import are parsed.
+
+'''
+
+import argparse
+import concurrent.futures
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from blackstarid.blackstarid import BlackstarIDAmpPreset
+from blackstarid.cache import cache_directory
+
+logger = logging.getLogger('outsider.blackstarid.library')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+def _parse_preset_file(path):
+    # Runs in a worker process, so returns only picklable data: the
+    # packet and metadata of the preset, or the error message
+    try:
+        ps = BlackstarIDAmpPreset.from_file(path)
+    except (OSError, ValueError) as e:
+        return path, None, None, str(e)
+    metadata = dict((field, getattr(ps, field))
+                    for field in BlackstarIDAmpPreset.metadata_fields)
+    return path, bytes(ps.packet), metadata, None
+
+
+class PresetLibrary(object):
+
+    '''Index of Insider preset files, stored in the SQLite database
+    ``database``. The default is library.sqlite in the outsider cache
+    directory, and ':memory:' gives an index which isn't saved.
+
+    Paths are stored as absolute paths.
+
+    '''
+
+    # Extensions of the files imported by import_tree
+    extensions = ('.rig', '.bsp')
+
+    # Files imported with fewer than this many to parse are parsed in
+    # this process, as starting worker processes would take longer
+    parallel_threshold = 64
+
+    control_columns = tuple(f for f in BlackstarIDAmpPreset.packet_fields
+                            if f != 'preset_number')
+    metadata_columns = BlackstarIDAmpPreset.metadata_fields
+    columns = ('path', 'mtime', 'size') + metadata_columns + control_columns
+
+    # Columns matched by the text argument of search
+    text_columns = ('name', 'creator', 'search_tags', 'about')
+
+    _operators = ('<', '<=', '=', '==', '!=', '>=', '>', 'like')
+
+    def __init__(self, database=None):
+        if database is None:
+            directory = cache_directory()
+            os.makedirs(directory, exist_ok=True)
+            database = os.path.join(directory, 'library.sqlite')
+        self.database = database
+        # The index may be updated by a LibraryWatcher thread while
+        # being searched from another, so access to the database is
+        # serialised with this
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(database, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._create()
+
+    def _create(self):
+        text = set(['path', 'name', 'creator', 'search_tags', 'about', 'track'])
+        defs = []
+        for column in self.columns:
+            if column == 'path':
+                defs.append('path TEXT PRIMARY KEY')
+            elif column == 'mtime':
+                defs.append('mtime REAL')
+            elif column in text:
+                defs.append('{0} TEXT'.format(column))
+            else:
+                defs.append('{0} INTEGER'.format(column))
+        defs.append('packet BLOB')
+
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS presets ({0})'.format(
+                ', '.join(defs)))
+            self._db.execute('CREATE INDEX IF NOT EXISTS presets_name '
+                             'ON presets (name COLLATE NOCASE)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS presets_genre '
+                             'ON presets (genre, subgenre)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM presets').fetchone()[0]
+
+    def _preset_files(self, directory):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in self.extensions:
+                    yield os.path.join(dirpath, filename)
+
+    def _parse(self, paths, workers):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers == 1 or len(paths) < self.parallel_threshold:
+            return map(_parse_preset_file, paths)
+
+        chunksize = max(1, len(paths) // (workers * 8))
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        try:
+            return list(executor.map(_parse_preset_file, paths,
+                                     chunksize=chunksize))
+        finally:
+            executor.shutdown()
+
+    def _store(self, parsed, stats):
+        '''Insert the results of _parse_preset_file, given with the stat
+        result of each file in ``stats``. Returns a list of (path,
+        error) pairs for the files which couldn't be parsed.
+
+        '''
+        failed = []
+        rows = []
+        for path, packet, metadata, error in parsed:
+            if error is not None:
+                logger.warning('Failed to import {0}: {1}'.format(path, error))
+                failed.append((path, error))
+                continue
+            ps = BlackstarIDAmpPreset(bytearray(packet))
+            st = stats[path]
+            row = [path, st.st_mtime, st.st_size]
+            row.extend(metadata[c] for c in self.metadata_columns)
+            row.extend(getattr(ps, c) for c in self.control_columns)
+            row.append(packet)
+            rows.append(row)
+
+        self._db.executemany(
+            'INSERT OR REPLACE INTO presets ({0}, packet) VALUES ({1})'.format(
+                ', '.join(self.columns), ', '.join(['?'] * (len(self.columns) + 1))),
+            rows)
+        return failed
+
+    def _update(self, to_parse, stats, removed, known, unchanged, workers):
+        # Parse and store the files to_parse and delete the entries
+        # removed, returning the result for import_tree and
+        # update_paths
+        with self._db:
+            failed = self._store(self._parse(to_parse, workers), stats)
+            self._db.executemany('DELETE FROM presets WHERE path = ?',
+                                 [(p,) for p in removed])
+
+        failed_paths = set(p for p, error in failed)
+        imported = [p for p in to_parse if p not in failed_paths]
+        return {
+            'added': len([p for p in imported if p not in known]),
+            'updated': len([p for p in imported if p in known]),
+            'unchanged': unchanged,
+            'removed': len(removed),
+            'failed': failed,
+        }
+
+    def import_tree(self, directory, workers=None, prune=True):
+        '''Index the preset files under ``directory``, parsing them with
+        ``workers`` processes (by default one per CPU). Files already
+        indexed whose size and modification time haven't changed are
+        not parsed again. If ``prune`` is True, entries for files under
+        ``directory`` which no longer exist are removed.
+
+        Returns a dictionary giving the numbers of files added,
+        updated, unchanged and removed, and a list of (path, error)
+        pairs for the files which couldn't be imported.
+
+        '''
+        start = time.monotonic()
+        directory = os.path.abspath(os.path.expanduser(directory))
+        prefix = os.path.join(directory, '')
+
+        with self._lock:
+            known = dict(
+                (row[0], (row[1], row[2])) for row in self._db.execute(
+                    'SELECT path, mtime, size FROM presets'))
+
+            stats = {}
+            to_parse = []
+            found = set()
+            unchanged = 0
+            for path in self._preset_files(directory):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.add(path)
+                if known.get(path) == (st.st_mtime, st.st_size):
+                    unchanged += 1
+                    continue
+                stats[path] = st
+                to_parse.append(path)
+
+            removed = []
+            if prune:
+                removed = [p for p in known
+                           if p.startswith(prefix) and p not in found]
+
+            result = self._update(to_parse, stats, removed, known, unchanged,
+                                  workers)
+
+        logger.debug('Imported {0} in {1:.3f}s: {2}'.format(
+            directory, time.monotonic() - start, result))
+        return result
+
+    def update_paths(self, paths, workers=1):
+        '''Bring the entries for the files ``paths`` up to date: files
+        which are new or have changed are parsed and indexed, and
+        entries for files which no longer exist are removed. Paths
+        which aren't preset files are ignored. Returns a dictionary as
+        for import_tree.
+
+        '''
+        paths = set(os.path.abspath(os.path.expanduser(p)) for p in paths)
+
+        with self._lock:
+            known = {}
+            ordered = sorted(paths)
+            for i in range(0, len(ordered), 500):
+                chunk = ordered[i:i + 500]
+                known.update(
+                    (row[0], (row[1], row[2])) for row in self._db.execute(
+                        'SELECT path, mtime, size FROM presets '
+                        'WHERE path IN ({0})'.format(', '.join(['?'] * len(chunk))),
+                        chunk))
+
+            stats = {}
+            to_parse = []
+            removed = []
+            unchanged = 0
+            for path in ordered:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    if path in known:
+                        removed.append(path)
+                    continue
+                if (not os.path.isfile(path) or
+                    os.path.splitext(path)[1].lower() not in self.extensions):
+                    continue
+                if known.get(path) == (st.st_mtime, st.st_size):
+                    unchanged += 1
+                    continue
+                stats[path] = st
+                to_parse.append(path)
+
+            return self._update(to_parse, stats, removed, known, unchanged,
+                                workers)
+
+    def remove_paths(self, paths):
+        '''Remove the entries for ``paths``, and for all files under any of
+        them which are directories. Returns the number of entries
+        removed.
+
+        '''
+        removed = 0
+        with self._lock, self._db:
+            for path in paths:
+                path = os.path.abspath(os.path.expanduser(path))
+                prefix = os.path.join(path, '')
+                cursor = self._db.execute(
+                    'DELETE FROM presets WHERE path = ? OR substr(path, 1, ?) = ?',
+                    (path, len(prefix), prefix))
+                removed += cursor.rowcount
+        return removed
+
+    def _condition(self, column, value):
+        if column not in self.columns:
+            raise ValueError('Unknown preset field {0}'.format(column))
+        if isinstance(value, tuple):
+            op, value = value
+            op = op.lower()
+            if op not in self._operators:
+                raise ValueError('Unknown comparison operator {0}'.format(op))
+        else:
+            op = '='
+        return '{0} {1} ?'.format(column, op), value
+
+    def search(self, text=None, order_by='name', limit=None, **conditions):
+        '''Return a list of the index entries matching all of the given
+        criteria, as sqlite3.Row objects which can be indexed by column
+        name (see columns).
+
+        ``text`` is matched, case insensitively, against any part of the
+        name, creator, search tags or description. Each keyword
+        argument gives a value which a field must equal, or a tuple of
+        a comparison operator and a value, for example gain=('>', 100)
+        or name=('like', 'Clean%').
+
+        '''
+        where = []
+        params = []
+        if text:
+            pattern = '%{0}%'.format(text.replace('\\', '\\\\')
+                                     .replace('%', '\\%').replace('_', '\\_'))
+            where.append('(' + ' OR '.join(
+                "{0} LIKE ? ESCAPE '\\'".format(c) for c in self.text_columns) + ')')
+            params.extend([pattern] * len(self.text_columns))
+        for column, value in sorted(conditions.items()):
+            clause, value = self._condition(column, value)
+            where.append(clause)
+            params.append(value)
+
+        if order_by not in self.columns:
+            raise ValueError('Unknown preset field {0}'.format(order_by))
+
+        sql = 'SELECT {0} FROM presets'.format(', '.join(self.columns))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY {0} COLLATE NOCASE'.format(order_by)
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
+
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def preset(self, path):
+        '''Return the indexed preset for the file ``path`` as a
+        BlackstarIDAmpPreset, including its metadata. Raises KeyError if
+        the file isn't indexed.
+
+        '''
+        path = os.path.abspath(os.path.expanduser(path))
+        with self._lock:
+            row = self._db.execute(
+                'SELECT {0}, packet FROM presets WHERE path = ?'.format(
+                    ', '.join(self.metadata_columns)), (path,)).fetchone()
+        if row is None:
+            raise KeyError(path)
+
+        ps = BlackstarIDAmpPreset(bytearray(row['packet']))
+        for column in self.metadata_columns:
+            setattr(ps, column, row[column])
+        return ps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blackstarid.library',
+        description='Index and search a collection of Insider preset files')
+    parser.add_argument('--database', help='index database to use')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('import', help='index the presets in a directory tree')
+    p.add_argument('directory')
+    p.add_argument('-j', '--jobs', type=int,
+                   help='number of worker processes to use')
+
+    p = sub.add_parser('search', help='search the index')
+    p.add_argument('text', nargs='?',
+                   help='text to find in the name, creator, tags or description')
+    p.add_argument('-w', '--where', action='append', default=[],
+                   metavar='FIELD OP VALUE', nargs=3,
+                   help='condition on a field, for example -w gain ">" 100')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    with PresetLibrary(args.database) as library:
+        if args.command == 'import':
+            start = time.monotonic()
+            result = library.import_tree(args.directory, args.jobs)
+            print('{0} added, {1} updated, {2} unchanged, {3} removed, '
+                  '{4} failed in {5:.2f}s'.format(
+                      result['added'], result['updated'], result['unchanged'],
+                      result['removed'], len(result['failed']),
+                      time.monotonic() - start))
+        else:
+            conditions = {}
+            for field, op, value in args.where:
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+                conditions[field] = (op, value)
+            start = time.monotonic()
+            rows = library.search(args.text, **conditions)
+            elapsed = time.monotonic() - start
+            for row in rows:
+                print('{0}\t{1}'.format(row['name'], row['path']))
+            print('{0} presets found in {1:.1f}ms'.format(
+                len(rows), elapsed * 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Use of several amplifiers attached to the same host. For example:
+
+    manager = AmpManager(callback=print)
+    manager.scan()
+    manager.connect()
+    manager['1-2.4'].set_control('gain', 64)
+    manager.group().select_preset(3)
+    report = manager.group().switch_preset(4)
+    print(report['skew'])
+    manager.close()
+
+Each amp is identified by the bus and port it is attached to, and
+has its own reader thread and writer thread, so that an amp which is
+slow to respond doesn't hold up the others.
+
+'''
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+from blackstarid.blackstarid import (BlackstarIDAmp, NotConnectedError,
+                                     USBTransport)
+from blackstarid.reader import AmpReader
+
+logger = logging.getLogger('outsider.blackstarid.manager')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class AmpGroupError(Exception):
+
+    '''Raised when an operation on an AmpGroup fails for some of the
+    amps. ``errors`` maps the IDs of those amps to the exceptions
+    raised, and ``results`` holds the results for the others.
+
+    '''
+
+    def __init__(self, errors, results):
+        super(AmpGroupError, self).__init__(
+            'Failed for {0}: {1}'.format(
+                ', '.join(sorted(errors)),
+                '; '.join('{0}: {1}'.format(k, errors[k])
+                          for k in sorted(errors))))
+        self.errors = errors
+        self.results = results
+
+
+class ManagedAmp(object):
+
+    '''An amp of an AmpManager: the BlackstarIDAmp, its ID and the
+    threads reading from and writing to it.
+
+    '''
+
+    def __init__(self, amp_id, amp, model=None):
+        self.amp_id = amp_id
+        self.amp = amp
+        # Known from the USB product ID before connecting
+        self.model = model
+        self.reader = None
+        self.executor = None
+
+    def submit(self, fn, *args):
+        '''Call fn(*args) in this amp's writer thread, returning a
+        concurrent.futures.Future. Calls are made in the order they
+        were submitted.
+
+        '''
+        if self.executor is None:
+            raise NotConnectedError('{0} is not connected'.format(self.amp_id))
+        return self.executor.submit(fn, *args)
+
+
+class AmpGroup(object):
+
+    '''Several amps of an AmpManager addressed together. Each method
+    makes the same call on every amp, in parallel through their writer
+    threads, and returns a dictionary mapping the amp IDs to the
+    results. If the call fails for any amp, AmpGroupError is raised
+    once the calls on the others have completed.
+
+    '''
+
+    def __init__(self, members):
+        self.members = members
+
+    @property
+    def amp_ids(self):
+        return [m.amp_id for m in self.members]
+
+    def __len__(self):
+        return len(self.members)
+
+    def call(self, method, *args):
+        '''Call the BlackstarIDAmp method named ``method`` with ``args`` on
+        every amp in the group.
+
+        '''
+        futures = dict((m.amp_id, m.submit(getattr(m.amp, method), *args))
+                       for m in self.members)
+        results = {}
+        errors = {}
+        for amp_id, future in futures.items():
+            try:
+                results[amp_id] = future.result()
+            except Exception as e:
+                errors[amp_id] = e
+        if errors:
+            raise AmpGroupError(errors, results)
+        return results
+
+    def startup(self):
+        return self.call('startup')
+
+    def set_control(self, control, value):
+        return self.call('set_control', control, value)
+
+    def queue_control(self, control, value):
+        return self.call('queue_control', control, value)
+
+    def select_preset(self, preset):
+        return self.call('select_preset', preset)
+
+    def send_together(self, packets, offsets=None, timeout=1.0):
+        '''Send the packets ``packets``, a dictionary mapping amp IDs to
+        packets built in advance, so that they reach the amps as close
+        together as possible. Each packet is sent from its amp's writer
+        thread, all of which wait at a barrier and are released
+        together.
+
+        ``offsets`` optionally maps amp IDs to delays in seconds
+        applied after release, to compensate for amps which are known
+        to respond late or early. Only the differences between the
+        offsets matter. If an amp's writer is still busy ``timeout``
+        seconds after the others are ready, the send is abandoned and
+        AmpGroupError raised.
+
+        Returns a dictionary holding the times at which each write was
+        issued and completed, in seconds from release, keyed by amp ID
+        under 'issued' and 'completed', and the spread of those times
+        under 'skew' and 'completion_skew'.
+
+        '''
+        members = self.members
+        if not members:
+            return {'issued': {}, 'completed': {}, 'skew': 0.0,
+                    'completion_skew': 0.0}
+        offsets = offsets or {}
+        base = min([offsets.get(m.amp_id, 0.0) for m in members] or [0.0])
+
+        release = []
+        barrier = threading.Barrier(
+            len(members), action=lambda: release.append(time.perf_counter()))
+        timer = time.perf_counter
+
+        def send(member, packet, offset):
+            barrier.wait(timeout)
+            if offset > 0:
+                delay = release[0] + offset - timer()
+                if delay > 0:
+                    time.sleep(delay)
+            issued = timer()
+            member.amp.send_packet(packet)
+            return issued, timer()
+
+        futures = dict(
+            (m.amp_id, m.submit(send, m, packets[m.amp_id],
+                                offsets.get(m.amp_id, 0.0) - base))
+            for m in members)
+
+        times = {}
+        errors = {}
+        for amp_id, future in futures.items():
+            try:
+                times[amp_id] = future.result()
+            except Exception as e:
+                errors[amp_id] = e
+        if errors:
+            barrier.abort()
+            raise AmpGroupError(errors, times)
+
+        t0 = release[0] if release else 0.0
+        issued = dict((k, v[0] - t0) for k, v in times.items())
+        completed = dict((k, v[1] - t0) for k, v in times.items())
+        report = {
+            'issued': issued,
+            'completed': completed,
+            'skew': max(issued.values()) - min(issued.values()),
+            'completion_skew':
+            max(completed.values()) - min(completed.values()),
+        }
+        return report
+
+    def switch_preset(self, preset, offsets=None, timeout=1.0):
+        '''Select ``preset`` on all the amps in the group at as close to
+        the same moment as possible, using send_together. Returns the
+        report from send_together, with the preset under 'preset'.
+
+        '''
+        packet = BlackstarIDAmp.select_preset_packet(preset)
+        report = self.send_together(
+            dict((m.amp_id, packet) for m in self.members), offsets, timeout)
+        report['preset'] = preset
+        logger.debug('Switched {0} amps to preset {1}: skew {2:.1f}us, '
+                     'completion skew {3:.1f}us'.format(
+                         len(self.members), preset, report['skew'] * 1e6,
+                         report['completion_skew'] * 1e6))
+        return report
+
+
+class AmpManager(object):
+
+    '''Manages any number of amplifiers. Amps found by scan, or added
+    with add, are connected with connect, after which each non-empty
+    dictionary of data read from an amp is passed to
+    callback(amp_id, data), called from that amp's reader thread.
+
+    '''
+
+    def __init__(self, callback=None, read_timeout=0.1):
+        self.callback = callback
+        self.read_timeout = read_timeout
+        self._members = {}
+        self._lock = threading.Lock()
+
+    def scan(self):
+        '''Add any attached amps not already added, returning a list of
+        the IDs of those added.
+
+        '''
+        added = []
+        for device in USBTransport.find_devices(BlackstarIDAmp.vendor):
+            amp_id = USBTransport.device_location(device)
+            if amp_id in self._members:
+                continue
+            model = BlackstarIDAmp.amp_models.get(device.idProduct)
+            if model is None:
+                logger.info('Ignoring unknown product ID {0:04X} at {1}'
+                            .format(device.idProduct, amp_id))
+                continue
+            self.add(amp_id, USBTransport(device), model)
+            added.append(amp_id)
+        logger.debug('Found amps: {0}'.format(added))
+        return added
+
+    def add(self, amp_id, transport, model=None):
+        '''Add the amp reached through ``transport`` under the ID
+        ``amp_id``, returning its BlackstarIDAmp.
+
+        '''
+        with self._lock:
+            if amp_id in self._members:
+                raise ValueError('Amp ID {0} already in use'.format(amp_id))
+            amp = BlackstarIDAmp(transport=transport)
+            self._members[amp_id] = ManagedAmp(amp_id, amp, model)
+        return amp
+
+    def remove(self, amp_id):
+        self.disconnect([amp_id])
+        with self._lock:
+            del self._members[amp_id]
+
+    def __getitem__(self, amp_id):
+        return self._members[amp_id].amp
+
+    def __contains__(self, amp_id):
+        return amp_id in self._members
+
+    def __iter__(self):
+        return iter(sorted(self._members))
+
+    def __len__(self):
+        return len(self._members)
+
+    def models(self):
+        '''Return a dictionary mapping amp IDs to models.'''
+        return dict((m.amp_id, m.amp.model or m.model)
+                    for m in self._members.values())
+
+    def _selected(self, amp_ids):
+        if amp_ids is None:
+            return [self._members[k] for k in sorted(self._members)]
+        return [self._members[k] for k in amp_ids]
+
+    def group(self, amp_ids=None):
+        '''Return an AmpGroup for the amps ``amp_ids``, by default all
+        connected amps.
+
+        '''
+        if amp_ids is None:
+            return AmpGroup([m for m in self._selected(None)
+                             if m.amp.connected])
+        return AmpGroup(self._selected(amp_ids))
+
+    def _connect(self, member):
+        member.amp.connect()
+        with member.amp.timed('drain'):
+            member.amp.drain()
+        member.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        callback = self.callback
+        amp_id = member.amp_id
+
+        def data_from_amp(data):
+            if callback is not None:
+                callback(amp_id, data)
+
+        member.reader = AmpReader(member.amp, data_from_amp,
+                                  self.read_timeout,
+                                  name='AmpReader-{0}'.format(amp_id))
+        member.reader.start()
+
+    def connect(self, amp_ids=None):
+        '''Connect to the amps ``amp_ids``, by default all those added and
+        not yet connected, and start reading from them. Amps are
+        connected in parallel. Returns a dictionary mapping the IDs of
+        any amps which couldn't be connected to the exceptions raised.
+
+        '''
+        members = [m for m in self._selected(amp_ids) if not m.amp.connected]
+        if not members:
+            return {}
+
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(len(members)) as pool:
+            futures = dict((m.amp_id, pool.submit(self._connect, m))
+                           for m in members)
+            for amp_id, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.warning('Could not connect to {0}: {1}'.format(
+                        amp_id, e))
+                    errors[amp_id] = e
+        return errors
+
+    def disconnect(self, amp_ids=None):
+        '''Stop reading from and disconnect from the amps ``amp_ids``, by
+        default all of them.
+
+        '''
+        members = self._selected(amp_ids)
+        # Ask all the readers to stop before waiting for any
+        for m in members:
+            if m.reader is not None:
+                m.reader.stop(wait=False)
+        for m in members:
+            if m.reader is not None:
+                m.reader.stop()
+                m.reader = None
+            if m.executor is not None:
+                m.executor.shutdown(wait=True)
+                m.executor = None
+            m.amp.disconnect()
+
+    def close(self):
+        self.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
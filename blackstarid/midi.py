@@ -0,0 +1,418 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Control of an amplifier from MIDI, for example from a foot
+controller:
+
+    python3 -m blackstarid.midi /dev/snd/midiC1D0 --map pedals.json
+
+The MIDI source is anything which produces a raw MIDI byte stream: an
+ALSA rawmidi device, a FIFO, a file or standard input. Control Change
+messages are mapped onto amp controls, scaled to the control's range,
+and Program Change messages select presets. A map file is JSON of
+the form:
+
+    {"channel": 1,
+     "cc": {"4": "gain", "7": {"control": "volume", "max": 100}},
+     "program_offset": 0}
+
+where channel, if given, restricts the bridge to one MIDI channel
+(1-16), and program N selects preset N + program_offset + 1.
+
+A pedal sweep sends far more CC messages than the amp can take, so
+control writes go through a ControlWriteCoalescer: the newest value
+of each control is written, at most max_rate times per second.
+
+'''
+
+import argparse
+import array
+import errno
+import json
+import logging
+import os
+import select
+import stat
+import sys
+import threading
+import time
+
+from blackstarid.blackstarid import BlackstarIDAmp, ControlWriteCoalescer
+from blackstarid.reader import AmpReader
+
+logger = logging.getLogger('outsider.blackstarid.midi')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+CONTROL_CHANGE = 0xb0
+PROGRAM_CHANGE = 0xc0
+
+
+class MidiParser(object):
+
+    '''Incremental parser of a raw MIDI byte stream. Handles running
+    status, real time messages interleaved with other messages and
+    system exclusive messages, which are skipped.
+
+    '''
+
+    def __init__(self):
+        self._status = 0
+        self._needed = 0
+        self._data = []
+        self._sysex = False
+
+    def feed(self, data):
+        '''Parse the bytes ``data``, returning a list of the channel
+        messages completed, as (status, data1, data2) tuples, where
+        data2 is None for messages with a single data byte.
+
+        '''
+        messages = []
+        for b in data:
+            if b >= 0xf8:
+                # Real time messages may appear anywhere, even within
+                # other messages, and don't affect running status
+                continue
+            if b >= 0x80:
+                if b == 0xf0:
+                    self._sysex = True
+                    self._status = 0
+                elif b == 0xf7:
+                    self._sysex = False
+                elif b >= 0xf0:
+                    # System common messages cancel running status
+                    self._sysex = False
+                    self._status = 0
+                else:
+                    self._sysex = False
+                    self._status = b
+                    self._needed = 1 if b & 0xe0 == 0xc0 else 2
+                    self._data = []
+                continue
+            if self._sysex or not self._status:
+                continue
+            self._data.append(b)
+            if len(self._data) == self._needed:
+                if self._needed == 1:
+                    messages.append((self._status, b, None))
+                else:
+                    messages.append((self._status, self._data[0], b))
+                # Running status: further data bytes start another
+                # message with the same status
+                self._data = []
+        return messages
+
+
+class MidiMap(object):
+
+    '''Mapping of MIDI messages to amp controls. ``cc`` maps controller
+    numbers to control names, or to dictionaries with 'control' and
+    optionally 'min' and 'max' members restricting the range the
+    controller covers. ``channel`` (1-16), if given, is the only
+    channel responded to. Program N selects preset N +
+    ``program_offset`` + 1; programs beyond preset 128 are ignored.
+
+    '''
+
+    # General purpose controllers 80-82 for the effect switches, and
+    # the standard volume, effect depth and foot controller numbers
+    default_cc = {
+        4: 'gain',
+        7: 'volume',
+        80: 'mod_switch',
+        81: 'delay_switch',
+        82: 'reverb_switch',
+        91: 'reverb_level',
+        93: 'mod_level',
+    }
+
+    def __init__(self, cc=None, channel=None, program_offset=0):
+        if cc is None:
+            cc = self.default_cc
+        if channel is not None and channel not in range(1, 17):
+            raise ValueError('MIDI channel {0} out of range'.format(channel))
+        self.channel = channel
+        self.program_offset = program_offset
+
+        # For each controller number, the control and the lookup
+        # table from the 128 controller values to control values
+        self._cc = [None] * 128
+        for number, target in cc.items():
+            number = int(number)
+            if number not in range(128):
+                raise ValueError('Controller number {0} out of range'.format(
+                    number))
+            if not isinstance(target, dict):
+                target = {'control': target}
+            control = target['control']
+            if control not in BlackstarIDAmp.controls:
+                raise ValueError('Unknown control {0}'.format(control))
+            low, high = BlackstarIDAmp.control_limits[control]
+            low = max(low, target.get('min', low))
+            high = min(high, target.get('max', high))
+            if high - low == 1:
+                # Switches: on in the top half of the range
+                table = [low if v < 64 else high for v in range(128)]
+            else:
+                table = [low + (v * (high - low) + 63) // 127
+                         for v in range(128)]
+            self._cc[number] = (control, table)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get('cc'), config.get('channel'),
+                   config.get('program_offset', 0))
+
+    def control_change(self, number, value):
+        '''Return the (control, value) pair for a Control Change of
+        controller ``number`` to ``value``, or None if the controller
+        isn't mapped.
+
+        '''
+        entry = self._cc[number]
+        if entry is None:
+            return None
+        return entry[0], entry[1][value]
+
+    def program_change(self, program):
+        '''Return the preset selected by ``program``, or None.'''
+        preset = program + self.program_offset + 1
+        if preset not in range(1, 129):
+            return None
+        return preset
+
+    def accepts(self, status):
+        return self.channel is None or (status & 0x0f) == self.channel - 1
+
+
+class MidiBridge(object):
+
+    '''Thread reading MIDI from ``source``, which is a path or a file
+    descriptor, and controlling ``amp`` as ``midi_map`` (by default
+    MidiMap()) directs. Control writes are made at most ``max_rate``
+    times per second per control.
+
+    The time from a message being read to the resulting write being
+    made is measured, and stats reports it. ``latency_budget`` is
+    the latency, in seconds, beyond which a write counts as late; it
+    should allow for the 1 / max_rate delay of a coalesced write.
+
+    '''
+
+    # Number of recent write latencies kept for stats
+    latency_samples = 1024
+
+    def __init__(self, amp, source, midi_map=None, max_rate=None,
+                 latency_budget=0.025):
+        self.amp = amp
+        self.source = source
+        self.midi_map = midi_map if midi_map is not None else MidiMap()
+        self.max_rate = max_rate or amp.max_write_rate
+        self.latency_budget = latency_budget
+
+        self.messages = 0
+        self.writes = 0
+        self.late = 0
+        self._latencies = array.array('d', bytes(8 * self.latency_samples))
+        self._latency_lock = threading.Lock()
+
+        self._parser = MidiParser()
+        self._coalescer = None
+        self._fd = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _open(self):
+        if isinstance(self.source, int):
+            return self.source, False
+        if self.source == '-':
+            return sys.stdin.fileno(), False
+        flags = os.O_RDONLY
+        if stat.S_ISFIFO(os.stat(self.source).st_mode):
+            # Opening a FIFO for writing as well means it doesn't hit
+            # end of file when the writer closes it, and the open
+            # doesn't wait for a writer
+            flags = os.O_RDWR
+        return os.open(self.source, flags | os.O_NONBLOCK), True
+
+    def start(self):
+        self._fd, self._owned = self._open()
+        self._coalescer = ControlWriteCoalescer(self.amp, self.max_rate,
+                                                on_sent=self._sent)
+        self._coalescer.start()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='MidiBridge')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._coalescer is not None:
+            self._coalescer.stop()
+            self._coalescer = None
+        if self._fd is not None and self._owned:
+            os.close(self._fd)
+        self._fd = None
+
+    def wait(self, timeout=None):
+        '''Wait for the source to reach end of file, which only regular
+        files do. Returns False on timeout.
+
+        '''
+        if self._thread is not None:
+            self._thread.join(timeout)
+            return not self._thread.is_alive()
+        return True
+
+    def _run(self):
+        fd = self._fd
+        while not self._stop.is_set():
+            readable, _, _ = select.select([fd], [], [], 0.2)
+            if not readable:
+                continue
+            try:
+                data = os.read(fd, 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                logger.error('Reading MIDI from {0} failed: {1}'.format(
+                    self.source, e))
+                return
+            if not data:
+                logger.debug('End of MIDI from {0}'.format(self.source))
+                return
+            self.handle(data)
+
+    def handle(self, data):
+        '''Act on the MIDI bytes ``data``.'''
+        midi_map = self.midi_map
+        for status, data1, data2 in self._parser.feed(data):
+            if not midi_map.accepts(status):
+                continue
+            kind = status & 0xf0
+            if kind == CONTROL_CHANGE:
+                target = midi_map.control_change(data1, data2)
+                if target is not None:
+                    self.messages += 1
+                    self._coalescer.put(*target)
+            elif kind == PROGRAM_CHANGE:
+                preset = midi_map.program_change(data1)
+                if preset is not None:
+                    self.messages += 1
+                    try:
+                        start = time.monotonic()
+                        self.amp.select_preset(preset)
+                        self._sent(None, preset, start, time.monotonic())
+                    except Exception:
+                        logger.exception('Selecting preset {0} failed'.format(
+                            preset))
+
+    def _sent(self, control, value, queued, sent):
+        # Called from the coalescer thread with the time each write
+        # was queued, which is as soon as the message was read
+        latency = sent - queued
+        with self._latency_lock:
+            self._latencies[self.writes % self.latency_samples] = latency
+            self.writes += 1
+            if latency > self.latency_budget:
+                self.late += 1
+
+    def stats(self):
+        '''Return a dictionary of the numbers of mapped messages received
+        and writes made, and the median, 99th percentile and maximum
+        latency in milliseconds of the recent writes.
+
+        '''
+        with self._latency_lock:
+            n = min(self.writes, self.latency_samples)
+            latencies = sorted(self._latencies[0:n])
+            result = {'messages': self.messages, 'writes': self.writes,
+                      'late': self.late}
+        if latencies:
+            result['p50_ms'] = latencies[n // 2] * 1000
+            result['p99_ms'] = latencies[int(0.99 * (n - 1))] * 1000
+            result['max_ms'] = latencies[-1] * 1000
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blackstarid.midi',
+        description='Control an amplifier from a MIDI byte stream')
+    parser.add_argument('source', help='ALSA rawmidi device, FIFO or file '
+                        'to read MIDI from, or - for standard input')
+    parser.add_argument('--map', help='JSON file mapping MIDI to controls')
+    parser.add_argument('--channel', type=int,
+                        help='only respond to this MIDI channel (1-16)')
+    parser.add_argument('--rate', type=float,
+                        help='maximum writes per second of each control')
+    parser.add_argument('--daemon', nargs='?', const='', metavar='SOCKET',
+                        help='reach the amp through blackstarid-daemon')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    if args.map is not None:
+        midi_map = MidiMap.from_file(args.map)
+        if args.channel is not None:
+            midi_map.channel = args.channel
+    else:
+        midi_map = MidiMap(channel=args.channel)
+
+    transport = None
+    if args.daemon is not None:
+        from blackstarid.daemon import DaemonTransport
+        transport = DaemonTransport(args.daemon or None)
+    amp = BlackstarIDAmp(transport=transport)
+    amp.connect()
+    amp.drain()
+
+    # The amp echoes every write, and nothing else reads from it, so
+    # read its packets to keep them from piling up
+    reader = AmpReader(amp, lambda data: None)
+    reader.start()
+    bridge = MidiBridge(amp, args.source, midi_map, args.rate)
+    bridge.start()
+    try:
+        while not bridge.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bridge.stop()
+        reader.stop()
+        amp.disconnect()
+        print(bridge.stats())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
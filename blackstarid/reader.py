@@ -0,0 +1,106 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+import logging
+import threading
+
+from blackstarid.blackstarid import NoDataAvailable, NotConnectedError
+
+logger = logging.getLogger('outsider.blackstarid.reader')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class AmpReader(threading.Thread):
+
+    '''Thread which reads data from an amplifier and passes each
+    non-empty dictionary returned by BlackstarIDAmp.read_data to
+    ``callback``. The callback is called in the reader thread.
+
+    Reads block for at most ``timeout`` seconds. Where the transport
+    supports it, stop interrupts a blocked read, and otherwise the
+    timeout bounds how long the thread takes to exit.
+
+    An error reading or decoding a packet is logged, and passed to
+    on_error(exception) if given, and the thread carries on reading
+    after waiting ``timeout`` seconds, so that one bad packet doesn't
+    stop updates from the amp. If the amp has gone away, say because it
+    was unplugged, the error is passed to on_error and the thread
+    exits.
+
+    '''
+
+    def __init__(self, amp, callback, timeout=0.1, name='AmpReader',
+                 on_error=None):
+        super(AmpReader, self).__init__(name=name)
+        self.daemon = True
+        self.amp = amp
+        self.callback = callback
+        self.timeout = timeout
+        self.on_error = on_error
+        self._stop_event = threading.Event()
+
+    def run(self):
+        logger.debug('{0} started'.format(self.name))
+
+        while not self._stop_event.is_set():
+            try:
+                data = self.amp.read_data(self.timeout)
+            except NoDataAvailable:
+                continue
+            except NotConnectedError as e:
+                logger.error('Amp disconnected: {0}'.format(e))
+                self._report_error(e)
+                break
+            except Exception as e:
+                logger.exception('Error reading from amp')
+                self._report_error(e)
+                # Don't spin if the error persists
+                self._stop_event.wait(self.timeout)
+                continue
+
+            if data:
+                try:
+                    self.callback(data)
+                except Exception:
+                    logger.exception('Error in amp data callback')
+
+        logger.debug('{0} exited'.format(self.name))
+
+    def _report_error(self, e):
+        if self.on_error is not None:
+            try:
+                self.on_error(e)
+            except Exception:
+                logger.exception('Error in amp error callback')
+
+    def stop(self, wait=True):
+        '''Ask the thread to exit, and if ``wait`` is True wait until it
+        has.
+
+        '''
+        self._stop_event.set()
+        self.amp.transport.wakeup()
+        if wait and self.is_alive():
+            self.join()
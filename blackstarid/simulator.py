@@ -0,0 +1,343 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''An in-memory simulation of a Blackstar ID amplifier, for exercising
+BlackstarIDAmp without hardware attached. For example:
+
+    amp = BlackstarIDAmp(transport=SimulatedTransport())
+    amp.connect()
+
+The simulated amplifier answers the packets that BlackstarIDAmp sends
+in the same way as an ID:TVP or ID:Core, as far as the protocol is
+understood.
+
+'''
+
+import array
+import collections
+import logging
+import threading
+
+from blackstarid.blackstarid import AmpTransport, BlackstarIDAmp, NoDataAvailable
+
+logger = logging.getLogger('outsider.blackstarid.simulator')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class SimulatedAmp(object):
+
+    '''Model of the state of an amplifier and of the packets it sends in
+    response to the packets it receives. Packets the amp would send
+    are queued and returned, one at a time, by next_packet.
+
+    '''
+
+    # Default read timeout in seconds, matching the PyUSB default
+    default_timeout = 1.0
+
+    # First of the three packets sent in response to the startup
+    # packet, as sent by a TVP60h.
+    identity_packet = [
+        0x07, 0x00, 0x00, 0x03, 0x04, 0x00, 0x01, 0x01,
+        0x40, 0x00, 0x00, 0x00, 0x00, 0x3d, 0x00, 0x00,
+        0x10, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00,
+        0x00, 0x00, 0x00, 0x02, 0x00, 0x01, 0x01, 0x03,
+        0x00, 0x15,
+    ]
+
+    default_controls = {
+        'voice': 2,
+        'gain': 64,
+        'volume': 40,
+        'bass': 64,
+        'middle': 64,
+        'treble': 64,
+        'isf': 64,
+        'tvp_valve': 0,
+        'resonance': 64,
+        'presence': 64,
+        'master_volume': 64,
+        'tvp_switch': 0,
+        'mod_switch': 0,
+        'delay_switch': 0,
+        'reverb_switch': 1,
+        'mod_type': 0,
+        'mod_segval': 0,
+        'mod_manual': 0,
+        'mod_level': 64,
+        'mod_speed': 64,
+        'delay_type': 0,
+        'delay_feedback': 0,
+        'delay_level': 64,
+        'delay_time': 500,
+        'reverb_type': 0,
+        'reverb_size': 8,
+        'reverb_level': 40,
+        'fx_focus': 3,
+    }
+
+    def __init__(self, model='id-tvp'):
+        product_ids = dict(
+            [(val, key) for key, val in BlackstarIDAmp.amp_models.items()])
+        self.product_id = product_ids[model]
+        self.model = model
+
+        self.controls = dict(self.default_controls)
+        self.preset = 1
+        self.manual_mode = 0
+        self.tuner_mode = 0
+
+        self.preset_names = ['Preset {0}'.format(i) for i in range(1, 129)]
+        self.preset_settings = []
+        for i in range(1, 129):
+            packet = self._settings_packet(self.controls)
+            packet[2] = i
+            self.preset_settings.append(packet)
+
+        # Name packets received by the amp when renaming a preset are
+        # held here until the following settings packet arrives
+        self._pending_names = {}
+
+        self._outbox = collections.deque()
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _packet(header):
+        packet = bytearray(64)
+        packet[0:len(header)] = bytearray(header)
+        return packet
+
+    def _settings_packet(self, controls):
+        # The byte address of each control in the settings packets is
+        # the control ID plus 3. The modulation level is also stored
+        # at byte 12.
+        packet = self._packet([0x02, 0x05, self.preset, 0x2a])
+        for control, id in BlackstarIDAmp.controls.items():
+            if control == 'delay_time':
+                value = controls[control]
+                packet[id + 3] = value % 256
+                packet[id + 4] = value // 256
+            elif control != 'delay_time_coarse':
+                packet[id + 3] = controls[control]
+        packet[12] = controls['mod_level']
+        return packet
+
+    def _controls_from_settings(self, packet):
+        controls = {}
+        for control, id in BlackstarIDAmp.controls.items():
+            if control == 'delay_time':
+                controls[control] = packet[id + 3] + 256 * packet[id + 4]
+            elif control != 'delay_time_coarse':
+                controls[control] = packet[id + 3]
+        return controls
+
+    def queue_packet(self, packet):
+        '''Queue a packet to be sent by the amp.'''
+        packet = array.array('B', bytes(packet))
+        with self._cond:
+            self._outbox.append(packet)
+            self._cond.notify()
+
+    def next_packet(self, timeout=None):
+        '''Return the next packet sent by the amp, waiting up to ``timeout``
+        seconds for one to become available. Raises NoDataAvailable on
+        timeout.
+
+        '''
+        if timeout is None:
+            timeout = self.default_timeout
+
+        with self._cond:
+            if not self._outbox:
+                self._cond.wait(timeout)
+            try:
+                return self._outbox.popleft()
+            except IndexError:
+                raise NoDataAvailable
+
+    def wakeup(self):
+        '''Wake any thread waiting in next_packet.'''
+        with self._cond:
+            self._cond.notify_all()
+
+    def pending(self):
+        '''Return the number of packets waiting to be read.'''
+        return len(self._outbox)
+
+    def handle(self, data):
+        '''Process a packet sent to the amp, queueing any response
+        packets.
+
+        '''
+        data = bytearray(data)
+
+        if data[0] == 0x81:
+            self._handle_startup(data)
+        elif data[0] == 0x03:
+            self._handle_control(data)
+        elif data[0] == 0x02:
+            self._handle_preset(data)
+        else:
+            logger.debug('Simulator ignoring packet type {0:02X}'.format(data[0]))
+
+    def _handle_startup(self, data):
+        self.queue_packet(self._packet(self.identity_packet))
+
+        # The packet describing all controls has the same layout as
+        # the preset settings packet
+        packet = self._settings_packet(self.controls)
+        packet[0:4] = [0x03, 0x00, 0x00, 0x2a]
+        self.queue_packet(packet)
+
+        self.queue_packet(self._packet(
+            [0x08, 0x01, 0x00, 0x1b, 0xf0, 0x00, 0x01, 0x01, 0x40]))
+
+    def _handle_control(self, data):
+        control = BlackstarIDAmp.control_ids.get(data[1])
+        if control is None:
+            logger.debug('Simulator ignoring control ID {0:02X}'.format(data[1]))
+            return
+
+        if control == 'delay_time' and data[3] == 0x02:
+            self.controls[control] = data[4] + 256 * data[5]
+        else:
+            self.controls[control] = data[4]
+
+        self.queue_packet(data)
+
+    def _handle_preset(self, data):
+        preset = data[2]
+        if preset not in range(1, 129):
+            return
+
+        if data[1] == 0x01:
+            # Select preset
+            self.preset = preset
+            self.manual_mode = 0
+            self.controls = self._controls_from_settings(
+                self.preset_settings[preset - 1])
+            self.queue_packet(self._packet([0x02, 0x06, preset]))
+        elif data[1] == 0x02:
+            # Preset name, which will be followed by the settings
+            self._pending_names[preset] = data
+        elif data[1] == 0x03:
+            # Preset settings, completing a preset write
+            namepkt = self._pending_names.pop(preset, None)
+            settings = bytearray(data)
+            settings[1] = 0x05
+            settings[3] = 0x2a
+            self.preset_settings[preset - 1] = settings
+            if namepkt is not None:
+                name = bytes(b for b in namepkt[4:25] if b > 0)
+                self.preset_names[preset - 1] = name.decode('ascii')
+            self.queue_packet(self._name_packet(preset))
+            self.queue_packet(settings)
+        elif data[1] == 0x04:
+            self.queue_packet(self._name_packet(preset))
+        elif data[1] == 0x05:
+            self.queue_packet(self.preset_settings[preset - 1])
+
+    def _name_packet(self, preset):
+        packet = self._packet([0x02, 0x04, preset, 0x15])
+        name = self.preset_names[preset - 1].encode('ascii')[0:21]
+        packet[4:4 + len(name)] = name
+        return packet
+
+    def turn_knob(self, control, value, tap=False):
+        '''Simulate the user changing ``control`` to ``value`` on the amp
+        front panel, queueing the packets the amp would send.
+
+        For the delay time, ``tap`` selects whether the tap button was
+        used, which results in a single packet, or the level knob with
+        the tap button held down, which results in a pair of packets
+        (see the implementation note in blackstarid.blackstarid).
+
+        '''
+        id = BlackstarIDAmp.controls[control]
+        self.controls[control] = value
+
+        if control == 'delay_time':
+            fine = value % 256
+            coarse = value // 256
+            if tap:
+                self.queue_packet(
+                    self._packet([0x03, id, 0x00, 0x02, fine, coarse]))
+            else:
+                coarse_id = BlackstarIDAmp.controls['delay_time_coarse']
+                self.queue_packet(self._packet([0x03, id, 0x00, 0x01, fine]))
+                self.queue_packet(
+                    self._packet([0x03, coarse_id, 0x00, 0x02, coarse]))
+        else:
+            self.queue_packet(self._packet([0x03, id, 0x00, 0x01, value]))
+
+    def select_preset_on_amp(self, preset):
+        '''Simulate the user selecting ``preset`` with the amp buttons.'''
+        self._handle_preset(self._packet([0x02, 0x01, preset]))
+
+    def set_tuner_mode(self, mode):
+        '''Simulate the user entering (``mode`` = 1) or leaving (``mode`` =
+        0) tuner mode.
+
+        '''
+        self.tuner_mode = mode
+        self.queue_packet(self._packet([0x08, 0x11, 0x00, 0x01, mode]))
+
+    def tuner_reading(self, note, delta):
+        '''Queue a tuner data packet. ``note`` indexes
+        BlackstarIDAmp.tuner_note and ``delta`` is between -50 and 49.
+
+        '''
+        self.queue_packet(self._packet([0x09, note, 50 - delta]))
+
+
+class SimulatedTransport(AmpTransport):
+
+    '''Transport connecting a BlackstarIDAmp to a SimulatedAmp. If
+    ``amp`` is not specified a new SimulatedAmp of type ``model`` is
+    created.
+
+    '''
+
+    def __init__(self, amp=None, model='id-tvp'):
+        super(SimulatedTransport, self).__init__()
+        if amp is None:
+            amp = SimulatedAmp(model)
+        self.amp = amp
+
+    def open(self, vendor):
+        self.product_id = self.amp.product_id
+
+    def close(self):
+        self.product_id = None
+
+    def read(self, timeout=None):
+        return self.amp.next_packet(timeout)
+
+    def write(self, data):
+        self.amp.handle(data)
+        return len(data)
+
+    def wakeup(self):
+        self.amp.wakeup()
@@ -0,0 +1,171 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''The state of an amplifier as last reported by it or written to it,
+kept by BlackstarIDAmp as amp.state. For example:
+
+    gain = amp.state['gain']
+    version, settings = amp.state.snapshot()
+    ...
+    version, changes = amp.state.changed_since(version)
+
+'''
+
+import logging
+import threading
+
+logger = logging.getLogger('outsider.blackstarid.state')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class AmpState(object):
+
+    '''Thread-safe mapping of setting names, such as control names,
+    to their current values. Every change increments the state's
+    version, and the version at which each setting last changed is
+    recorded, so that a reader can find out cheaply what has changed
+    since it last looked.
+
+    Settings whose value is unknown, for example the controls just
+    after a preset has been selected, are absent. Single lookups are
+    not locked; use snapshot for a consistent view of several
+    settings.
+
+    '''
+
+    def __init__(self):
+        self._values = {}
+        # Version at which each setting last changed, including
+        # settings which have since been forgotten
+        self._versions = {}
+        self.version = 0
+        self._cond = threading.Condition(threading.Lock())
+        # Number of threads in wait, so that updates only notify when
+        # someone is listening
+        self._waiting = 0
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self.snapshot()[1])
+
+    def version_of(self, key):
+        '''Return the version at which ``key`` last changed, or 0 if it
+        never has.
+
+        '''
+        return self._versions.get(key, 0)
+
+    def snapshot(self):
+        '''Return the current version and a copy of all known settings.'''
+        with self._cond:
+            return self.version, dict(self._values)
+
+    def update(self, values):
+        '''Set each setting in the dictionary ``values``. Returns a
+        dictionary of the settings which changed.
+
+        '''
+        changed = {}
+        with self._cond:
+            current = self._values
+            for key, value in values.items():
+                if key not in current or current[key] != value:
+                    changed[key] = value
+            if changed:
+                self.version += 1
+                current.update(changed)
+                for key in changed:
+                    self._versions[key] = self.version
+                if self._waiting:
+                    self._cond.notify_all()
+        return changed
+
+    def set(self, key, value):
+        '''Set a single setting, returning True if it changed.'''
+        with self._cond:
+            current = self._values
+            if key in current and current[key] == value:
+                return False
+            self.version += 1
+            current[key] = value
+            self._versions[key] = self.version
+            if self._waiting:
+                self._cond.notify_all()
+        return True
+
+    def forget(self, keys=None):
+        '''Mark the settings ``keys``, by default all of them, as
+        unknown.
+
+        '''
+        with self._cond:
+            if keys is None:
+                keys = list(self._values)
+            forgotten = [k for k in keys if k in self._values]
+            if not forgotten:
+                return
+            self.version += 1
+            for key in forgotten:
+                del self._values[key]
+                self._versions[key] = self.version
+            if self._waiting:
+                self._cond.notify_all()
+
+    def changed_since(self, version):
+        '''Return the current version and a dictionary of the settings
+        which have changed since ``version``. Settings which have been
+        forgotten have the value None.
+
+        '''
+        with self._cond:
+            if version >= self.version:
+                return self.version, {}
+            return self.version, dict(
+                (key, self._values.get(key))
+                for key, v in self._versions.items() if v > version)
+
+    def wait(self, version, timeout=None):
+        '''Wait until the state has changed since ``version``, or
+        ``timeout`` seconds have passed. Returns the current version.
+
+        '''
+        with self._cond:
+            self._waiting += 1
+            try:
+                self._cond.wait_for(lambda: self.version > version, timeout)
+            finally:
+                self._waiting -= 1
+            return self.version
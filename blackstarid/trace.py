@@ -0,0 +1,145 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''A record of the most recent packets exchanged with an amplifier,
+for diagnosing protocol problems. For example:
+
+    trace = amp.enable_trace(256)
+    ...
+    print(trace.format())
+
+'''
+
+import array
+import logging
+import threading
+import time
+
+from blackstarid.blackstarid import PACKET_SENT, format_packet
+
+logger = logging.getLogger('outsider.blackstarid.trace')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+class PacketTrace(object):
+
+    '''Ring buffer holding the last ``capacity`` packets sent to or
+    received from the amp, as raw bytes with a time.monotonic
+    timestamp and direction. Recording a packet only copies it into
+    preallocated storage; packets are formatted as hex only when the
+    trace is formatted or dumped.
+
+    A PacketTrace is an amp tap - see BlackstarIDAmp.add_tap.
+
+    '''
+
+    packet_size = 64
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError('Capacity must be at least 1')
+        self.capacity = capacity
+        self._data = bytearray(capacity * self.packet_size)
+        self._lengths = array.array('B', bytes(capacity))
+        self._directions = bytearray(capacity)
+        self._times = array.array('d', bytes(8 * capacity))
+        # Total number of packets recorded
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, direction, packet):
+        '''Record ``packet``, which was sent if ``direction`` is
+        PACKET_SENT or received if PACKET_RECEIVED. Anything beyond
+        packet_size bytes is not recorded.
+
+        '''
+        t = time.monotonic()
+        n = min(len(packet), self.packet_size)
+        with self._lock:
+            i = self._count % self.capacity
+            start = i * self.packet_size
+            self._data[start:start + n] = packet[0:n]
+            self._lengths[i] = n
+            self._directions[i] = direction
+            self._times[i] = t
+            self._count += 1
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def entries(self, last=None):
+        '''Return a list of (timestamp, direction, bytes) tuples, oldest
+        first, for all recorded packets or the ``last`` most recent.
+
+        '''
+        with self._lock:
+            n = min(self._count, self.capacity)
+            if last is not None:
+                n = min(n, last)
+            first = self._count - n
+            result = []
+            for k in range(first, self._count):
+                i = k % self.capacity
+                start = i * self.packet_size
+                result.append((self._times[i], self._directions[i],
+                               bytes(self._data[start:start + self._lengths[i]])))
+        return result
+
+    def format(self, last=None):
+        '''Format the trace as text, one packet per block. Times are in
+        seconds relative to the most recent packet.
+
+        '''
+        entries = self.entries(last)
+        if not entries:
+            return '(no packets traced)'
+
+        end = entries[-1][0]
+        blocks = []
+        for t, direction, packet in entries:
+            arrow = '>' if direction == PACKET_SENT else '<'
+            lines = format_packet(packet).split('\n')
+            header = '{0:+11.6f} {1} '.format(t - end, arrow)
+            indent = ' ' * len(header)
+            blocks.append('\n'.join(
+                [header + lines[0]] + [indent + l for l in lines[1:]]))
+        return '\n'.join(blocks)
+
+    def dump(self, log=None, level=logging.ERROR, last=None):
+        '''Write the trace to the logger ``log``, by default this module's
+        logger, at ``level``.
+
+        '''
+        if log is None:
+            log = logger
+        if log.isEnabledFor(level):
+            log.log(level, 'Packet trace ({0} of {1} packets, > sent, '
+                    '< received):\n{2}'.format(
+                        len(self) if last is None else min(last, len(self)),
+                        self._count, self.format(last)))
@@ -0,0 +1,404 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Keeping a PresetLibrary up to date with the preset files in a
+directory tree as they are created, changed and deleted. For example:
+
+    watcher = LibraryWatcher(library, '~/presets', on_change=refresh)
+    watcher.start()
+    ...
+    watcher.stop()
+
+On Linux changes are picked up with inotify, so only the files which
+changed are parsed. Elsewhere, or if inotify can't be used, the tree
+is rescanned periodically, which costs a stat of every file.
+
+'''
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from blackstarid.library import PresetLibrary
+
+logger = logging.getLogger('outsider.blackstarid.watch')
+
+
+class __NullHandler(logging.Handler):
+
+    def emit(self, record):
+        pass
+
+__null_handler = __NullHandler()
+logger.addHandler(__null_handler)
+
+
+# inotify event masks, from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events watched for in each directory of the tree. IN_MODIFY isn't
+# included: a file being written is picked up when it is closed.
+watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# Watch descriptor, mask, cookie and name length
+event_format = struct.Struct('iIII')
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class Inotify(object):
+
+    '''Minimal wrapper of the Linux inotify API. Raises
+    InotifyUnavailable if it can't be used on this system.
+
+    '''
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise InotifyUnavailable('inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise InotifyUnavailable('libc has no inotify support')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise InotifyUnavailable('inotify_init1 failed: {0}'.format(
+                os.strerror(e)))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        '''Watch ``path`` for the events in ``mask``, returning the watch
+        descriptor.
+
+        '''
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        '''Return a list of (wd, mask, cookie, name) tuples for the
+        events available, which is empty if there are none.
+
+        '''
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_format.unpack_from(data, offset)
+            offset += event_format.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class LibraryWatcher(object):
+
+    '''Thread keeping ``library`` up to date with the preset files under
+    ``directory``. Changes are collected until none have been seen for
+    ``debounce`` seconds, so copying a large number of files results
+    in a single update of the library, after which ``on_change`` is
+    called, from the watcher thread, with the result of the update
+    (see PresetLibrary.import_tree).
+
+    If inotify isn't available, or ``use_inotify`` is False, the tree
+    is rescanned every ``interval`` seconds instead.
+
+    The tree is imported once when the watcher starts, so the library
+    is current even if files changed while it wasn't being watched.
+
+    '''
+
+    def __init__(self, library, directory, debounce=0.5, on_change=None,
+                 interval=10.0, use_inotify=True):
+        self.library = library
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.debounce = debounce
+        self.on_change = on_change
+        self.interval = interval
+        self.use_inotify = use_inotify
+
+        self._inotify = None
+        # Watch descriptor to directory path
+        self._watches = {}
+        # Paths of files changed since the last update, and of
+        # directories to import or remove
+        self._files = set()
+        self._new_dirs = set()
+        self._removed_dirs = set()
+        self._rescan = False
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def using_inotify(self):
+        return self._inotify is not None
+
+    def start(self):
+        if self.use_inotify:
+            try:
+                self._inotify = Inotify()
+            except InotifyUnavailable as e:
+                logger.info('Falling back to rescanning {0}: {1}'.format(
+                    self.directory, e))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='LibraryWatcher')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches = {}
+
+    def _watch_tree(self, top):
+        # Watch top and every directory under it. Watches are added
+        # before the tree is imported, so nothing created meanwhile is
+        # missed.
+        for dirpath, dirnames, filenames in os.walk(top):
+            try:
+                wd = self._inotify.add_watch(dirpath, watch_mask)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.warning('Out of inotify watches at {0}; raise '
+                                   'fs.inotify.max_user_watches'.format(
+                                       dirpath))
+                    return
+                # Removed before it could be watched
+                continue
+            self._watches[wd] = dirpath
+
+    def _handle(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, rescanning {0}'
+                               .format(self.directory))
+                self._rescan = True
+                continue
+
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # The directory itself is gone; its entries are
+                # removed by the event in its parent, unless it is the
+                # top of the tree
+                if directory == self.directory:
+                    self._removed_dirs.add(directory)
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._removed_dirs.discard(path)
+                    self._new_dirs.add(path)
+                    self._watch_tree(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._new_dirs.discard(path)
+                    self._removed_dirs.add(path)
+            elif mask & IN_CREATE:
+                # Wait for IN_CLOSE_WRITE, but note the file in case
+                # it is a hard link, which never gets one
+                self._files.add(path)
+            else:
+                self._files.add(path)
+
+    def _pending(self):
+        return bool(self._files or self._new_dirs or self._removed_dirs or
+                    self._rescan)
+
+    def _update(self):
+        # Apply the changes collected, returning the combined result
+        result = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0,
+                  'failed': []}
+
+        def add(r):
+            for k in ('added', 'updated', 'unchanged', 'removed'):
+                result[k] += r[k]
+            result['failed'].extend(r['failed'])
+
+        # The changes are forgotten even if applying them fails, so
+        # that a failure isn't retried after every later event
+        try:
+            if self._rescan:
+                add(self.library.import_tree(self.directory, workers=1))
+            else:
+                if self._removed_dirs:
+                    result['removed'] += self.library.remove_paths(
+                        self._removed_dirs)
+                for path in self._new_dirs:
+                    add(self.library.import_tree(path, workers=1))
+                files = [f for f in self._files
+                         if not any(f.startswith(os.path.join(d, ''))
+                                    for d in self._new_dirs)]
+                if files:
+                    add(self.library.update_paths(files))
+        finally:
+            self._files = set()
+            self._new_dirs = set()
+            self._removed_dirs = set()
+            self._rescan = False
+        return result
+
+    def _changed(self, result):
+        changed = result['added'] + result['updated'] + result['removed']
+        logger.debug('Library updated from {0}: {1}'.format(
+            self.directory, result))
+        if changed and self.on_change is not None:
+            try:
+                self.on_change(result)
+            except Exception:
+                logger.exception('Library change callback failed')
+
+    def _import_tree(self):
+        try:
+            self._changed(self.library.import_tree(self.directory, workers=1))
+        except Exception:
+            logger.exception('Importing {0} failed'.format(self.directory))
+
+    def _run(self):
+        if self._inotify is not None:
+            self._watch_tree(self.directory)
+        self._import_tree()
+
+        if self._inotify is None:
+            while not self._stop.wait(self.interval):
+                self._import_tree()
+            return
+
+        last_event = None
+        while not self._stop.is_set():
+            timeout = 0.2
+            if last_event is not None:
+                timeout = max(0.0, min(
+                    timeout, last_event + self.debounce - time.monotonic()))
+            readable, _, _ = select.select([self._inotify], [], [], timeout)
+            if readable:
+                events = self._inotify.read()
+                if events:
+                    self._handle(events)
+                    if self._pending():
+                        last_event = time.monotonic()
+                    continue
+
+            if (last_event is not None and
+                time.monotonic() - last_event >= self.debounce):
+                last_event = None
+                try:
+                    self._changed(self._update())
+                except Exception:
+                    logger.exception('Updating library from {0} failed'
+                                     .format(self.directory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m blackstarid.watch',
+        description='Keep the preset index up to date with a directory tree')
+    parser.add_argument('directory')
+    parser.add_argument('--database', help='index database to use')
+    parser.add_argument('--debounce', type=float, default=0.5,
+                        help='seconds to wait for changes to settle')
+    parser.add_argument('--poll', action='store_true',
+                        help='rescan periodically rather than using inotify')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    def report(result):
+        print('{0} added, {1} updated, {2} removed, {3} failed'.format(
+            result['added'], result['updated'], result['removed'],
+            len(result['failed'])))
+
+    with PresetLibrary(args.database) as library:
+        watcher = LibraryWatcher(library, args.directory, args.debounce,
+                                 on_change=report,
+                                 use_inotify=not args.poll)
+        watcher.start()
+        print('Watching {0}, press Ctrl-C to stop'.format(watcher.directory))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
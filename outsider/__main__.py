@@ -15,22 +15,92 @@
 #
 # Copyright 2015, Jonathan Underwood. All rights reserved.
 
+import time
+
+# Taken before anything else is imported, for --startup-time
+start_time = time.perf_counter()
+
 from outsider.outsider import Ui
+from blackstarid import BlackstarIDAmp, USBTransport
+import argparse
 import sys
 from PyQt5 import QtWidgets
+from PyQt5.QtCore import QTimer
 from PyQt5.QtGui import QPalette, QColor
 import logging
 
+
+def report_startup_time(window, imported, created):
+    # Called from the event loop once the window has been shown
+    shown = time.perf_counter()
+    print('Imports {0:.1f}ms, window created {1:.1f}ms (UI from {2}), '
+          'first window shown {3:.1f}ms after start'.format(
+              (imported - start_time) * 1000, (created - imported) * 1000,
+              window.ui_source, (shown - start_time) * 1000),
+          file=sys.stderr)
+    QtWidgets.QApplication.instance().quit()
+
+
 def main(args=None):
-    # TODO use argparse to add various options for debugging etc
     if args is None:
         args = sys.argv[1:]
 
-    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(
+        prog='outsider', description='Control Blackstar ID amplifiers')
+    parser.add_argument('--debug', action='store_true',
+                        help='log debugging messages')
+    parser.add_argument('--trace', type=int, metavar='N', default=0,
+                        help='keep a trace of the last N packets exchanged '
+                        'with the amp, which is logged on protocol errors '
+                        'and on exit')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='instead of connecting to an amp, replay a '
+                        'capture made with blackstarid.capture')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        metavar='SPEED',
+                        help='replay speed relative to the original')
+    parser.add_argument('--daemon', nargs='?', const='', metavar='SOCKET',
+                        help='share the amp with other programs through '
+                        'blackstarid-daemon, optionally giving the path of '
+                        'its socket')
+    parser.add_argument('--fast-reconnect', action='store_true',
+                        help='don\'t reset the amp when reconnecting to it '
+                        'after disconnecting cleanly')
+    parser.add_argument('--latency', action='store_true',
+                        help='time the amp\'s answers and the display of '
+                        'its changes, and print histograms on exit')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='report the time taken to show the window, '
+                        'and exit')
+    opts, qt_args = parser.parse_known_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if opts.debug else logging.WARNING)
     logger = logging.getLogger('outsider')
 
-    app = QtWidgets.QApplication(sys.argv)
+    imported = time.perf_counter()
+    app = QtWidgets.QApplication(sys.argv[0:1] + qt_args)
     window = Ui()
+    created = time.perf_counter()
+    if opts.replay is not None:
+        from blackstarid.capture import ReplayTransport
+        window.amp = BlackstarIDAmp(
+            transport=ReplayTransport(opts.replay, speed=opts.replay_speed))
+    elif opts.daemon is not None:
+        from blackstarid.daemon import DaemonTransport
+        window.amp = BlackstarIDAmp(
+            transport=DaemonTransport(opts.daemon or None))
+    elif opts.fast_reconnect:
+        window.amp = BlackstarIDAmp(
+            transport=USBTransport(fast_reconnect=True))
+    if opts.trace > 0:
+        window.amp.enable_trace(opts.trace)
+        app.aboutToQuit.connect(
+            lambda: window.amp.dump_trace(logging.WARNING))
+    if opts.latency:
+        latency = window.amp.enable_latency()
+        latency.track_display = True
+        app.aboutToQuit.connect(
+            lambda: print(latency.format(), file=sys.stderr))
 
     # Tweak colors as per:
     # https://gist.github.com/QuantumCD/6245215
@@ -52,6 +122,12 @@ def main(args=None):
     app.setPalette(dark_palette)
     app.setStyleSheet("QToolTip { color: #ffffff; background-color: #2a82da; border: 1px solid white; }")
 
+    if opts.startup_time:
+        # Runs once the event loop has processed the window being
+        # shown
+        QTimer.singleShot(0, lambda: report_startup_time(
+            window, imported, created))
+
     sys.exit(app.exec_())
 
 
@@ -15,14 +15,21 @@
 #
 # Copyright 2015, Jonathan Underwood. All rights reserved.
 
-from PyQt5 import uic
-from PyQt5.QtCore import QObject, QThread, QMutex
+from PyQt5.QtCore import QObject, QTimer
 from PyQt5.QtCore import pyqtSlot, pyqtSignal
-from PyQt5.QtWidgets import QMainWindow, QMessageBox, QGroupBox, QSlider, QLCDNumber, QRadioButton, QListWidgetItem, QInputDialog
-from PyQt5.QtWidgets import QApplication
-from blackstarid import BlackstarIDAmp, NoDataAvailable, NotConnectedError
+from PyQt5.QtWidgets import QMainWindow, QMessageBox, QGroupBox, QComboBox, QSlider, QLCDNumber, QRadioButton, QListWidgetItem, QInputDialog
+from blackstarid import BlackstarIDAmp, NotConnectedError
+from blackstarid.bank import PresetBank
+from blackstarid.cache import PresetCache, PresetSync, cache_directory
+from blackstarid.reader import AmpReader
+import functools
+import importlib
+import importlib.util
 import logging
 import os
+import queue
+import threading
+import time
 
 # Set up logging and create a null handler in case the application doesn't
 # provide a log handler
@@ -38,63 +45,208 @@ __null_handler = __NullHandler()
 logger.addHandler(__null_handler)
 
 
+# Name of the module outsider.ui is compiled to, which setup.py
+# builds alongside outsider.ui, or failing that is kept in the user's
+# cache directory
+ui_module = 'outsider_ui'
+
+
+def _is_current(module_path, ui_path):
+    # A compiled UI is only used if it is at least as new as the .ui
+    # file, so that editing the .ui file takes effect
+    try:
+        return os.stat(module_path).st_mtime_ns >= os.stat(ui_path).st_mtime_ns
+    except OSError:
+        return False
+
+
+def compile_ui(ui_path, module_path):
+    '''Compile the Qt Designer file ``ui_path`` to the Python module
+    ``module_path``. The module is replaced atomically, so a reader
+    never sees a partly written module.
+
+    '''
+    from PyQt5 import uic
+    directory = os.path.dirname(module_path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(module_path, os.getpid())
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            uic.compileUi(ui_path, f)
+        os.replace(tmp, module_path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def load_ui(window, ui_path):
+    '''Create the widgets described by the Qt Designer file ``ui_path``
+    in ``window``, as uic.loadUi does. The file is compiled to Python
+    once, rather than interpreted on every start, and the compiled
+    module is used while it is current. Returns how the UI was loaded:
+    'built' for the module built by setup.py, 'cached' for one in the
+    user's cache directory, or 'loadUi'.
+
+    '''
+    module = None
+    source = 'built'
+    built = os.path.join(os.path.dirname(ui_path), ui_module + '.py')
+    if _is_current(built, ui_path):
+        try:
+            module = importlib.import_module('outsider.' + ui_module)
+        except ImportError as e:
+            logger.warning('Could not import {0}: {1}'.format(built, e))
+
+    if module is None:
+        source = 'cached'
+        cached = os.path.join(cache_directory(), 'ui', ui_module + '.py')
+        try:
+            if not _is_current(cached, ui_path):
+                logger.debug('Compiling {0} to {1}'.format(ui_path, cached))
+                compile_ui(ui_path, cached)
+            spec = importlib.util.spec_from_file_location(ui_module, cached)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except Exception as e:
+            logger.warning('Could not use compiled UI {0}: {1}'.format(
+                cached, e))
+            module = None
+
+    if module is None:
+        from PyQt5 import uic
+        uic.loadUi(ui_path, window)
+        return 'loadUi'
+
+    form = module.Ui_MainWindow()
+    form.setupUi(window)
+    # The widgets are attributes of the form; make them attributes of
+    # the window, as loadUi does
+    for name, value in vars(form).items():
+        setattr(window, name, value)
+    return source
+
+
 class Ui(QMainWindow):
-    shutdown_threads = pyqtSignal(name='shutdown_threads')
+
+    # Maximum time in seconds the amp watcher blocks waiting for data
+    amp_read_timeout = 0.1
+
+    # Data from the amp is applied to the widgets at most this many
+    # times a second. Everything arriving in between is merged, so
+    # that each widget is updated at most once per frame however fast
+    # the amp sends data.
+    max_frame_rate = 60
+
+    # Data which describe events rather than settings, so must each
+    # be handled rather than merged with later data of the same kind
+    event_keys = frozenset(['preset_name', 'preset_settings', 'amp_identity'])
+
+    # Controls set with a slider or combo box, as (control, widget,
+    # display, focus): the names of the widget and of the LCD number
+    # showing the control's value, if any, and for the controls of an
+    # effect, the fx_focus value giving that effect focus, which is
+    # written along with the control. Adding a control only takes a
+    # widget in outsider.ui and an entry here.
+    control_bindings = (
+        ('voice', 'voiceComboBox', None, None),
+        ('gain', 'gainSlider', 'gainLcdNumber', None),
+        ('volume', 'volumeSlider', 'volumeLcdNumber', None),
+        ('bass', 'bassSlider', 'bassLcdNumber', None),
+        ('middle', 'middleSlider', 'middleLcdNumber', None),
+        ('treble', 'trebleSlider', 'trebleLcdNumber', None),
+        ('isf', 'isfSlider', 'isfLcdNumber', None),
+        ('tvp_valve', 'TVPComboBox', None, None),
+        ('resonance', 'resonanceSlider', 'resonanceLcdNumber', None),
+        ('presence', 'presenceSlider', 'presenceLcdNumber', None),
+        ('master_volume', 'masterVolumeSlider', 'masterVolumeLcdNumber', None),
+        ('mod_type', 'modComboBox', None, 1),
+        ('mod_segval', 'modSegValSlider', 'modSegValLcdNumber', 1),
+        ('mod_manual', 'modManualSlider', 'modManualLcdNumber', 1),
+        ('mod_level', 'modLevelSlider', 'modLevelLcdNumber', 1),
+        ('mod_speed', 'modSpeedSlider', 'modSpeedLcdNumber', 1),
+        ('delay_type', 'delayComboBox', None, 2),
+        ('delay_feedback', 'delayFeedbackSlider', 'delayFeedbackLcdNumber', 2),
+        ('delay_level', 'delayLevelSlider', 'delayLevelLcdNumber', 2),
+        ('delay_time', 'delayTimeSlider', 'delayTimeLcdNumber', 2),
+        ('reverb_type', 'reverbComboBox', None, 3),
+        ('reverb_size', 'reverbSizeSlider', 'reverbSizeLcdNumber', 3),
+        ('reverb_level', 'reverbLevelSlider', 'reverbLevelLcdNumber', 3),
+    )
+
+    # Switches, as (control, radio button, focus, dependents): the
+    # widgets in dependents are only enabled while the switch is on,
+    # and for an effect, turning it on gives it focus.
+    switch_bindings = (
+        ('tvp_switch', 'TVPRadioButton', None, ('TVPComboBox',)),
+        ('mod_switch', 'modRadioButton', 1,
+         ('modComboBox', 'modSegValSlider', 'modSegValLabel',
+          'modSegValLcdNumber', 'modSpeedSlider', 'modSpeedLabel',
+          'modSpeedLcdNumber', 'modLevelSlider', 'modLevelLabel',
+          'modLevelLcdNumber')),
+        ('delay_switch', 'delayRadioButton', 2,
+         ('delayComboBox', 'delayFeedbackSlider', 'delayFeedbackLabel',
+          'delayFeedbackLcdNumber', 'delayTimeSlider', 'delayTimeLabel',
+          'delayTimeLcdNumber', 'delayLevelSlider', 'delayLevelLabel',
+          'delayLevelLcdNumber')),
+        ('reverb_switch', 'reverbRadioButton', 3,
+         ('reverbComboBox', 'reverbSizeSlider', 'reverbSizeLabel',
+          'reverbSizeLcdNumber', 'reverbLevelSlider', 'reverbLevelLabel',
+          'reverbLevelLcdNumber')),
+    )
 
     def __init__(self):
         super(Ui, self).__init__()
 
+        uif = os.path.join(os.path.split(__file__)[0], 'outsider.ui')
+        logger.debug('loading GUI file: {0}'.format(uif))
+        self.ui_source = load_ui(self, uif)
+
         # Dictionary of methods to call in response to changes to
-        # controls made directly on the amplifier.
+        # controls made directly on the amplifier. Those of the bound
+        # controls are added by bind_widgets.
         self.response_funcs = {
-            'voice': self.voice_changed_on_amp,
-            'gain': self.gain_changed_on_amp,
-            'volume': self.volume_changed_on_amp,
-            'bass': self.bass_changed_on_amp,
-            'middle': self.middle_changed_on_amp,
-            'treble': self.treble_changed_on_amp,
-            'isf': self.isf_changed_on_amp,
-            'tvp_switch': self.tvp_switch_changed_on_amp,
-            'tvp_valve': self.tvp_valve_changed_on_amp,
-            'mod_switch': self.mod_switch_changed_on_amp,
-            'delay_switch': self.delay_switch_changed_on_amp,
-            'reverb_switch': self.reverb_switch_changed_on_amp,
-            'mod_type': self.mod_type_changed_on_amp,
-            'mod_segval': self.mod_segval_changed_on_amp,
-            'mod_level': self.mod_level_changed_on_amp,
-            'mod_speed': self.mod_speed_changed_on_amp,
-            'mod_manual': self.mod_manual_changed_on_amp,
-            'delay_type': self.delay_type_changed_on_amp,
-            'delay_feedback': self.delay_feedback_changed_on_amp,
-            'delay_level': self.delay_level_changed_on_amp,
-            'delay_time': self.delay_time_changed_on_amp,
-            'reverb_type': self.reverb_type_changed_on_amp,
-            'reverb_size': self.reverb_size_changed_on_amp,
-            'reverb_level': self.reverb_level_changed_on_amp,
             'fx_focus': self.fx_focus_changed_on_amp,
             'preset': self.preset_changed_on_amp,
             'manual_mode': self.manual_mode_changed_on_amp,
             'tuner_mode': self.tuner_mode_changed_on_amp,
             'tuner_note': self.tuner_note_changed_on_amp,
             'tuner_delta': self.tuner_delta_changed_on_amp,
-            'resonance': self.resonance_changed_on_amp,
-            'presence': self.presence_changed_on_amp,
-            'master_volume': self.master_volume_changed_on_amp,
             'preset_name': self.preset_name_from_amp,
             'preset_settings': self.preset_settings_from_amp,
+            'amp_identity': self.amp_identity_from_amp,
         }
+        self.bind_widgets()
+        self.response_funcs['mod_switch'] = self.mod_switch_changed_on_amp
+        self.response_funcs['mod_type'] = self.mod_type_changed_on_amp
 
-        uif = os.path.join(os.path.split(__file__)[0], 'outsider.ui')
-        logger.debug('loading GUI file: {0}'.format(uif))
-        uic.loadUi(uif, self)
+        # The widgets reset by controls_enabled, found once rather
+        # than on every connect and disconnect
+        self.group_boxes = self.findChildren(QGroupBox)
+        self.sliders = self.findChildren(QSlider)
+        self.lcd_numbers = self.findChildren(QLCDNumber)
+        self.radio_buttons = self.findChildren(QRadioButton)
 
-        self.amp_mutex = None
         self.amp = BlackstarIDAmp()
-        self.watcher_thread = None
+        self.watcher = None
+
+        # Settings from the amp waiting for the next frame, merged so
+        # only the latest value of each is kept, and events, kept in
+        # order
+        self.pending_settings = {}
+        self.pending_events = []
+        self.last_frame = 0.0
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.apply_frame)
+        self.preset_cache = PresetCache()
+        self.preset_sync = None
+        self.connect_time = None
+        self.bank_fetch_start = None
 
         # For now we don't do anything with preset settings
-        # information other than store them in this list
-        self.preset_settings = [None] * 128
+        # information other than store them in this bank
+        self.preset_bank = PresetBank()
 
         self.controls_enabled(False)
         self.show()
@@ -102,8 +254,7 @@ class Ui(QMainWindow):
     def controls_enabled(self, bool):
         # Disable/Enable all widgets except the connect button (always enabled) and the master controls (always disabled)
         if bool is True:
-            widgets = self.findChildren(QGroupBox)#(QObject)
-            for w in widgets:
+            for w in self.group_boxes:
                 if w == self.masterGroupBox:
                    pass
                 elif w.objectName() == 'TVPGroupBox' and self.amp.model == 'id-core':
@@ -115,65 +266,110 @@ class Ui(QMainWindow):
                     w.setEnabled(bool)
 
         elif bool is False:
-            widgets = self.findChildren(QGroupBox)#(QObject)
-            for w in widgets:
+            for w in self.group_boxes:
                 w.setEnabled(bool)
 
-            widgets = self.findChildren(QSlider)
-            for w in widgets:
+            for w in self.sliders:
                 w.blockSignals(True)
                 w.setValue(0)
                 w.blockSignals(False)
 
-            widgets = self.findChildren(QLCDNumber)
-            for w in widgets:
+            for w in self.lcd_numbers:
                 w.blockSignals(True) # Not nescessary
                 w.display(0)
                 w.blockSignals(False) # Not nescessary
 
-            widgets = self.findChildren(QRadioButton)
-            for w in widgets:
+            for w in self.radio_buttons:
                 w.blockSignals(True)
                 w.setChecked(False)
                 w.blockSignals(False)
 
+    def bind_widgets(self):
+        # Look up the widgets of control_bindings and switch_bindings,
+        # add the methods updating them to response_funcs and connect
+        # their signals to the slots writing to the amp
+        self.bindings = {}
+        for control, name, display, focus in self.control_bindings:
+            widget = getattr(self, name)
+            if isinstance(widget, QComboBox):
+                setter = widget.setCurrentIndex
+                signal = widget.currentIndexChanged
+            else:
+                setter = widget.setValue
+                signal = widget.valueChanged
+            if display is not None:
+                display = getattr(self, display).display
+            binding = (widget, setter, display)
+            self.bindings[control] = binding
+            self.response_funcs[control] = functools.partial(
+                self.control_changed_on_amp, binding)
+            signal.connect(functools.partial(
+                self.control_changed_on_gui, control, focus))
+
+        for control, name, focus, dependents in self.switch_bindings:
+            button = getattr(self, name)
+            binding = (button, [getattr(self, d) for d in dependents])
+            self.bindings[control] = binding
+            self.response_funcs[control] = functools.partial(
+                self.switch_changed_on_amp, binding)
+            button.toggled.connect(functools.partial(
+                self.switch_changed_on_gui, control, focus))
+
+        # The manual control is only enabled for the flanger
+        self.modRadioButton.toggled.connect(self.assess_manual_enabled)
+
     def connect(self):
         try:
             self.amp.connect()
-            self.amp.drain()
-            self.start_amp_watcher_thread()
+            with self.amp.timed('drain'):
+                self.amp.drain()
+            self.start_amp_watcher()
+            self.connect_time = time.monotonic()
+            # The preset names and settings are loaded once the amp
+            # identifies itself in reply to this - see
+            # amp_identity_from_amp
             self.amp.startup()
-            self.amp.get_all_preset_names()
         except NotConnectedError:
             raise
 
+    def preset_sync_done(self, sync):
+        # Called from the fetch thread. Names and settings fetched
+        # from the amp reach the GUI through the watcher as they
+        # arrive.
+        self.amp.connect_timings['bank_fetch'] = (time.perf_counter() -
+                                                  self.bank_fetch_start)
+        logger.debug('Presets revalidated {0:.3f}s after connect, '
+                     '{1} settings fetched, {2} changed'.format(
+                         time.monotonic() - self.connect_time,
+                         len(sync.refetched), len(sync.changed)))
+        logger.debug('Connect timings: {0}'.format(self.amp.format_timings()))
+
     def disconnect(self):
-        if self.watcher_thread is not None:
+        if self.preset_sync is not None:
+            self.preset_sync.stop()
+            self.preset_sync = None
+
+        if self.watcher is not None:
             logger.debug('Closing down amplifier watching thread')
-            self.shutdown_threads.emit()
-            self.watcher_thread.quit()
-            self.watcher_thread.wait()
+            self.watcher.stop()
+            self.watcher.have_data.disconnect(self.amp_data_available)
+            self.watcher = None
             logger.debug('Amplifier watching thread finished')
 
+        self.frame_timer.stop()
+        self.pending_settings = {}
+        self.pending_events = []
+
         if self.amp.connected is True:
             self.amp.disconnect()
 
-    def start_amp_watcher_thread(self):
+    def start_amp_watcher(self):
         # Set up thread to watch for manual changes of the amp
         # controls at the amp (rather than gui) so we can update the
-        # gui controls as needed. The way this is done is inspired
-        # by:
-        # http://stackoverflow.com/questions/29243692/pyqt5-how-to-make-qthread-return-data-to-main-thread
-        # https://mayaposch.wordpress.com/2011/11/01/how-to-really-truly-use-qthreads-the-full-explanation/
-        self.watcher_thread = QThread()
-        self.amp_mutex = QMutex()
-        self.watcher = AmpControlWatcher(self.amp, self.amp_mutex)
-        self.watcher.have_data.connect(self.new_data_from_amp)
-        self.shutdown_threads.connect(self.watcher.stop_watching)
-        self.watcher.moveToThread(self.watcher_thread)
-        self.watcher_thread.started.connect(self.watcher.work)
-
-        self.watcher_thread.start()
+        # gui controls as needed.
+        self.watcher = AmpControlWatcher(self.amp, self.amp_read_timeout)
+        self.watcher.have_data.connect(self.amp_data_available)
+        self.watcher.start()
 
     def closeEvent(self, event):
         # Ran when the application is closed.
@@ -181,7 +377,42 @@ class Ui(QMainWindow):
         super(Ui, self).close()
         logger.debug('Exiting')
 
-    @pyqtSlot(dict)
+    @pyqtSlot()
+    def amp_data_available(self):
+        if self.watcher is None:
+            return
+        pending = self.pending_settings
+        event_keys = self.event_keys
+        for settings in self.watcher.get_data():
+            for key, value in settings.items():
+                if key in event_keys:
+                    self.pending_events.append({key: value})
+                else:
+                    # Move the key to the end, so that settings are
+                    # applied in the order they last changed
+                    pending.pop(key, None)
+                    pending[key] = value
+
+        if not self.frame_timer.isActive():
+            # Apply at once if a frame hasn't been applied recently,
+            # otherwise wait until the next frame is due
+            delay = self.last_frame + 1.0 / self.max_frame_rate - time.monotonic()
+            self.frame_timer.start(max(0, int(delay * 1000)))
+
+    @pyqtSlot()
+    def apply_frame(self):
+        self.last_frame = time.monotonic()
+        settings = self.pending_settings
+        events = self.pending_events
+        self.pending_settings = {}
+        self.pending_events = []
+        if settings:
+            self.new_data_from_amp(settings)
+            if self.amp.latency is not None:
+                self.amp.latency.displayed(settings)
+        for event in events:
+            self.new_data_from_amp(event)
+
     def new_data_from_amp(self, settings):
         for control, value in settings.items():
             try:
@@ -192,175 +423,32 @@ class Ui(QMainWindow):
     ######################################################################
     # The following methods are called when data is received from the amp
     ######################################################################
-    def voice_changed_on_amp(self, value):
-        self.voiceComboBox.blockSignals(True)
-        self.voiceComboBox.setCurrentIndex(value)
-        self.voiceComboBox.blockSignals(False)
-
-    def gain_changed_on_amp(self, value):
-        self.gainSlider.blockSignals(True)
-        self.gainSlider.setValue(value)
-        self.gainLcdNumber.display(value)
-        self.gainSlider.blockSignals(False)
-
-    def volume_changed_on_amp(self, value):
-        self.volumeSlider.blockSignals(True)
-        self.volumeSlider.setValue(value)
-        self.volumeLcdNumber.display(value)
-        self.volumeSlider.blockSignals(False)
-
-    def bass_changed_on_amp(self, value):
-        self.bassSlider.blockSignals(True)
-        self.bassSlider.setValue(value)
-        self.bassLcdNumber.display(value)
-        self.bassSlider.blockSignals(False)
-
-    def middle_changed_on_amp(self, value):
-        self.middleSlider.blockSignals(True)
-        self.middleSlider.setValue(value)
-        self.middleLcdNumber.display(value)
-        self.middleSlider.blockSignals(False)
-
-    def treble_changed_on_amp(self, value):
-        self.trebleSlider.blockSignals(True)
-        self.trebleSlider.setValue(value)
-        self.trebleLcdNumber.display(value)
-        self.trebleSlider.blockSignals(False)
-
-    def isf_changed_on_amp(self, value):
-        self.isfSlider.blockSignals(True)
-        self.isfSlider.setValue(value)
-        self.isfLcdNumber.display(value)
-        self.isfSlider.blockSignals(False)
-
-    def tvp_switch_changed_on_amp(self, value):
-        value = bool(value)
-        self.TVPRadioButton.blockSignals(True)
-        self.TVPRadioButton.setChecked(value)
-        self.TVPComboBox.setEnabled(value)
-        self.TVPRadioButton.blockSignals(False)
 
-    def tvp_valve_changed_on_amp(self, value):
-        self.TVPComboBox.blockSignals(True)
-        self.TVPComboBox.setCurrentIndex(value)
-        self.TVPComboBox.blockSignals(False)
+    def control_changed_on_amp(self, binding, value):
+        widget, setter, display = binding
+        widget.blockSignals(True)
+        setter(value)
+        widget.blockSignals(False)
+        if display is not None:
+            display(value)
 
-    def mod_switch_changed_on_amp(self, value):
+    def switch_changed_on_amp(self, binding, value):
+        button, dependents = binding
         value = bool(value)
-        self.modRadioButton.blockSignals(True)
-        self.modRadioButton.setChecked(value)
-        self.modComboBox.setEnabled(value)
-        self.modSegValSlider.setEnabled(value)
-        self.modSegValLabel.setEnabled(value)
-        self.modSegValLcdNumber.setEnabled(value)
-        self.modSpeedSlider.setEnabled(value)
-        self.modSpeedLabel.setEnabled(value)
-        self.modSpeedLcdNumber.setEnabled(value)
-        self.modLevelSlider.setEnabled(value)
-        self.modLevelLabel.setEnabled(value)
-        self.modLevelLcdNumber.setEnabled(value)
-        self.modRadioButton.blockSignals(False)
-        self.assess_manual_enabled()
+        button.blockSignals(True)
+        button.setChecked(value)
+        for w in dependents:
+            w.setEnabled(value)
+        button.blockSignals(False)
 
-    def delay_switch_changed_on_amp(self, value):
-        value = bool(value)
-        self.delayRadioButton.blockSignals(True)
-        self.delayRadioButton.setChecked(value)
-        self.delayComboBox.setEnabled(value)
-        self.delayFeedbackSlider.setEnabled(value)
-        self.delayFeedbackLabel.setEnabled(value)
-        self.delayFeedbackLcdNumber.setEnabled(value)
-        self.delayTimeSlider.setEnabled(value)
-        self.delayTimeLabel.setEnabled(value)
-        self.delayTimeLcdNumber.setEnabled(value)
-        self.delayLevelSlider.setEnabled(value)
-        self.delayLevelLabel.setEnabled(value)
-        self.delayLevelLcdNumber.setEnabled(value)
-        self.delayRadioButton.blockSignals(False)
-
-    def reverb_switch_changed_on_amp(self, value):
-        value = bool(value)
-        self.reverbRadioButton.blockSignals(True)
-        self.reverbRadioButton.setChecked(value)
-        self.reverbComboBox.setEnabled(value)
-        self.reverbSizeSlider.setEnabled(value)
-        self.reverbSizeLabel.setEnabled(value)
-        self.reverbSizeLcdNumber.setEnabled(value)
-        self.reverbLevelSlider.setEnabled(value)
-        self.reverbLevelLabel.setEnabled(value)
-        self.reverbLevelLcdNumber.setEnabled(value)
-        self.reverbRadioButton.blockSignals(False)
+    def mod_switch_changed_on_amp(self, value):
+        self.switch_changed_on_amp(self.bindings['mod_switch'], value)
+        self.assess_manual_enabled()
 
     def mod_type_changed_on_amp(self, value):
-        self.modComboBox.blockSignals(True)
-        self.modComboBox.setCurrentIndex(value)
-        self.modComboBox.blockSignals(False)
+        self.control_changed_on_amp(self.bindings['mod_type'], value)
         self.mod_type_changed(value)
 
-    def mod_segval_changed_on_amp(self, value):
-        self.modSegValSlider.blockSignals(True)
-        self.modSegValSlider.setValue(value)
-        self.modSegValLcdNumber.display(value)
-        self.modSegValSlider.blockSignals(False)
-
-    def mod_level_changed_on_amp(self, value):
-        self.modLevelSlider.blockSignals(True)
-        self.modLevelSlider.setValue(value)
-        self.modLevelLcdNumber.display(value)
-        self.modLevelSlider.blockSignals(False)
-
-    def mod_speed_changed_on_amp(self, value):
-        self.modSpeedSlider.blockSignals(True)
-        self.modSpeedSlider.setValue(value)
-        self.modSpeedLcdNumber.display(value)
-        self.modSpeedSlider.blockSignals(False)
-
-    def mod_manual_changed_on_amp(self, value):
-        self.modManualSlider.blockSignals(True)
-        self.modManualSlider.setValue(value)
-        self.modManualLcdNumber.display(value)
-        self.modManualSlider.blockSignals(False)
-        
-    def delay_type_changed_on_amp(self, value):
-        self.delayComboBox.blockSignals(True)
-        self.delayComboBox.setCurrentIndex(value)
-        self.delayComboBox.blockSignals(False)
-
-    def delay_feedback_changed_on_amp(self, value):
-        self.delayFeedbackSlider.blockSignals(True)
-        self.delayFeedbackSlider.setValue(value)
-        self.delayFeedbackLcdNumber.display(value)
-        self.delayFeedbackSlider.blockSignals(False)
-
-    def delay_level_changed_on_amp(self, value):
-        self.delayLevelSlider.blockSignals(True)
-        self.delayLevelSlider.setValue(value)
-        self.delayLevelLcdNumber.display(value)
-        self.delayLevelSlider.blockSignals(False)
-
-    def delay_time_changed_on_amp(self, value):
-        self.delayTimeSlider.blockSignals(True)
-        self.delayTimeSlider.setValue(value)
-        self.delayTimeLcdNumber.display(value)
-        self.delayTimeSlider.blockSignals(False)
-
-    def reverb_type_changed_on_amp(self, value):
-        self.reverbComboBox.blockSignals(True)
-        self.reverbComboBox.setCurrentIndex(value)
-        self.reverbComboBox.blockSignals(False)
-
-    def reverb_size_changed_on_amp(self, value):
-        self.reverbSizeSlider.blockSignals(True)
-        self.reverbSizeSlider.setValue(value)
-        self.reverbSizeLcdNumber.display(value)
-        self.reverbSizeSlider.blockSignals(False)
-
-    def reverb_level_changed_on_amp(self, value):
-        self.reverbLevelSlider.blockSignals(True)
-        self.reverbLevelSlider.setValue(value)
-        self.reverbLevelLcdNumber.display(value)
-        self.reverbLevelSlider.blockSignals(False)
-
     def fx_focus_changed_on_amp(self, value):
         # This is a bit of a misnomer, as the amp doesn't emit data if
         # the user changes the effect focus on the amp. However, when
@@ -399,7 +487,30 @@ class Ui(QMainWindow):
             item.setText(name)
 
     def preset_settings_from_amp(self, settings):
-        self.preset_settings[settings.preset_number] = settings
+        self.preset_bank.update(settings)
+
+    def amp_identity_from_amp(self, identity):
+        # The amp sends its identity in reply to every startup packet,
+        # and startup is sent again when an effect is switched off, so
+        # only the first reply of a connection starts a sync
+        if self.preset_sync is not None:
+            if self.preset_sync.identity == bytes(identity):
+                return
+            self.preset_sync.stop()
+
+        self.bank_fetch_start = time.perf_counter()
+        self.preset_sync = PresetSync(self.amp, self.preset_cache, identity)
+        if self.preset_sync.from_cache:
+            for i, name in enumerate(self.preset_sync.names):
+                if name is not None:
+                    self.preset_name_from_amp([i + 1, name])
+            self.preset_bank = PresetBank.frombytes(
+                self.preset_sync.bank.tobytes())
+            logger.debug('Presets loaded from cache {0:.3f}s after connect'.format(
+                time.monotonic() - self.connect_time))
+
+        self.preset_sync.add_done_callback(self.preset_sync_done)
+        self.preset_sync.start()
 
     def preset_changed_on_amp(self, value):
         # TODO: This function is a stub for now, but will need hooking
@@ -433,27 +544,6 @@ class Ui(QMainWindow):
         # TODO: Stub for now - needs hooking into a suitable tuner widget
         logger.debug('tuner_delta changed on amp: {0}'.format(value))
 
-    def resonance_changed_on_amp(self, value):
-        self.resonanceSlider.blockSignals(True)
-        self.resonanceSlider.setValue(value)
-        self.resonanceLcdNumber.display(value)
-        self.resonanceSlider.blockSignals(False)
-        logger.debug('resonance changed on amp: {0}'.format(value))
-
-    def presence_changed_on_amp(self, value):
-        self.presenceSlider.blockSignals(True)
-        self.presenceSlider.setValue(value)
-        self.presenceLcdNumber.display(value)
-        self.presenceSlider.blockSignals(False)
-        logger.debug('presence changed on amp: {0}'.format(value))
-
-    def master_volume_changed_on_amp(self, value):
-        self.masterVolumeSlider.blockSignals(True)
-        self.masterVolumeSlider.setValue(value)
-        self.masterVolumeLcdNumber.display(value)
-        self.masterVolumeSlider.blockSignals(False)
-        logger.debug('master_volume changed on amp: {0}'.format(value))
-
     ##################################################################
     # The following methods are the slots for changes made on the gui
     ##################################################################
@@ -473,166 +563,26 @@ class Ui(QMainWindow):
             self.controls_enabled(False)
             self.connectToAmpButton.setText('Connect to Amp')
 
-    @pyqtSlot(int)
-    def on_volumeSlider_valueChanged(self, value):
-        logger.debug('Volume slider: {0}'.format(value))
-        self.amp.set_control('volume', value)
-
-    @pyqtSlot(int)
-    def on_gainSlider_valueChanged(self, value):
-        logger.debug('Gain slider: {0}'.format(value))
-        self.amp.set_control('gain', value)
-
-    @pyqtSlot(int)
-    def on_bassSlider_valueChanged(self, value):
-        logger.debug('Bass slider: {0}'.format(value))
-        self.amp.set_control('bass', value)
-
-    @pyqtSlot(int)
-    def on_middleSlider_valueChanged(self, value):
-        logger.debug('Middle slider: {0}'.format(value))
-        self.amp.set_control('middle', value)
-
-    @pyqtSlot(int)
-    def on_trebleSlider_valueChanged(self, value):
-        logger.debug('Treble slider: {0}'.format(value))
-        self.amp.set_control('treble', value)
-
-    @pyqtSlot(int)
-    def on_isfSlider_valueChanged(self, value):
-        logger.debug('ISF slider: {0}'.format(value))
-        self.amp.set_control('isf', value)
-
-    @pyqtSlot(int)
-    def on_TVPComboBox_currentIndexChanged(self, idx):
-        logger.debug('TVP selection: {0}'.format(idx))
-        self.amp.set_control('tvp_valve', idx)
-
-    @pyqtSlot(bool)
-    def on_TVPRadioButton_toggled(self, state):
-        logger.debug('TVP switch: {0}'.format(state))
-        if state == True:
-            self.amp.set_control('tvp_switch', 1)
-        else:
-            self.amp.set_control('tvp_switch', 0)
-
-    @pyqtSlot(int)
-    def on_voiceComboBox_currentIndexChanged(self, idx):
-        logger.debug('Voice selection: {0}'.format(idx))
-        self.amp.set_control('voice', idx)
-
-    @pyqtSlot(bool)
-    def on_modRadioButton_toggled(self, state):
-        logger.debug('Mod switch: {0}'.format(state))
-        self.amp.set_control('mod_switch', state)
-        if state == 1:
-            self.amp.set_control('fx_focus', 1)
-        else:
-            # Find out if the mod effect had focus before being
-            # deactivated and shift focus to another effect if
-            # possible. The only mechanism we have available to do
-            # this is to get the status of all controls, sadly.
-            self.amp.startup()
-        self.assess_manual_enabled()
-
-    @pyqtSlot(int)
-    def on_modComboBox_currentIndexChanged(self, value):
-        logger.debug('Mod Combo Box: {0}'.format(value))
-        self.amp.set_control('mod_type', value)
-        self.amp.set_control('fx_focus', 1)
-
-    @pyqtSlot(int)
-    def on_modSegValSlider_valueChanged(self, value):
-        logger.debug('Mod SegVal slider: {0}'.format(value))
-        self.amp.set_control('mod_segval', value)
-        self.amp.set_control('fx_focus', 1)
-
-    @pyqtSlot(int)
-    def on_modLevelSlider_valueChanged(self, value):
-        logger.debug('Mod Level slider: {0}'.format(value))
-        self.amp.set_control('mod_level', value)
-        self.amp.set_control('fx_focus', 1)
-
-    @pyqtSlot(int)
-    def on_modSpeedSlider_valueChanged(self, value):
-        logger.debug('Mod Speed slider: {0}'.format(value))
-        self.amp.set_control('mod_speed', value)
-        self.amp.set_control('fx_focus', 1)
-
-    @pyqtSlot(int)
-    def on_modManualSlider_valueChanged(self, value):
-        logger.debug('Mod Manual slider: {0}'.format(value))
-        self.amp.set_control('mod_manual', value)
-        self.amp.set_control('fx_focus', 1)
-
-    @pyqtSlot(bool)
-    def on_delayRadioButton_toggled(self, state):
-        logger.debug('Delay switch: {0}'.format(state))
-        self.amp.set_control('delay_switch', state)
-        if state == 1:
-            self.amp.set_control('fx_focus', 2)
-        else:
-            # Find out if the mod effect had focus before being
-            # deactivated and shift focus to another effect if
-            # possible. The only mechanism we have available to do
-            # this is to get the status of all controls, sadly.
-            self.amp.startup()
-
-    @pyqtSlot(int)
-    def on_delayComboBox_currentIndexChanged(self, value):
-        logger.debug('Delay Combo Box: {0}'.format(value))
-        self.amp.set_control('delay_type', value)
-        self.amp.set_control('fx_focus', 2)
-
-    @pyqtSlot(int)
-    def on_delayFeedbackSlider_valueChanged(self, value):
-        logger.debug('Delay feedback slider: {0}'.format(value))
-        self.amp.set_control('delay_feedback', value)
-        self.amp.set_control('fx_focus', 2)
-
-    @pyqtSlot(int)
-    def on_delayLevelSlider_valueChanged(self, value):
-        logger.debug('Delay Level slider: {0}'.format(value))
-        self.amp.set_control('delay_level', value)
-        self.amp.set_control('fx_focus', 2)
-
-    @pyqtSlot(int)
-    def on_delayTimeSlider_valueChanged(self, value):
-        logger.debug('Delay Time slider: {0}'.format(value))
-        self.amp.set_control('delay_time', value)
-        self.amp.set_control('fx_focus', 2)
-
-    @pyqtSlot(bool)
-    def on_reverbRadioButton_toggled(self, state):
-        logger.debug('Reverb switch: {0}'.format(state))
-        self.amp.set_control('reverb_switch', state)
-        if state == 1:
-            self.amp.set_control('fx_focus', 3)
+    # The slots of the bound widgets, connected by bind_widgets
+    def control_changed_on_gui(self, control, focus, value):
+        self.amp.queue_control(control, value)
+        if focus is not None:
+            self.amp.queue_control('fx_focus', focus)
+
+    def switch_changed_on_gui(self, control, focus, state):
+        logger.debug('{0}: {1}'.format(control, state))
+        self.amp.set_control(control, int(state))
+        if focus is None:
+            return
+        if state:
+            self.amp.set_control('fx_focus', focus)
         else:
-            # Find out if the mod effect had focus before being
+            # Find out if the effect had focus before being
             # deactivated and shift focus to another effect if
             # possible. The only mechanism we have available to do
             # this is to get the status of all controls, sadly.
             self.amp.startup()
 
-    @pyqtSlot(int)
-    def on_reverbComboBox_currentIndexChanged(self, value):
-        logger.debug('Reverb Combo Box: {0}'.format(value))
-        self.amp.set_control('reverb_type', value)
-        self.amp.set_control('fx_focus', 3)
-
-    @pyqtSlot(int)
-    def on_reverbSizeSlider_valueChanged(self, value):
-        logger.debug('Reverb Size slider: {0}'.format(value))
-        self.amp.set_control('reverb_size', value)
-        self.amp.set_control('fx_focus', 3)
-
-    @pyqtSlot(int)
-    def on_reverbLevelSlider_valueChanged(self, value):
-        logger.debug('Reverb Level slider: {0}'.format(value))
-        self.amp.set_control('reverb_level', value)
-        self.amp.set_control('fx_focus', 3)
-
     @pyqtSlot(QListWidgetItem)
     def on_presetNamesList_itemDoubleClicked(self, item):
         idx = self.presetNamesList.currentRow()
@@ -649,12 +599,10 @@ class Ui(QMainWindow):
             'Enter new name for preset {0}:'.format(preset)
         )
         if ok == True:
-            # We need to grab the amp mutex to stop the amp watcher
-            # thread from consuming the packets emitted by the amp in
-            # the preset rename process
-            self.amp_mutex.lock()
+            # set_preset_name holds the amp's I/O lock, which stops
+            # the amp watcher thread from consuming the packets
+            # emitted by the amp in the preset rename process
             self.amp.set_preset_name(preset, name)
-            self.amp_mutex.unlock()
 
     # When the modulation type is changed, we want to change the label
     # associated with the segment value control. So, we need to define
@@ -676,24 +624,9 @@ class Ui(QMainWindow):
             self.mod_segval_label_update.emit('FreqMod')
         self.assess_manual_enabled()
 
-    @pyqtSlot(int)
-    def on_resonanceSlider_valueChanged(self, value):
-        logger.debug('Resonance slider: {0}'.format(value))
-        self.amp.set_control('resonance', value)
-
-    @pyqtSlot(int)
-    def on_presenceSlider_valueChanged(self, value):
-        logger.debug('Presence slider: {0}'.format(value))
-        self.amp.set_control('presence', value)
-
-    @pyqtSlot(int)
-    def on_masterVolumeSlider_valueChanged(self, value):
-        logger.debug('Master volume slider: {0}'.format(value))
-        self.amp.set_control('master_volume', value)
-
-
     # When the modulation is enabled and the modution type is flanger, enable
     # the manual control.
+    @pyqtSlot()
     def assess_manual_enabled(self):
         value = self.modRadioButton.isChecked() and self.modComboBox.currentIndex() == 1
         self.modManualSlider.blockSignals(True)
@@ -702,56 +635,49 @@ class Ui(QMainWindow):
 
 
 class AmpControlWatcher(QObject):
-    have_data = pyqtSignal(dict, name='have_data')
-    shutdown = False
 
-    @pyqtSlot()
-    def stop_watching(self):
-        logger.debug('signal received in stop_watching slot')
-        self.shutdown = True
+    '''Reads data from the amp in a background thread, which blocks on
+    the amp rather than polling. Data is placed on a queue, and the
+    have_data signal is emitted when data becomes available. The
+    signal is emitted once however much data is queued, until the
+    queue has been emptied with get_data.
+
+    '''
 
-    def __init__(self, amp, mutex):
+    have_data = pyqtSignal(name='have_data')
+
+    def __init__(self, amp, timeout=0.1):
         super(AmpControlWatcher, self).__init__()
-        self.amp = amp
-        self.amp_mutex = mutex
+        self.queue = queue.Queue()
+        self._notified = threading.Event()
+        self.reader = AmpReader(amp, self._data_from_amp, timeout,
+                                name='AmpControlWatcher')
         logger.debug('AmpControlWatcher initialized')
 
-    def work(self):
-
-        logger.debug("AmpWatcher work function started")
-
-        # Poll persistently until some data appears. If there's no
-        # data, read_data() will raise an exception, so we just catch
-        # that and carry on.
-        while not self.shutdown:
-            # We need to call this, otherwise in the thread the
-            # shutdown signal is never processed
-            QApplication.processEvents()
-            if self.amp_mutex.tryLock():
-                try:
-                    settings = self.amp.read_data()
-                except NoDataAvailable:
-                    self.amp_mutex.unlock()
-                    logger.debug('No changes of amp controls reported')
-                else:
-                    self.amp_mutex.unlock()
-                    for control, value in settings.items():
-                        if control == 'preset_settings':
-                            logger.debug(
-                                'Amp preset settings:: preset: {0} settings: {1}'.format(
-                                    value.preset_number, value)
-                            )
-                        elif control == 'preset_name':
-                            logger.debug(
-                                'Amp preset name:: preset: {0} name: {1}'.format(
-                                    value[0], value[1])
-                            )
-                        else:
-                            logger.debug(
-                                'Amp adjustment detected:: control: {0} value: {1}'.format(
-                                    control, value)
-                            )
-
-                        self.have_data.emit(settings)
-
-        logger.debug('AmpWatcher watching loop exited')
+    def start(self):
+        self.reader.start()
+
+    def stop(self):
+        self.reader.stop()
+
+    def _data_from_amp(self, settings):
+        # Called in the reader thread
+        self.queue.put(settings)
+        if not self._notified.is_set():
+            self._notified.set()
+            self.have_data.emit()
+
+    def get_data(self):
+        '''Remove and return a list of all the queued data. This must be
+        called from the GUI thread.
+
+        '''
+        # Clear the flag first, so that data queued while we're
+        # emptying the queue results in a new signal
+        self._notified.clear()
+        data = []
+        while True:
+            try:
+                data.append(self.queue.get_nowait())
+            except queue.Empty:
+                return data
@@ -21,11 +21,35 @@ of amplifiers.
 """
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 from codecs import open
 from os import path
 
 here = path.abspath(path.dirname(__file__))
 
+
+class build_py_ui(build_py):
+
+    """Also compiles outsider/outsider.ui to the Python module
+    outsider/outsider_ui.py, which the GUI starts faster from. Without
+    PyQt5 at build time the module isn't built, and the GUI compiles
+    the .ui file into the user's cache directory when first run.
+
+    """
+
+    def run(self):
+        build_py.run(self)
+        try:
+            from PyQt5 import uic
+        except ImportError:
+            self.warn('PyQt5 not available, not compiling outsider.ui')
+            return
+        target = path.join(self.build_lib, 'outsider', 'outsider_ui.py')
+        self.announce('compiling outsider.ui to {0}'.format(target), level=2)
+        if not self.dry_run:
+            with open(target, 'w', encoding='utf-8') as f:
+                uic.compileUi(path.join(here, 'outsider', 'outsider.ui'), f)
+
 with open(path.join(here, 'DESCRIPTION.rst'), encoding='utf-8') as f:
     long_description = f.read()
 
@@ -69,6 +93,9 @@ setup(
     #     'dev': ['check-manifest'],
     #     'test': ['coverage'],
     # },
+    extras_require={
+        'numpy': ['numpy'],
+    },
 
     package_data={
         'outsider': ['outsider.ui'],
@@ -83,9 +110,16 @@ setup(
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
+    cmdclass={
+        'build_py': build_py_ui,
+    },
+
     entry_points={
         'gui_scripts': [
             'outsider = outsider.__main__:main',
         ],
+        'console_scripts': [
+            'blackstarid-daemon = blackstarid.daemon:main',
+        ],
     },
 )
@@ -0,0 +1,119 @@
+# This file is part of Outsider.
+#
+# Outsider is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Outsider is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Outsider.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2015, Jonathan Underwood. All rights reserved.
+
+'''Tests of blackstarid.library. Run with:
+
+    python3 -m unittest discover tests
+
+'''
+
+import os
+import tempfile
+import unittest
+
+from blackstarid.library import PresetLibrary
+
+INSIDER_PRESET = '''<?xml version="1.0" encoding="UTF-8"?>
+<Preset>
+  <Amplifier>
+    <Voice>3</Voice>
+    <Gain>96</Gain>
+    <Volume>40</Volume>
+    <Bass>70</Bass>
+    <Middle>50</Middle>
+    <Treble>80</Treble>
+    <ISF>30</ISF>
+    <TVP Status="1">2</TVP>
+  </Amplifier>
+  <EffectsChain Focused="2">
+    <Modulation Status="0" Position="1">
+      <Types/>
+      <Level>64</Level>
+      <Rate>20</Rate>
+      <Adjust1>5</Adjust1>
+      <Adjust2>64</Adjust2>
+    </Modulation>
+    <Delay Status="1" Position="2">
+      <Types/>
+      <Level>50</Level>
+      <Tempo>450</Tempo>
+      <Adjust1>12</Adjust1>
+      <Adjust2>127</Adjust2>
+    </Delay>
+    <Reverb Status="1" Position="0">
+      <Types/>
+      <Level>30</Level>
+      <Adjust1>10</Adjust1>
+      <Adjust2>0</Adjust2>
+    </Reverb>
+  </EffectsChain>
+  <Info>
+    <Name>Benchmark Lead</Name>
+    <Creator>outsider</Creator>
+    <Genre>3</Genre>
+    <SubGenre>1</SubGenre>
+    <SearchTags>lead solo</SearchTags>
+    <About>Synthetic preset used by the benchmark suite</About>
+  </Info>
+  <Tuner>0</Tuner>
+  <Bench>0</Bench>
+  <Audio>
+    <Metronome Type="0">120</Metronome>
+    <Track Repeat="0"></Track>
+  </Audio>
+</Preset>
+'''
+
+
+class ImportTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self._tmpdir.name
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_bad_file_is_reported(self):
+        # Enough files to be parsed by worker processes, and one with a
+        # delay time too large for its field in the settings packet
+        for i in range(70):
+            self.write('{0}.rig'.format(i), INSIDER_PRESET.replace(
+                'Benchmark Lead', 'Preset {0}'.format(i)))
+        bad = self.write('bad.rig', INSIDER_PRESET.replace(
+            '<Tempo>450</Tempo>', '<Tempo>70000</Tempo>'))
+
+        for workers in (1, 2):
+            library = PresetLibrary(':memory:')
+            try:
+                result = library.import_tree(self.directory, workers=workers)
+                self.assertEqual(result['added'], 70)
+                self.assertEqual([path for path, error in result['failed']],
+                                 [bad])
+                self.assertEqual(len(library.search()), 70)
+            finally:
+                library.close()
+
+
+if __name__ == '__main__':
+    unittest.main()